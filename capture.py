@@ -0,0 +1,121 @@
+import collections
+import gzip
+import queue
+import struct
+import threading
+import time
+
+
+# Capture file (gzip compressed)
+#   magic (4 bytes) + version (2 bytes)
+#   records: kind (1 byte), connection id (4 bytes), time since the start of the capture (8 bytes), length (4 bytes),
+#            followed by 'length' bytes (the peer address for RECORD_OPEN, the complete frame for RECORD_FRAME)
+CAPTURE_MAGIC = b'HCAP'
+CAPTURE_VERSION = 1
+CAPTURE_RECORD = struct.Struct('<BIdI')
+
+RECORD_OPEN = 0
+RECORD_FRAME = 1
+RECORD_CLOSE = 2
+
+
+class CaptureWriter(object):
+    """
+    Records the frames received by the server on each connection, with their timing, so that the sessions can be
+    replayed later against another server.
+
+    The records are timestamped and copied when they are received, and compressed and written to the file by a
+    background thread, so that capturing doesn't slow down (or skew the timing of) the sessions captured.
+    """
+    def __init__(self, path, compresslevel=1):
+        self.path = path
+        self._file = gzip.open(path, 'wb', compresslevel=compresslevel)
+        self._file.write(CAPTURE_MAGIC + CAPTURE_VERSION.to_bytes(2, byteorder='little'))
+        self._start = time.perf_counter()
+        self._next_connection_id = 1
+        self._records = queue.Queue()
+        self._writer = threading.Thread(target=self._write_records, daemon=True)
+        self._writer.start()
+
+    def open_connection(self, peer=None):
+        """
+        :return: The id of the new connection, to be used in the next records
+        """
+        connection_id = self._next_connection_id
+        self._next_connection_id += 1
+        self._write(RECORD_OPEN, connection_id, str(peer or '').encode())
+        return connection_id
+
+    def record_frame(self, connection_id, frame):
+        self._write(RECORD_FRAME, connection_id, frame)
+
+    def close_connection(self, connection_id):
+        self._write(RECORD_CLOSE, connection_id, b'')
+
+    def _write(self, kind, connection_id, data):
+        # the frame is a view on the receive buffer, which is reused for the next frames
+        self._records.put((CAPTURE_RECORD.pack(kind, connection_id, time.perf_counter() - self._start, len(data)),
+                           bytes(data)))
+
+    def _write_records(self):
+        while True:
+            record = self._records.get()
+            if record is None:
+                break
+            header, data = record
+            self._file.write(header)
+            self._file.write(data)
+
+    def close(self):
+        """
+        Writes the records still queued and closes the file.
+        """
+        self._records.put(None)
+        self._writer.join()
+        self._file.close()
+
+
+class CapturedSession(object):
+    def __init__(self, connection_id, peer, start):
+        self.connection_id = connection_id
+        self.peer = peer
+        self.start = start
+        # list of (time since the start of the session, frame)
+        self.frames = []
+
+    @property
+    def size(self):
+        return sum(len(frame) for _, frame in self.frames)
+
+
+def read_capture(path):
+    """
+    Reads a capture file. A capture that was interrupted (e.g., the server was killed) is read up to its last
+    complete record.
+    :return: List of CapturedSession, ordered by the time the connections were opened
+    """
+    sessions = collections.OrderedDict()
+    with gzip.open(path, 'rb') as f:
+        preamble = f.read(len(CAPTURE_MAGIC) + 2)
+        if preamble[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC or int.from_bytes(preamble[4:], 'little') != CAPTURE_VERSION:
+            raise ValueError(f'{path} is not a capture file')
+
+        while True:
+            try:
+                record = f.read(CAPTURE_RECORD.size)
+                if len(record) != CAPTURE_RECORD.size:
+                    break
+                kind, connection_id, timestamp, length = CAPTURE_RECORD.unpack(record)
+                data = f.read(length)
+                if len(data) != length:
+                    break
+            except EOFError:
+                break
+
+            if kind == RECORD_OPEN:
+                sessions[connection_id] = CapturedSession(connection_id, data.decode(), timestamp)
+            elif kind == RECORD_FRAME and connection_id in sessions:
+                session = sessions[connection_id]
+                session.frames.append((timestamp - session.start, data))
+
+    return [session for session in sessions.values() if session.frames]
@@ -0,0 +1,255 @@
+import array
+import errno
+import time
+from health import DeviceWatchdog
+
+
+class DeviceRecoveredError(AssertionError):
+    """
+    A command failed and the device had to be restarted or reset to recover, so it lost the commands written before
+    (e.g. the metadata of the sound): the command isn't written again on its own, the whole upload has to be.
+    """
+
+
+class SoundCardDevice(object):
+    """
+    USB connection to the Harp sound card. Commands are written with 'send_command', which waits for the reply of the
+    device and recovers the connection when the device fails, according to the health followed by the watchdog.
+    """
+    def __init__(self, watchdog=None, max_retries=3):
+        """
+        :param watchdog: (Optional) DeviceWatchdog with the timeouts and the health of the device
+        :param max_retries: (Optional) Number of times a command that failed is written again
+        """
+        self.watchdog = watchdog if watchdog is not None else DeviceWatchdog()
+        self.max_retries = max_retries
+        # number of commands written again since the device was created
+        self.retries = 0
+        self.conn_open = False
+        self._dev = None
+        self._int32_size = 4
+        # Data command reply:     'c' 'm' 'd' '0x81' + random + error
+        self._reply = array.array('b', [0] * (4 + self._int32_size + self._int32_size))
+
+    def open(self):
+        if self.conn_open is True:
+            return True
+
+        # pyusb is only imported when needed, so that it doesn't delay the start of the server
+        import usb.core
+        import usb.util
+        from usb.backend import libusb1 as libusb
+
+        print('Trying to open USB connection to the Harp sound card')
+        backend = libusb.get_backend()
+        # backend = libusb.get_backend(find_library=lambda x: "libusb-1.0.dll")
+        self._dev = usb.core.find(backend=backend, idVendor=0x04d8, idProduct=0xee6a)
+        if self._dev is None:
+            print(f'\tError while trying to connect to the Harp sound card. Please make sure it is connected to the computer and try again.')
+            return False
+
+        print(f'backend used: {self._dev.backend}')
+        if self._dev is None:
+            print('\tSoundCard not found. Please connect it to the USB port before proceeding.')
+        else:
+            # set the active configuration. With no arguments, the first configuration will be the active one
+            # note: some devices reset when setting an already selected configuration so we should check for it before
+            _cfg = self._dev.get_active_configuration()
+            if _cfg is None or _cfg.bConfigurationValue != 1:
+                self._dev.set_configuration(1)
+            usb.util.claim_interface(self._dev, 0)
+
+        self.conn_open = True
+        return True
+
+    def restart(self):
+        print('Restarting USB connection')
+        self.close()
+        self.open()
+
+    def reset(self):
+        """
+        Resets the device, waits 700ms and tries to connect again so that the current instance of the SoundCard object can still be used.
+        :note Necessary at the moment after sending a sound
+        """
+        print('Resetting device')
+        if not self._dev:
+            raise Exception("Sound card might not be connected. Please connect it before any operation.")
+
+        # Reset command length:    'c' 'm' 'd' '0x88' + 'f'
+        reset_cmd = [ord('c'), ord('m'), ord('d'), 0x88, ord('f')]
+        # cmd = 'cmd' + chr(0x88) + 'f'
+        wrt = self._dev.write(1, reset_cmd, 100)
+        if wrt != len(reset_cmd):
+            raise AssertionError("Error while sending reset command to device")
+
+        time.sleep(700.0 / 1000.0)
+        # the device enumerates again after the reset, so the previous handle can't be reused
+        self.close()
+        self.open()
+
+    def close(self):
+        print('Closing USB connection')
+        # close usb connection
+        if self._dev:
+            import usb.util
+            usb.util.dispose_resources(self._dev)
+        self.conn_open = False
+
+    def wait_for_connection(self):
+        """
+        Blocks until the connection to the device is open.
+        """
+        if self.conn_open is True:
+            return
+        while self.open() is False:
+            # wait a bit before trying again
+            time.sleep(1)
+
+    def flush(self):
+        """
+        Commands are written synchronously, so there's nothing to wait for.
+        """
+
+    def start_session(self):
+        """
+        Starts the commands of a new upload. The connection is proactively recovered here if the throughput collapsed
+        even without errors, as a restart (or reset) in the middle of an upload would lose the metadata of its sound.
+        Commands are written synchronously, so there are no failures of previous uploads left to discard.
+        """
+        if self.watchdog.recovery_action() is not None:
+            self._recover()
+
+    def wait_for_slot(self, blocking=True):
+        """
+        Commands are written synchronously, so there's no queue to wait for.
+        """
+        return True
+
+    def send_command(self, data_to_send: bytes, rand_val, is_metadata=False, data_size=0):
+        """
+        Writes a command to the device and waits for its reply. The timeouts used are the ones learned by the watchdog.
+        A command that fails (USB error, wrong reply or error reply) is written again, up to 'max_retries' times,
+        unless the device had to be restarted or reset (DeviceRecoveredError is raised then).
+        :param data_to_send: The complete command to write
+        :param rand_val: The random value of the command, that should be in the reply
+        :param is_metadata: (Optional) True if this is the metadata command, which takes longer to be acknowledged
+        :param data_size: (Optional) Number of bytes of sound data in the command, used to follow the throughput
+        """
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.retries += 1
+                print(f'Writing the command again (retry {attempt} of {self.max_retries})')
+            try:
+                if self._write_command(data_to_send, rand_val, is_metadata, data_size):
+                    return
+            except DeviceRecoveredError:
+                raise
+            except AssertionError as e:
+                error = e
+                print(f'Command failed with message {e}')
+
+        raise AssertionError(f'Command failed after {self.max_retries} retries' + (f': {error}' if error else ''))
+
+    def _write_command(self, data_to_send, rand_val, is_metadata, data_size):
+        """
+        :return: True if the device acknowledged the command, False if the connection had to be recovered
+        """
+        import usb.core
+
+        start = time.perf_counter()
+        try:
+            res_write = self._dev.write(0x01, data_to_send, self.watchdog.write_timeout)
+        except usb.core.USBError as e:
+            print(f'Exception while writing to device with message {e}')
+            self.watchdog.record_failure('write', timed_out=e.errno == errno.ETIMEDOUT)
+            self._recover_connection()
+            return False
+
+        write_done = time.perf_counter()
+        self.watchdog.record_write(write_done - start)
+
+        if res_write != len(data_to_send):
+            self.watchdog.record_failure('write')
+            raise AssertionError("Written data size on device different than data sent size")
+
+        if not self._receive_reply(rand_val, is_metadata):
+            return False
+        self.watchdog.record_ack(time.perf_counter() - write_done, is_metadata)
+        self.watchdog.record_success(data_size, time.perf_counter() - start)
+        return True
+
+    def _receive_reply(self, rand_val, is_metadata=False):
+        import usb.core
+
+        read_timeout = self.watchdog.metadata_ack_timeout if is_metadata else self.watchdog.ack_timeout
+        try:
+            ret = self._dev.read(0x81, self._reply, read_timeout)
+        except usb.core.USBError as e:
+            print(f'Exception while reading from device with message {e}')
+            self.watchdog.record_failure('ack', timed_out=e.errno == errno.ETIMEDOUT, metadata=is_metadata)
+            self._recover_connection()
+            return False
+
+        # get the random received and the error received from the reply command
+        rand_val_received = int.from_bytes(self._reply[4: 4 + self._int32_size], byteorder='little', signed=True)
+        error_received = int.from_bytes(self._reply[8: 8 + self._int32_size], byteorder='little', signed=False)
+
+        if ret != 12:
+            self.watchdog.record_failure('error')
+            raise AssertionError("Reply from device is not 12 bytes")
+
+        if rand_val_received != rand_val:
+            self.watchdog.record_failure('value')
+            raise AssertionError("Random value received different than the random value sent")
+
+        if error_received != 0:
+            self.watchdog.record_failure('error')
+            raise AssertionError("Error received from device")
+
+        return True
+
+    def _recover_connection(self):
+        """
+        Recovers after a failed command, which can only be written again if the device was neither restarted nor
+        reset.
+        """
+        action = self._recover()
+        if action is not None:
+            raise DeviceRecoveredError(f'Device recovered with a {action}, the upload has to be sent again')
+
+    def _recover(self):
+        """
+        Brings the device back after a failure. While the watchdog doesn't consider the device wedged, it simply waits
+        for the connection to be available again, otherwise it restarts the USB connection or resets the device.
+        :return: The action taken ('restart' or 'reset'), or None if the connection was kept
+        """
+        import usb.core
+
+        action = self.watchdog.recovery_action()
+        if action is None:
+            time.sleep(1)
+            self.conn_open = False
+            self.wait_for_connection()
+            return None
+
+        print(f'Device health is "{self.watchdog.state}", trying to recover with a {action}')
+        try:
+            if action == 'reset':
+                self.reset()
+            else:
+                self.restart()
+        except (usb.core.USBError, AssertionError) as e:
+            print(f'Exception while trying to recover the device with message {e}')
+        self.watchdog.record_recovery(action)
+
+        self.wait_for_connection()
+        return action
+
+    def as_dict(self):
+        return {
+            'connected': self.conn_open,
+            'health': self.watchdog.as_dict(),
+            'retries': self.retries,
+        }
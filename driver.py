@@ -0,0 +1,286 @@
+import multiprocessing
+import queue
+import threading
+import numpy as np
+from device import SoundCardDevice
+
+
+# The front end copies each command to the next slot of a ring buffer in shared memory and sends a small request to
+# the driver process, which owns the sound card:
+#   (REQUEST_COMMAND, sequence, slot, size, random value, is metadata, data size) or (REQUEST_*, sequence)
+# The driver process writes the commands to the device in order and sends back small notifications:
+#   (EVENT_*, sequence, error message or None, health of the device or None)
+# The largest command is the metadata command: 'cmd' 0x80 + random + 16 + 32768 + 2048 + 'f' (34841 bytes)
+SLOT_SIZE = 34880
+
+REQUEST_COMMAND = 0
+REQUEST_RESTART = 1
+REQUEST_RESET = 2
+REQUEST_STOP = 3
+REQUEST_SESSION = 4
+
+EVENT_READY = 0
+EVENT_DONE = 1
+EVENT_STOPPED = 2
+
+# the health of the device is sent with the completion of every HEALTH_INTERVAL commands (and of failed ones)
+HEALTH_INTERVAL = 32
+
+
+def run_driver(ring_name, requests, completions, device_factory=SoundCardDevice):
+    """
+    Main function of the driver process.
+    """
+    from multiprocessing import shared_memory
+
+    ring = shared_memory.SharedMemory(name=ring_name)
+    device = device_factory()
+    try:
+        device.wait_for_connection()
+        completions.put((EVENT_READY, -1, None, device.as_dict()))
+
+        while True:
+            request = requests.get()
+            kind, sequence = request[:2]
+            if kind == REQUEST_STOP:
+                break
+
+            error = None
+            try:
+                if kind == REQUEST_COMMAND:
+                    slot, size, rand_val, is_metadata, data_size = request[2:]
+                    offset = slot * SLOT_SIZE
+                    device.send_command(bytes(ring.buf[offset: offset + size]), rand_val, is_metadata, data_size)
+                elif kind == REQUEST_RESTART:
+                    device.restart()
+                elif kind == REQUEST_RESET:
+                    device.reset()
+                elif kind == REQUEST_SESSION:
+                    device.start_session()
+            except Exception as e:
+                error = str(e) or type(e).__name__
+
+            health = device.as_dict() if error is not None or sequence % HEALTH_INTERVAL == 0 else None
+            completions.put((EVENT_DONE, sequence, error, health))
+    finally:
+        device.close()
+        ring.close()
+
+
+class DeviceProcess(object):
+    """
+    Sound card driven by a separate process, with the same interface as SoundCardDevice.
+
+    'send_command' only copies the command to the ring buffer, and returns as soon as there's a free slot, so the
+    front end prepares the next commands while the device writes the previous ones. A failure of a command is raised
+    by the next call to 'send_command' or 'flush' of the same session (see 'start_session').
+    """
+    def __init__(self, slots=8, device_factory=SoundCardDevice):
+        """
+        :param slots: (Optional) Number of commands that can be queued to the driver process
+        :param device_factory: (Optional) Callable that creates the device in the driver process (it has to be
+            importable by the process, e.g. a class defined at the top level of a module)
+        """
+        self.slots = slots
+        self.conn_open = False
+        self._device_factory = device_factory
+        self._context = multiprocessing.get_context('spawn')
+        self._ring = None
+        self._process = None
+        self._requests = None
+        self._completions = None
+        self._listener = None
+
+        self._free_slots = threading.Semaphore(slots)
+        self._completed = threading.Condition()
+        self._ready = threading.Event()
+        self._next_sequence = 0
+        self._completed_sequence = 0
+        # first sequence number of the session in progress, and the first failure of its commands (sequence, message)
+        self._session_start = 0
+        self._error = None
+        self._health = {}
+        self._retries = 0
+
+    def start(self):
+        # shared memory needs Python 3.8, so it is only imported when the driver process is used
+        from multiprocessing import shared_memory
+
+        # the commands still queued to a previous process (e.g. one that died) won't be completed
+        self._free_slots = threading.Semaphore(self.slots)
+        with self._completed:
+            self._completed_sequence = self._next_sequence
+            self._session_start = self._next_sequence
+            self._error = None
+
+        self._ring = shared_memory.SharedMemory(create=True, size=self.slots * SLOT_SIZE)
+        self._requests = self._context.Queue()
+        self._completions = self._context.Queue()
+        self._process = self._context.Process(target=run_driver, daemon=True,
+                                              args=(self._ring.name, self._requests, self._completions,
+                                                    self._device_factory))
+        self._process.start()
+        self._listener = threading.Thread(target=self._receive_completions, args=(self._process,), daemon=True)
+        self._listener.start()
+
+    def _receive_completions(self, process):
+        while True:
+            try:
+                kind, sequence, error, health = self._completions.get(timeout=1.0)
+            except queue.Empty:
+                # the process died (nothing else will be received) or was stopped
+                if not process.is_alive():
+                    break
+                continue
+            except (EOFError, OSError, ValueError):
+                break
+            if kind == EVENT_STOPPED:
+                break
+            if health is not None:
+                self._health = health['health']
+                self._retries = health['retries']
+                self.conn_open = health['connected']
+            if kind == EVENT_READY:
+                self._ready.set()
+                continue
+
+            with self._completed:
+                if error is not None and self._error is None and sequence >= self._session_start:
+                    self._error = (sequence, error)
+                self._completed_sequence = sequence + 1
+                self._completed.notify_all()
+            self._free_slots.release()
+
+    def open(self):
+        """
+        Starts the driver process (if needed, or again if it died) and waits up to a second for it to open the device.
+        :return: True if the device is open
+        """
+        if self._process is not None and not self._process.is_alive():
+            print(f'The device process exited with code {self._process.exitcode}, starting it again')
+            self.close()
+        if self._process is None:
+            self.start()
+        return self._ready.wait(1.0)
+
+    def wait_for_connection(self):
+        self.open()
+        while not self._ready.wait(1.0):
+            self._check_process()
+
+    def _check_process(self):
+        if self._process is not None and not self._process.is_alive():
+            self.conn_open = False
+            raise AssertionError(f'The device process exited with code {self._process.exitcode}')
+
+    def _raise_error(self):
+        with self._completed:
+            error, self._error = self._error, None
+        if error is not None:
+            raise AssertionError(error[1])
+
+    def start_session(self):
+        """
+        Starts the commands of a new upload. Failures of the commands queued before (e.g. by an upload that was aborted
+        without flushing) are discarded instead of being raised to the new upload. The device itself starts the session
+        in order with the commands (see SoundCardDevice.start_session).
+        """
+        with self._completed:
+            self._session_start = self._next_sequence
+            if self._error is not None and self._error[0] < self._session_start:
+                self._error = None
+        self._requests.put((REQUEST_SESSION, self._get_sequence()))
+
+    def _get_sequence(self):
+        """
+        Waits for a free slot in the ring buffer.
+        :return: The sequence number of the next request
+        """
+        self._raise_error()
+        while not self._free_slots.acquire(timeout=1.0):
+            self._check_process()
+        sequence = self._next_sequence
+        self._next_sequence += 1
+        return sequence
+
+    def wait_for_slot(self, blocking=True):
+        """
+        Waits for a free slot in the ring buffer, so that the next 'send_command' doesn't block (e.g. called from an
+        executor, so that an event loop isn't blocked while the ring buffer is full).
+        :param blocking: (Optional) False to only check if there's a free slot
+        :return: True if there's a free slot
+        """
+        if blocking:
+            while not self._free_slots.acquire(timeout=1.0):
+                self._check_process()
+        elif not self._free_slots.acquire(blocking=False):
+            return False
+        self._free_slots.release()
+        return True
+
+    def send_command(self, data_to_send: bytes, rand_val, is_metadata=False, data_size=0):
+        """
+        Queues a command to the device (see SoundCardDevice.send_command).
+        """
+        sequence = self._get_sequence()
+        # requests are completed in order, so the slot of the request sent 'slots' requests ago is free
+        slot = sequence % self.slots
+        offset = slot * SLOT_SIZE
+        self._ring.buf[offset: offset + len(data_to_send)] = data_to_send
+        self._requests.put((REQUEST_COMMAND, sequence, slot, len(data_to_send),
+                            int(np.asarray(rand_val).reshape(-1)[0]), bool(is_metadata), int(data_size)))
+
+    def flush(self):
+        """
+        Waits for all the queued commands to be written to the device.
+        """
+        with self._completed:
+            while self._completed_sequence < self._next_sequence:
+                if not self._completed.wait(1.0):
+                    self._check_process()
+        self._raise_error()
+
+    def restart(self):
+        self._send_request_and_wait(REQUEST_RESTART)
+
+    def reset(self):
+        self._send_request_and_wait(REQUEST_RESET)
+
+    def _send_request_and_wait(self, kind):
+        self._requests.put((kind, self._get_sequence()))
+        self.flush()
+
+    def close(self):
+        """
+        Stops the driver process, which closes the USB connection.
+        """
+        if self._process is None:
+            return
+        if self._process.is_alive():
+            self._requests.put((REQUEST_STOP, -1))
+            self._process.join(5)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        # a process that was killed may still hold the lock of the queue, so the listener then stops on its own
+        if self._process.exitcode == 0:
+            self._completions.put((EVENT_STOPPED, -1, None, None))
+        self._listener.join()
+        self._ring.close()
+        self._ring.unlink()
+        self._process = None
+        self._ready.clear()
+        self.conn_open = False
+
+    def as_dict(self):
+        return {
+            'connected': self.conn_open,
+            'health': self._health,
+            'retries': self._retries,
+            'process': {
+                'pid': self._process.pid if self._process is not None else None,
+                'alive': self._process is not None and self._process.is_alive(),
+                'slots': self.slots,
+                'queued': self._next_sequence - self._completed_sequence,
+            },
+        }
@@ -0,0 +1,186 @@
+import collections
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through up to 'rate' records per second of each event (with bursts of up to 'burst' records), so that a
+    flood of the same event (e.g. a client sending corrupted data) can't fill the log. The number of records dropped
+    is added to the next record of the event that gets through.
+    """
+    def __init__(self, rate=10.0, burst=None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        # records dropped of each event since its last record that got through, and in total
+        self.suppressed = collections.Counter()
+        self.suppressed_total = 0
+        self._buckets = {}
+        # records are filtered in the thread that emits them (the event loop or the executor threads)
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        with self._lock:
+            return self._take(record)
+
+    def _take(self, record):
+        event = getattr(record, 'event', None)
+        now = time.monotonic()
+        tokens, last = self._buckets.get(event, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1.0:
+            self._buckets[event] = (tokens, now)
+            self.suppressed[event] += 1
+            self.suppressed_total += 1
+            return False
+
+        self._buckets[event] = (tokens - 1.0, now)
+        suppressed = self.suppressed.pop(event, 0)
+        if suppressed:
+            record.fields = {**getattr(record, 'fields', {}), 'suppressed': suppressed}
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records when the queue is full instead of waiting, and leaves the formatting to the
+    thread of the listener.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as a JSON document in one line: time, level, event, message and the fields of the event.
+    """
+    def format(self, record):
+        document = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage(),
+            **getattr(record, 'fields', {}),
+        }
+        return json.dumps(document, default=str)
+
+
+class EventLog(object):
+    """
+    Structured log of the server for the service mode. Emitting a record only puts it in a queue: the records are
+    formatted and written (to a file or to stderr) by a background thread, so a slow or frozen console never blocks
+    the event loop. Records are rate limited per event and dropped if the queue is full.
+    """
+    def __init__(self, path=None, rate=10.0, level=logging.INFO, queue_size=10000, name='soundcard_server'):
+        """
+        :param path: (Optional) File where the records are appended. By default they are written to stderr
+        :param rate: (Optional) Maximum number of records per second of each event
+        :param level: (Optional) Minimum level of the records written
+        :param queue_size: (Optional) Maximum number of records waiting to be written
+        :param name: (Optional) Name of the logger
+        """
+        self.path = path
+        self._logger = logging.getLogger(name)
+        self._logger.setLevel(level)
+        self._logger.propagate = False
+        self._rate_limit = RateLimitFilter(rate)
+        self._handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+        self._handler.addFilter(self._rate_limit)
+        self._output = None
+        self._listener = None
+
+    def start(self):
+        if self.path is not None:
+            self._output = logging.FileHandler(self.path, encoding='utf-8')
+        else:
+            # the stream is taken now, as sys.stderr might be redirected to the log afterwards
+            self._output = logging.StreamHandler(sys.__stderr__)
+        self._output.setFormatter(JsonFormatter())
+        self._listener = logging.handlers.QueueListener(self._handler.queue, self._output)
+        self._listener.start()
+        self._logger.addHandler(self._handler)
+
+    def stop(self):
+        """
+        Writes the records still in the queue and stops the background thread.
+        """
+        if self._listener is None:
+            return
+        self._logger.removeHandler(self._handler)
+        self._listener.stop()
+        self._output.close()
+        self._listener = None
+
+    def emit(self, event, message, level=logging.INFO, **fields):
+        """
+        :param event: Name of the event (e.g. 'upload'), used to rate limit the records
+        :param message: Human readable description of the event
+        :param level: (Optional) Level of the record
+        :param fields: Values of the event, written as fields of the record
+        """
+        self._logger.log(level, message, extra={'event': event, 'fields': fields})
+
+    def as_dict(self):
+        return {
+            'path': self.path,
+            'queued': self._handler.queue.qsize(),
+            'dropped': self._handler.dropped,
+            'suppressed': self._rate_limit.suppressed_total,
+        }
+
+
+class LogWriter(object):
+    """
+    File-like object that turns the lines written to it into records of an EventLog, to be used as sys.stdout or
+    sys.stderr in service mode, so that the messages printed by other modules don't go to the console either.
+    """
+    def __init__(self, event_log, event='output', level=logging.INFO):
+        self._event_log = event_log
+        self._event = event
+        self._level = level
+        self._buffer = ''
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            self._buffer += text
+            *lines, self._buffer = self._buffer.split('\n')
+        for line in lines:
+            line = line.strip()
+            if line:
+                self._event_log.emit(self._event, line, self._level)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class NullProgress(object):
+    """
+    Stand-in for the progress bar of an upload when there's no console.
+    """
+    def update(self, n=1):
+        pass
+
+    def close(self):
+        pass
@@ -1,16 +1,39 @@
 import asyncio
 import time
 
-from .protocol import Protocol
+from .protocol import Protocol, get_sound_hash
 from .communication import Communication
 from .tools import WindowConfiguration, generate_sound
 
 
-async def tcp_send_sound_client(loop):
-    sound_index = 4
-    duration = 12
-    sample_rate = 96000
-    data_type = 0
+class ClientResult:
+    def __init__(self):
+        self.ok = False
+        self.error = None
+        self.bytes_sent = 0
+        self.total_time = None
+        # time between sending the header and receiving its reply (includes waiting for other uploads to finish)
+        self.time_to_first_reply = None
+        self.packet_sending_timings = []
+        # data commands sent again because the server received them corrupted
+        self.retransmissions = 0
+        # sound index given by the server (with 'tcp_ensure_sound_client') and whether the sound was already loaded
+        self.sound_index = None
+        self.loaded = None
+
+
+async def tcp_send_sound_client(loop, sound_index=4, duration=12, sample_rate=96000, data_type=0, with_data=True,
+                                with_file_metadata=True, address='localhost', port=9999, verbose=True,
+                                source_sample_rate=None, sound_file=None):
+    """
+    Generates a sound and sends it to the server.
+
+    :param source_sample_rate: (Optional) If given, the sound is generated at this sample rate and the server converts
+        it to 'sample_rate' (the sample rate of the Sound Card) while receiving it
+    :param sound_file: (Optional) Binary file with the sound to send instead of generating one. The file is read while
+        the sound is sent, instead of being loaded to memory first.
+    """
+    result = ClientResult()
 
     # define a WindowConfiguration to be applied to the generated sound in the next step
     window_config = WindowConfiguration(left_duration=0,
@@ -22,26 +45,32 @@ async def tcp_send_sound_client(loop):
                                         right_apply_window_end=True,
                                         right_window_function='Bartlett')
 
-    # generate the sound
-    wave_int = generate_sound(fs=sample_rate,                 # sample rate in Hz
-                              duration=duration,              # duration of the sound in seconds
-                              frequency_left=1500,            # frequency of the sinusoidal signal generated in Hz for the left channel
-                              frequency_right=1200,           # frequency of the sinusoidal signal generated in Hz for the right channel
-                              window_configuration=window_config
-                              )
+    if sound_file is not None:
+        # the file is memory-mapped, so it is read while the sound is sent
+        protocol = Protocol.from_file(sound_file)
+    else:
+        # generate the sound
+        wave_int = generate_sound(fs=source_sample_rate or sample_rate,  # sample rate in Hz
+                                  duration=duration,              # duration of the sound in seconds
+                                  frequency_left=1500,            # frequency of the sinusoidal signal generated in Hz for the left channel
+                                  frequency_right=1200,           # frequency of the sinusoidal signal generated in Hz for the right channel
+                                  window_configuration=window_config
+                                  )
+
+        # initialize the Protocol with the data from the generate_sound
+        # (use your own functions to generate your binary sounds if you need something different)
+        protocol = Protocol(wave_int)
 
-    # initialize the Protocol with the data from the generate_sound
-    # (use your own functions to generate your binary sounds if you need something different)
-    protocol = Protocol(wave_int)
     # prepare header (it will define the size of the first command that will be sent to the Sound Card)
-    protocol.prepare_header(with_data=True, with_file_metadata=True)
+    protocol.prepare_header(with_data=with_data, with_file_metadata=with_file_metadata,
+                            source_sample_rate=source_sample_rate)
     # add the metadata information regarding the sound and which index will the sound be written to
     protocol.add_metadata([sound_index, protocol.sound_file_size_in_samples, sample_rate, data_type])
 
     initial_time = time.time()
 
     # initialize communication
-    comm = Communication(protocol, loop)
+    comm = Communication(protocol, loop, address, port)
 
     # start creating message to send according to the protocol
     # NOTE: if on calling prepare_header with_file_metadata was False, the next elements aren't required
@@ -69,34 +98,99 @@ async def tcp_send_sound_client(loop):
     # open communication just before sending data
     await comm.open()
 
+    return await _send_sound(comm, protocol, result, initial_time, verbose)
+
+
+async def _send_sound(comm, protocol, result, initial_time, verbose=True):
+    """
+    Sends the sound through an open connection, starting with the header (that has to be ready to be sent).
+    """
     # send header to server
     comm.send_header(protocol.header)
 
     # receive reply
     reply = await comm.get_reply()
+    result.time_to_first_reply = time.time() - initial_time
 
     # if reply is an error, simply return (ou maybe try again would be more adequate)
     if reply[0] != 2:
-        return
+        result.error = 'Error: WhileSendingHeader'
+        comm.close()
+        return result
 
     # ex. gets the timestamp as per the Harp protocol to verify timings if you wish
     timestamp = protocol.convert_timestamp(reply[5: 5 + 6])
 
     # send rest of data
-    print(f'Sending...')
+    if verbose:
+        print(f'Sending...')
     # Communication.send_sound calculates the duration that it took to send each packet
     (has_error, error_str) = await comm.send_sound()
+    result.packet_sending_timings = comm.packet_sending_timings
+    result.retransmissions = comm.retransmissions
+    result.bytes_sent = len(protocol.header) + len(protocol.data_cmd) * len(comm.packet_sending_timings)
 
     if has_error:
-        print(f'Error while transfering sound data with message "{error_str}". Please try again after resetting the Sound Card')
-        return
+        if verbose:
+            print(f'Error while transfering sound data with message "{error_str}". Please try again after resetting the Sound Card')
+        result.error = error_str
+        comm.close()
+        return result
 
     msg = await comm.get_final_reply()
+    comm.close()
 
     # wait for the server's response after sending everything
     if msg == b'OK':
-        total_time = (time.time() - initial_time)
-        print(f'Elapsed time: {int(round(total_time * 1000))} ms')
+        result.ok = True
+        result.total_time = (time.time() - initial_time)
+        if verbose:
+            print(f'Elapsed time: {int(round(result.total_time * 1000))} ms')
+    return result
+
+
+async def tcp_ensure_sound_client(loop, wave_int, sample_rate=96000, data_type=0, pin=False, address='localhost',
+                                  port=9999, verbose=True):
+    """
+    Has a sound loaded in the Sound Card by a server started with '--sound-cache', which gives the sound index to use.
+    The sound is only sent if it isn't already loaded.
+
+    :param pin: (Optional) If True, the sound is never evicted from the Sound Card by the server
+    :return: ClientResult, with the sound index where the sound is and whether it was already loaded
+    """
+    result = ClientResult()
+    initial_time = time.time()
+
+    protocol = Protocol(wave_int)
+    comm = Communication(protocol, loop, address, port)
+    await comm.open()
+
+    slot = await comm.ensure_sound(get_sound_hash(wave_int, sample_rate, data_type), pin=pin)
+    if slot is None:
+        result.error = 'Error: WhileEnsuringSound'
+        comm.close()
+        return result
+    result.sound_index, result.loaded = slot
+
+    if result.loaded:
+        comm.close()
+        result.ok = True
+        result.total_time = time.time() - initial_time
+        if verbose:
+            print(f'Sound already loaded in index {result.sound_index}')
+        return result
+
+    # the sound index in the metadata is replaced by the server anyway
+    protocol.prepare_header()
+    protocol.add_metadata([result.sound_index, protocol.sound_file_size_in_samples, sample_rate, data_type])
+    protocol.add_filemetadata()
+    protocol.add_first_data_block()
+    protocol.update_header_checksum()
+
+    if verbose:
+        print(f'Loading sound to index {result.sound_index}')
+    return await _send_sound(comm, protocol, result, initial_time, verbose)
+
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
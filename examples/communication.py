@@ -1,6 +1,9 @@
 import asyncio
+import json
 import time
 
+from .protocol import CONTROL_STATUS, CONTROL_PROFILE, REPLY_RETRANSMIT, build_control_frame, build_ensure_frame
+
 
 class Communication:
     def __init__(self, protocol, loop, address='localhost', port=9999):
@@ -12,9 +15,13 @@ class Communication:
         self._loop = loop
 
         self._reply_size = 5 + 6 + 1
+        # duration of the round trip (send and reply) of each data command of the last sound sent
+        self.packet_sending_timings = []
+        # number of data commands of the last sound sent again because the server received them corrupted
+        self.retransmissions = 0
 
     async def open(self):
-        self._reader, self._writer = await asyncio.open_connection(self._address, self._port, loop=self._loop)
+        self._reader, self._writer = await asyncio.open_connection(self._address, self._port)
 
     def send_header(self, header):
         self.send_data(header)
@@ -25,30 +32,86 @@ class Communication:
     async def get_reply(self):
         return await self._reader.readexactly(self._reply_size)
 
-    async def send_sound(self):
-        packet_sending_timings = []
+    async def get_status(self):
+        """
+        Requests the status of the server (device connection, health of the device, ...).
+        The server only handles one request per connection, so it should be used in its own connection.
+        :return: The status as a dictionary, or None if the server replied with an error
+        """
+        self.send_data(build_control_frame(CONTROL_STATUS))
+        reply = await self.get_reply()
+        if reply[0] != 2:
+            return None
+        size = int.from_bytes(await self._reader.readexactly(4), byteorder='little')
+        return json.loads(await self._reader.readexactly(size))
+
+    async def enable_profiling(self):
+        """
+        Asks the server to profile the next uploads (the server has to be started with '--profile-dir').
+        As with 'get_status', it should be used in its own connection.
+        :return: True if the server enabled profiling
+        """
+        self.send_data(build_control_frame(CONTROL_PROFILE))
+        reply = await self.get_reply()
+        return reply[0] == 2
+
+    async def ensure_sound(self, content_hash, pin=False, unpin=False):
+        """
+        Asks the server (started with '--sound-cache') to have a sound loaded. If it isn't, the sound has to be sent
+        next in the same connection (the sound index of the metadata is replaced by the server).
+        :return: (sound index, True if the sound is already loaded), or None if the server replied with an error
+        """
+        self.send_data(build_ensure_frame(content_hash, pin, unpin))
+        reply = await self.get_reply()
+        if reply[0] != 2:
+            return None
+        slot = await self._reader.readexactly(5)
+        return int.from_bytes(slot[:4], byteorder='little'), slot[4] == 1
+
+    def _prepare_data_cmd(self, i):
+        # clean the remaining elements for the last packet which might be smaller than 32K
+        if i == self._protocol.commands_to_send - 1:
+            self._protocol.clean_data_cmd()
+
+        self._protocol.write_data_index(i)
+        self._protocol.write_data_block(i)
+        self._protocol.update_data_checksum()
 
-        # cycle through the sound data and send the packets to the server
-        for i in range(1, self._protocol.commands_to_send):
-            # clean the remaining elements for the last packet which might be smaller than 32K
-            if i == self._protocol.commands_to_send - 1:
-                self._protocol.clean_data_cmd()
+    async def send_sound(self):
+        packet_sending_timings = self.packet_sending_timings = []
+        self.retransmissions = 0
+        first_index, commands_to_send = self._protocol.first_data_cmd_index, self._protocol.commands_to_send
 
-            self._protocol.write_data_index(i)
-            self._protocol.write_data_block(i)
-            self._protocol.update_data_checksum()
+        if first_index < commands_to_send:
+            self._prepare_data_cmd(first_index)
 
+        # cycle through the sound data and send the packets to the server
+        for i in range(first_index, commands_to_send):
             start = time.time()
 
-            # write to socket
-            self.send_data(self._protocol.data_cmd)
+            # write to socket (the data command is copied, so it can be reused for the next packet)
+            data_cmd = bytes(self._protocol.data_cmd)
+            self._writer.write(data_cmd)
 
             # to guarantee that the buffer is not getting filled completely. It will continue immediately if there's still space in the buffer
             await self._writer.drain()
 
+            # read (or generate) the next block of the sound while the server handles this one
+            if i + 1 < commands_to_send:
+                self._prepare_data_cmd(i + 1)
+
             # receive ok
             reply = await self.get_reply()
 
+            # the server asks for the data command again when it arrives corrupted
+            while reply[2] == REPLY_RETRANSMIT:
+                data_index = int.from_bytes(await self._reader.readexactly(4), byteorder='little')
+                if data_index != i:
+                    return (True, "Error: WhileTransferringData")
+                self.retransmissions += 1
+                self._writer.write(data_cmd)
+                reply = await self.get_reply()
+
             packet_sending_timings.append(time.time() - start)
 
             # gets the timestamp as per the Harp protocol
@@ -62,3 +125,14 @@ class Communication:
 
     async def get_final_reply(self):
         return await self._reader.readexactly(2)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    async def get_job_id(self):
+        """
+        When the server stages the uploads (started with '--spool-dir'), the final reply is followed by the id of the
+        job that will write the sound to the Sound Card.
+        """
+        return int.from_bytes(await self._reader.readexactly(4), byteorder='little')
@@ -0,0 +1,186 @@
+import os
+import argparse
+import asyncio
+import struct
+import time
+
+from .client import ClientResult
+from .protocol import Protocol
+
+
+# .harpframes file
+#   file header (16 bytes): magic, version, size of the header frame, number of data commands
+#   the header frame, followed by the data commands, exactly as they are sent to the server (checksums included)
+HARPFRAMES_MAGIC = b'HFRM'
+HARPFRAMES_VERSION = 1
+HARPFRAMES_HEADER = struct.Struct('<4sHII')
+HARPFRAMES_HEADER_SIZE = 16
+DATA_CMD_SIZE = 7 + 4 + 32768 + 1
+REPLY_SIZE = 12
+
+
+class HarpFrames(object):
+    """
+    Byte ranges of the frames in a .harpframes file.
+    """
+    def __init__(self, path, header_size, data_cmds):
+        self.path = path
+        self.header_size = header_size
+        self.data_cmds = data_cmds
+
+    @property
+    def header_offset(self):
+        return HARPFRAMES_HEADER_SIZE
+
+    @property
+    def data_offset(self):
+        return HARPFRAMES_HEADER_SIZE + self.header_size
+
+    @property
+    def data_size(self):
+        return self.data_cmds * DATA_CMD_SIZE
+
+    def get_data_cmd_range(self, position):
+        """
+        :return: (offset, size) of the data command at the given position in the file
+        """
+        return self.data_offset + position * DATA_CMD_SIZE, DATA_CMD_SIZE
+
+
+def write_harpframes(path, protocol):
+    """
+    Writes the frames of an upload to a .harpframes file, so that the sound can be uploaded many times without
+    framing it again.
+
+    :param path: Path of the file to write
+    :param protocol: Protocol with the header ready to be sent (metadata, file metadata, first data block and checksum
+        already added)
+    :return: The HarpFrames of the written file
+    """
+    data_cmds = protocol.commands_to_send - protocol.first_data_cmd_index
+    with open(path, 'wb') as f:
+        f.write(HARPFRAMES_HEADER.pack(HARPFRAMES_MAGIC, HARPFRAMES_VERSION, len(protocol.header), data_cmds).ljust(
+            HARPFRAMES_HEADER_SIZE, b'\0'))
+        f.write(protocol.header.tobytes())
+
+        for i in range(protocol.first_data_cmd_index, protocol.commands_to_send):
+            # clean the remaining elements for the last packet which might be smaller than 32K
+            if i == protocol.commands_to_send - 1:
+                protocol.clean_data_cmd()
+            protocol.write_data_index(i)
+            protocol.write_data_block(i)
+            protocol.update_data_checksum()
+            f.write(protocol.data_cmd.tobytes())
+
+    return HarpFrames(path, len(protocol.header), data_cmds)
+
+
+def read_harpframes(path):
+    """
+    :return: The HarpFrames of the file
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HARPFRAMES_HEADER.size)
+    if len(header) != HARPFRAMES_HEADER.size:
+        raise ValueError(f'{path} is not a .harpframes file')
+    magic, version, header_size, data_cmds = HARPFRAMES_HEADER.unpack(header)
+    if magic != HARPFRAMES_MAGIC or version != HARPFRAMES_VERSION:
+        raise ValueError(f'{path} is not a .harpframes file')
+
+    frames = HarpFrames(path, header_size, data_cmds)
+    if os.path.getsize(path) < frames.data_offset + frames.data_size:
+        raise ValueError(f'{path} is truncated')
+    return frames
+
+
+async def send_harpframes(path, address='localhost', port=9999):
+    """
+    Uploads a .harpframes file. The frames are sent straight from the file with 'loop.sendfile' (zero-copy where the
+    platform supports it): the header first and, after its reply, all the data commands in a single range. The replies
+    to the data commands are read after everything is sent.
+
+    :return: ClientResult
+    """
+    result = ClientResult()
+    frames = read_harpframes(path)
+    loop = asyncio.get_event_loop()
+    initial_time = time.time()
+
+    reader, writer = await asyncio.open_connection(address, port)
+    try:
+        with open(path, 'rb') as f:
+            await loop.sendfile(writer.transport, f, frames.header_offset, frames.header_size)
+            reply = await reader.readexactly(REPLY_SIZE)
+            result.time_to_first_reply = time.time() - initial_time
+            if reply[0] != 2:
+                result.error = 'Error: WhileSendingHeader'
+                return result
+
+            await loop.sendfile(writer.transport, f, frames.data_offset, frames.data_size)
+            result.bytes_sent = frames.header_size + frames.data_size
+
+        replies = await reader.readexactly(REPLY_SIZE * frames.data_cmds)
+        if any(replies[i] != 2 for i in range(0, len(replies), REPLY_SIZE)):
+            result.error = 'Error: WhileTransferringData'
+            return result
+
+        writer.write_eof()
+        if await reader.readexactly(2) == b'OK':
+            result.ok = True
+            result.total_time = time.time() - initial_time
+    except asyncio.IncompleteReadError:
+        result.error = 'Error: ConnectionClosed'
+    finally:
+        writer.close()
+    return result
+
+
+def frame_sound_file(sound_file, output, sound_index, sample_rate, data_type=0, with_data=True,
+                     with_file_metadata=True, source_sample_rate=None):
+    """
+    Frames a binary sound file (the samples as sent to the Sound Card) into a .harpframes file.
+    """
+    protocol = Protocol.from_file(sound_file)
+    protocol.prepare_header(with_data=with_data, with_file_metadata=with_file_metadata,
+                            source_sample_rate=source_sample_rate)
+    protocol.add_metadata([sound_index, protocol.sound_file_size_in_samples, sample_rate, data_type])
+    protocol.add_sound_filename(os.path.basename(sound_file))
+    protocol.add_filemetadata()
+    protocol.add_first_data_block()
+    protocol.update_header_checksum()
+    return write_harpframes(output, protocol)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pre-frames sounds into .harpframes files and uploads them')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    frame = commands.add_parser('frame', help='frame a binary sound file')
+    frame.add_argument('sound_file')
+    frame.add_argument('output')
+    frame.add_argument('--sound-index', type=int, required=True)
+    frame.add_argument('--sample-rate', type=int, default=96000, help='sample rate of the Sound Card')
+    frame.add_argument('--data-type', type=int, default=0)
+    frame.add_argument('--header', type=int, choices=[128, 129, 130], default=128,
+                       help='frame type of the header (default: 128)')
+    frame.add_argument('--source-sample-rate', type=int, default=None,
+                       help='sample rate of the sound file, if the server has to convert it')
+
+    send = commands.add_parser('send', help='upload a .harpframes file')
+    send.add_argument('harpframes_file')
+    send.add_argument('--address', default='localhost')
+    send.add_argument('--port', type=int, default=9999)
+    args = parser.parse_args()
+
+    if args.command == 'frame':
+        frames = frame_sound_file(args.sound_file, args.output, args.sound_index, args.sample_rate, args.data_type,
+                                  with_data=args.header == 128, with_file_metadata=args.header != 130,
+                                  source_sample_rate=args.source_sample_rate)
+        print(f'{args.output}: header of {frames.header_size} bytes and {frames.data_cmds} data commands')
+    else:
+        result = asyncio.get_event_loop().run_until_complete(send_harpframes(args.harpframes_file, args.address,
+                                                                             args.port))
+        if result.ok:
+            print(f'Elapsed time: {int(round(result.total_time * 1000))} ms')
+        else:
+            print(result.error)
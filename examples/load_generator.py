@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import random
+import time
+
+from .client import tcp_send_sound_client
+from .communication import Communication
+from .report import format_bandwidth, format_latencies
+
+
+# frame type of the first command: (with_data, with_file_metadata)
+FRAME_TYPES = {
+    128: (True, True),
+    129: (False, True),
+    130: (False, False),
+}
+
+
+class ClientStats:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.uploads = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.busy_time = 0.0
+        self.time_to_first_reply = []
+        self.chunk_latencies = []
+
+
+class LoadConfiguration:
+    def __init__(self,
+                 clients=4,
+                 uploads_per_client=None,
+                 run_duration=None,
+                 ramp='none',
+                 ramp_time=0.0,
+                 ramp_steps=4,
+                 sound_indexes=(2, 31),
+                 durations=(0.5, 4.0),
+                 sample_rates=(96000, 192000),
+                 frame_types=(128, 129, 130),
+                 retry_delay=0.5,
+                 seed=None):
+        """
+
+        :param clients: (Optional) Number of concurrent clients
+        :param uploads_per_client: (Optional) Number of uploads done by each client (count-based run)
+        :param run_duration: (Optional) Duration of the run in seconds (duration-based run). No new uploads are started
+            after this time. If neither this nor 'uploads_per_client' are given, each client does a single upload
+        :param ramp: (Optional) How the clients are started: 'none' (all at once), 'linear' (evenly spread over
+            'ramp_time') or 'step' (in 'ramp_steps' groups spread over 'ramp_time')
+        :param ramp_time: (Optional) Duration of the ramp-up in seconds
+        :param ramp_steps: (Optional) Number of groups of clients for the 'step' ramp-up
+        :param sound_indexes: (Optional) Range (inclusive) of sound indexes used
+        :param durations: (Optional) Range of the sound durations in seconds
+        :param sample_rates: (Optional) Sample rates used
+        :param frame_types: (Optional) Frame types of the first command used (128, 129 or 130)
+        :param retry_delay: (Optional) Seconds a client waits before trying again when it can't connect to the server,
+            doubled on each consecutive failure (up to 16 times)
+        :param seed: (Optional) Seed for the random choices, to repeat a run
+        """
+        self.clients = clients
+        self.uploads_per_client = uploads_per_client
+        self.run_duration = run_duration
+        self.ramp = ramp
+        self.ramp_time = ramp_time
+        self.ramp_steps = ramp_steps
+        self.sound_indexes = sound_indexes
+        self.durations = durations
+        self.sample_rates = sample_rates
+        self.frame_types = frame_types
+        self.retry_delay = retry_delay
+        self.seed = seed
+
+    def get_start_delay(self, client_id):
+        """
+        :return: Delay in seconds before the client with the given id (from 0) starts, according to the ramp-up
+        """
+        if self.ramp == 'linear' and self.clients > 1:
+            return self.ramp_time * client_id / (self.clients - 1)
+        if self.ramp == 'step' and self.ramp_steps > 1:
+            step = client_id * self.ramp_steps // self.clients
+            return self.ramp_time * step / (self.ramp_steps - 1)
+        return 0.0
+
+
+async def run_client(loop, client_id, config, stats, rng, address, port, end_time):
+    await asyncio.sleep(config.get_start_delay(client_id))
+
+    uploads = 0
+    connection_errors = 0
+    while True:
+        if config.uploads_per_client is not None and uploads >= config.uploads_per_client:
+            break
+        if end_time is not None and time.time() >= end_time:
+            break
+        if config.uploads_per_client is None and end_time is None and uploads > 0:
+            break
+        uploads += 1
+
+        with_data, with_file_metadata = FRAME_TYPES[rng.choice(config.frame_types)]
+        start = time.time()
+        try:
+            result = await tcp_send_sound_client(loop,
+                                                 sound_index=rng.randint(*config.sound_indexes),
+                                                 duration=rng.uniform(*config.durations),
+                                                 sample_rate=rng.choice(config.sample_rates),
+                                                 with_data=with_data,
+                                                 with_file_metadata=with_file_metadata,
+                                                 address=address,
+                                                 port=port,
+                                                 verbose=False)
+        except (OSError, asyncio.IncompleteReadError):
+            stats.errors += 1
+            # back off instead of building a new sound and trying again right away (e.g. connection refused)
+            await asyncio.sleep(config.retry_delay * 2 ** min(connection_errors, 4))
+            connection_errors += 1
+            continue
+        connection_errors = 0
+
+        stats.busy_time += time.time() - start
+        stats.bytes_sent += result.bytes_sent
+        stats.chunk_latencies.extend(result.packet_sending_timings)
+        if result.time_to_first_reply is not None:
+            stats.time_to_first_reply.append(result.time_to_first_reply)
+        if result.ok:
+            stats.uploads += 1
+        else:
+            stats.errors += 1
+
+
+async def run_load(loop, config, address='localhost', port=9999):
+    """
+    Runs the concurrent clients according to the configuration.
+    :return: (list of ClientStats, total time of the run in seconds, status of the server at the end of the run)
+    """
+    rng = random.Random(config.seed)
+    start = time.time()
+    end_time = start + config.run_duration if config.run_duration is not None else None
+
+    all_stats = [ClientStats(i) for i in range(config.clients)]
+    await asyncio.gather(*[run_client(loop, i, config, all_stats[i], random.Random(rng.random()), address, port,
+                                      end_time)
+                           for i in range(config.clients)])
+    total_time = time.time() - start
+
+    # the server keeps the time each upload waited for the Sound Card
+    comm = Communication(None, loop, address, port)
+    try:
+        await comm.open()
+        status = await comm.get_status()
+        comm.close()
+    except (OSError, asyncio.IncompleteReadError):
+        status = None
+
+    return all_stats, total_time, status
+
+
+def print_report(all_stats, total_time, status):
+    print('client  uploads  errors  throughput      time to first reply                 chunk latency')
+    for stats in all_stats:
+        print(f'{stats.client_id:6d}  {stats.uploads:7d}  {stats.errors:6d}  '
+              f'{format_bandwidth(stats.bytes_sent, stats.busy_time):>14}  '
+              f'{format_latencies(stats.time_to_first_reply):34}  {format_latencies(stats.chunk_latencies)}')
+
+    uploads = sum(s.uploads for s in all_stats)
+    errors = sum(s.errors for s in all_stats)
+    bytes_sent = sum(s.bytes_sent for s in all_stats)
+    print()
+    print(f'Total: {uploads} uploads, {errors} errors, {bytes_sent} bytes in {int(round(total_time * 1000))} ms')
+    print(f'Aggregate throughput: {format_bandwidth(bytes_sent, total_time)}')
+    print(f'Time to first reply: {format_latencies([t for s in all_stats for t in s.time_to_first_reply])}')
+    print(f'Chunk latency: {format_latencies([t for s in all_stats for t in s.chunk_latencies])}')
+
+    queue_wait = (status or {}).get('metrics', {}).get('queue_wait_ms')
+    if queue_wait:
+        print(f'Server queue wait: p50={queue_wait["p50"]:.1f}ms p95={queue_wait["p95"]:.1f}ms '
+              f'p99={queue_wait["p99"]:.1f}ms')
+
+
+def parse_range(value, convert=float):
+    parts = [convert(v) for v in value.split('-')]
+    return (parts[0], parts[-1])
+
+
+def parse_list(value):
+    return tuple(int(v) for v in value.split(','))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Concurrent load generator for the Sound Card TCP server')
+    parser.add_argument('--address', default='localhost')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--clients', type=int, default=4, help='number of concurrent clients')
+    run = parser.add_mutually_exclusive_group()
+    run.add_argument('--count', type=int, default=None, help='number of uploads per client')
+    run.add_argument('--duration', type=float, default=None, help='duration of the run in seconds')
+    parser.add_argument('--ramp', choices=['none', 'linear', 'step'], default='none', help='ramp-up profile')
+    parser.add_argument('--ramp-time', type=float, default=0.0, help='duration of the ramp-up in seconds')
+    parser.add_argument('--ramp-steps', type=int, default=4, help='number of steps of the step ramp-up')
+    parser.add_argument('--sound-indexes', default='2-31', help='range of sound indexes, e.g. 2-31')
+    parser.add_argument('--sound-durations', default='0.5-4', help='range of sound durations in seconds, e.g. 0.5-4')
+    parser.add_argument('--sample-rates', default='96000,192000', help='comma separated sample rates')
+    parser.add_argument('--frame-types', default='128,129,130', help='comma separated frame types of the header')
+    parser.add_argument('--retry-delay', type=float, default=0.5,
+                        help='seconds a client waits before trying again after a connection error (default: 0.5)')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = LoadConfiguration(clients=args.clients,
+                               uploads_per_client=args.count,
+                               run_duration=args.duration,
+                               ramp=args.ramp,
+                               ramp_time=args.ramp_time,
+                               ramp_steps=args.ramp_steps,
+                               sound_indexes=parse_range(args.sound_indexes, int),
+                               durations=parse_range(args.sound_durations),
+                               sample_rates=parse_list(args.sample_rates),
+                               frame_types=parse_list(args.frame_types),
+                               retry_delay=args.retry_delay,
+                               seed=args.seed)
+
+    loop = asyncio.get_event_loop()
+    print_report(*loop.run_until_complete(run_load(loop, config, args.address, args.port)))
+    loop.close()
@@ -1,29 +1,190 @@
+import os
+import hashlib
 import numpy as np
 
 
+CONTROL_STATUS = 0
+CONTROL_PROFILE = 1
+
+ENSURE_PIN = 1
+ENSURE_UNPIN = 2
+
+# address of the reply asking for a corrupted data command again, followed by its dataIndex (4 bytes, little endian)
+REPLY_RETRANSMIT = 135
+
+DATA_BLOCK_SIZE = 32768
+
+
+def build_control_frame(command):
+    """
+    Builds a control frame for the server. Control frames are answered even while an upload is in progress.
+
+    :param command: The control command (CONTROL_STATUS to get the status of the server and the sound card,
+        CONTROL_PROFILE to profile the next uploads on the server)
+    :return: The control frame as bytes
+    """
+    frame = bytearray([1, 5, 131, 255, 1, command])
+    frame.append(sum(frame) & 0xFF)
+    return bytes(frame)
+
+
+def build_ensure_frame(content_hash, pin=False, unpin=False):
+    """
+    Builds an ensure frame, that asks the server (started with '--sound-cache') to have a sound loaded in the Sound
+    Card. The reply is followed by the sound index (4 bytes, little endian) and 1 byte that is 1 if the sound is
+    already loaded; if it isn't, the upload of the sound has to follow in the same connection.
+
+    :param content_hash: The 32 bytes that identify the sound (see 'get_sound_hash')
+    :param pin: (Optional) If True, the sound is never evicted from the Sound Card by the server
+    :param unpin: (Optional) If True, the sound can be evicted again
+    :return: The ensure frame as bytes
+    """
+    if len(content_hash) != 32:
+        raise ValueError('The content hash has to have 32 bytes')
+    flags = (ENSURE_PIN if pin else 0) | (ENSURE_UNPIN if unpin else 0)
+    frame = bytearray([2, 40, 134, 255, 1]) + bytes(content_hash) + flags.to_bytes(4, byteorder='little')
+    frame.append(sum(frame) & 0xFF)
+    return bytes(frame)
+
+
+def get_sound_hash(wave_int, sample_rate, data_type=0, source_sample_rate=None):
+    """
+    Hash (SHA-256) of the content of a sound, with the metadata that changes how it is played.
+
+    :param wave_int: The complete sound (an array or a memory-mapped file)
+    :param sample_rate: Sample rate of the Sound Card
+    :param data_type: (Optional) Data type of the samples
+    :param source_sample_rate: (Optional) Sample rate of the data, if the server converts it
+    """
+    wave_int8 = _as_int8(wave_int)
+    content_hash = hashlib.sha256()
+    content_hash.update(np.array([len(wave_int8) // 4, sample_rate, data_type, source_sample_rate or 0],
+                                 dtype=np.int32).tobytes())
+    for start in range(0, len(wave_int8), DATA_BLOCK_SIZE):
+        content_hash.update(wave_int8[start: start + DATA_BLOCK_SIZE])
+    return content_hash.digest()
+
+
+def _as_int8(block):
+    if isinstance(block, np.ndarray):
+        return np.ascontiguousarray(block).reshape(-1).view(np.int8)
+    return np.frombuffer(block, dtype=np.int8)
+
+
+class ArraySource(object):
+    """
+    Sound data from an array (or a memory-mapped file) with the complete sound.
+    """
+    def __init__(self, wave_int):
+        self.wave_int8 = _as_int8(wave_int)
+        self.total_samples = len(self.wave_int8) // 4
+
+    def read_block(self, index):
+        """
+        :return: The block of data with the given index (the last one might be smaller than 32768 bytes)
+        """
+        return self.wave_int8[index * DATA_BLOCK_SIZE: (index + 1) * DATA_BLOCK_SIZE]
+
+
+class IteratorSource(object):
+    """
+    Sound data from an iterator of blocks of samples of any size (numpy arrays or bytes-like objects), e.g. read from
+    a file or generated on the fly. The blocks are only requested when they are needed, so they have to be read in
+    order.
+    """
+    def __init__(self, blocks, total_samples):
+        """
+        :param blocks: Iterable with the blocks of samples
+        :param total_samples: Number of samples (of all channels) of the complete sound, which has to be declared in
+            the header before the data is sent. Data after this size is ignored.
+        """
+        self.total_samples = total_samples
+        self._blocks = iter(blocks)
+        self._buffer = np.zeros(DATA_BLOCK_SIZE, dtype=np.int8)
+        self._pending = np.zeros(0, dtype=np.int8)
+        self._next_index = 0
+
+    def read_block(self, index):
+        """
+        :return: The block of data with the given index (the last one might be smaller than 32768 bytes)
+        """
+        if index != self._next_index:
+            raise ValueError(f'Block {index} requested, but the next block of the iterator is {self._next_index}')
+        self._next_index += 1
+
+        size = min(DATA_BLOCK_SIZE, self.total_samples * 4 - index * DATA_BLOCK_SIZE)
+        filled = 0
+        while filled < size:
+            if len(self._pending) == 0:
+                try:
+                    self._pending = _as_int8(next(self._blocks))
+                except StopIteration:
+                    raise ValueError(f'The sound has less than the {self.total_samples} samples declared') from None
+            n = min(size - filled, len(self._pending))
+            self._buffer[filled: filled + n] = self._pending[:n]
+            self._pending = self._pending[n:]
+            filled += n
+        return self._buffer[:size]
+
+
 class Protocol(object):
     """
     Harp Protocol implementation for the Sound Card.
     For more details, please check the Harp Protocol for the Sound Card commands in:
     https://bitbucket.org/fchampalimaud/device.soundcard/src/master/TCP%20server%20protocol.txt
     """
-    def __init__(self, wave_int):
-        self.wave_int8 = wave_int.view(np.int8)
+    def __init__(self, wave_int=None, sound_source=None):
+        """
+        :param wave_int: The complete sound (use 'from_file' or 'from_iterator' to avoid having it in memory)
+        :param sound_source: (Optional) Object that gives the blocks of data of the sound ('read_block(index)') and
+            its size ('total_samples'), used instead of 'wave_int'
+        """
+        self.sound_source = sound_source if sound_source is not None else ArraySource(wave_int)
         self.int32_size = np.dtype(np.int32).itemsize
 
         # get number of commands to send
-        self.sound_file_size_in_samples = len(self.wave_int8) // 4
+        self.sound_file_size_in_samples = self.sound_source.total_samples
         self.commands_to_send = int(self.sound_file_size_in_samples * 4 // 32768 + (
             1 if ((self.sound_file_size_in_samples * 4) % 32768) != 0 else 0))
 
-    def prepare_header(self, with_data=True, with_file_metadata=True):
+    @classmethod
+    def from_file(cls, path, total_samples=None, offset=0):
+        """
+        Creates the Protocol for a sound in a binary file (the samples as sent to the Sound Card), which is
+        memory-mapped so that only the blocks being sent are read.
+
+        :param path: Path of the file
+        :param total_samples: (Optional) Number of samples to send. By default, all the samples after 'offset'
+        :param offset: (Optional) Position in bytes of the first sample in the file
+        """
+        if total_samples is None:
+            total_samples = (os.path.getsize(path) - offset) // 4
+        wave_int = np.memmap(path, dtype=np.int8, mode='r', offset=offset, shape=(total_samples * 4,))
+        return cls(sound_source=ArraySource(wave_int))
+
+    @classmethod
+    def from_iterator(cls, blocks, total_samples):
+        """
+        Creates the Protocol for a sound given as blocks of samples, which are only requested when they are sent.
+
+        :param blocks: Iterable with the blocks of samples (numpy arrays or bytes-like objects of any size)
+        :param total_samples: Number of samples (of all channels) of the complete sound
+        """
+        return cls(sound_source=IteratorSource(blocks, total_samples))
+
+    def prepare_header(self, with_data=True, with_file_metadata=True, source_sample_rate=None):
         """
         This method initializes the data containers with the appropriate dimensions according to the parameters passed.
         This results in the three different supported types of commands.
 
         :param with_data: If the first 32kb block of data is to be included in the first command message or not.
         :param with_file_metadata: If extra information regarding the sound is to be included.
+        :param source_sample_rate: (Optional) Sample rate of the sound data, when it is different from the sample rate
+            in the metadata. The server converts the data to the sample rate in the metadata while it is received, so
+            the first block of data is never included in the first command and the file metadata is always included.
         """
+        if source_sample_rate is not None:
+            with_data, with_file_metadata = False, True
         self._metadata_size = 16
         self._data_block_size = 32768
         self._file_metadata_size = 2048
@@ -31,11 +192,19 @@ class Protocol(object):
 
         self._metadata_index = 5 if with_file_metadata is False else 7
         self._preamble_size = self._metadata_index
+        self._with_data = with_data and with_file_metadata
 
         self._data_index = self._metadata_index + self._metadata_size
-        self._filemetadata_index = self._metadata_index + self._metadata_size + self._data_block_size
-
-        if with_file_metadata is True:
+        # the file metadata comes right after the metadata when the first block of data isn't in the header
+        self._filemetadata_index = self._data_index + (self._data_block_size if self._with_data else 0)
+
+        if source_sample_rate is not None:
+            # the source sample rate (4 bytes) comes between the metadata and the file metadata
+            self._filemetadata_index += self.int32_size
+            self.header = np.zeros(self._metadata_index + self._metadata_size + self.int32_size + self._file_metadata_size + checksum_size, dtype=np.int8)
+            self.header[:self._metadata_index] = [2, 255, int('0x18', 16), int('0x08', 16), 133, 255, 1]
+            self.header[self._data_index: self._data_index + self.int32_size] = np.array([source_sample_rate], dtype=np.int32).view(np.int8)
+        elif with_file_metadata is True:
             if with_data is True:
                 self.header = np.zeros(self._metadata_index + self._metadata_size + self._data_block_size + self._file_metadata_size + checksum_size, dtype=np.int8)
                 self.header[:self._metadata_index] = [2, 255, int('0x10', 16), int('0x88', 16), 128, 255, 1]
@@ -117,15 +286,23 @@ class Protocol(object):
             return
         self.header[self._filemetadata_index: self._filemetadata_index + self._file_metadata_size] = self.filemetadata
 
+    @property
+    def first_data_cmd_index(self):
+        """
+        Index of the first block of data that has to be sent in a data command (0 if the header doesn't include it)
+        """
+        return 1 if self._with_data else 0
+
     def add_first_data_block(self):
         """
         Adds the first block of data to the first command being sent to the server.
         .. note:: If when preparing the header the first command wasn't part of the first command, this method call
         won't do anything
         """
-        if self._metadata_index == 5:
+        if not self._with_data:
             return
-        self.header[self._data_index: self._data_index + self._data_block_size] = self.wave_int8[:self._data_block_size]
+        data_block = self.sound_source.read_block(0)
+        self.header[self._data_index: self._data_index + len(data_block)] = data_block
 
     def update_header_checksum(self):
         """
@@ -147,9 +324,8 @@ class Protocol(object):
         Writes data block to the data command message
         :param index: Index of the data block from the sound data container
         """
-        # write data from wave_int to cmd
-        wave_idx = index * 32768
-        data_block = self.wave_int8[wave_idx: wave_idx + 32768]
+        # write data from the sound to cmd
+        data_block = self.sound_source.read_block(index)
 
         self.data_cmd[self._data_cmd_data_block_index: self._data_cmd_data_block_index + len(data_block)] = data_block
 
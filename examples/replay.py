@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import collections
+import time
+
+from capture import read_capture
+from .protocol import REPLY_RETRANSMIT
+from .report import format_bandwidth, format_latencies
+
+
+class ReplayStats:
+    def __init__(self):
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.frame_latencies = []
+        self.first_reply_times = []
+        self.session_durations = []
+        self.errors = collections.Counter()
+        self.sessions_ok = 0
+        self.retransmissions = 0
+
+
+async def replay_session(session, address, port, speed, start_time, stats, timeout):
+    """
+    Replays the frames of a captured session, keeping the recorded timing (compressed by 'speed').
+    After each frame, the reply from the server is awaited, as the clients do.
+    """
+    if speed > 0:
+        await asyncio.sleep(max(0.0, start_time - time.perf_counter()))
+
+    session_start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        stats.errors['connection'] += 1
+        return
+
+    has_upload = False
+    first_reply = None
+    try:
+        for timestamp, frame in session.frames:
+            if speed > 0:
+                await asyncio.sleep(max(0.0, session_start + timestamp / speed - time.perf_counter()))
+
+            start = time.perf_counter()
+            writer.write(frame)
+            await writer.drain()
+            stats.bytes_sent += len(frame)
+            stats.frames_sent += 1
+
+            reply = await asyncio.wait_for(reader.readexactly(12), timeout)
+            now = time.perf_counter()
+            stats.frame_latencies.append(now - start)
+            if first_reply is None:
+                first_reply = now - session_start
+                stats.first_reply_times.append(first_reply)
+
+            # a corrupted data command is requested again (address 135) with its dataIndex (4 bytes). The command sent
+            # again by the client is the next frame captured
+            if reply[2] == REPLY_RETRANSMIT:
+                await asyncio.wait_for(reader.readexactly(4), timeout)
+                stats.retransmissions += 1
+                continue
+
+            if reply[0] != 2:
+                stats.errors['error_reply'] += 1
+
+            # control frames (address 131) are followed by the status length and content
+            if frame[2] == 131:
+                size = int.from_bytes(await asyncio.wait_for(reader.readexactly(4), timeout), byteorder='little')
+                await asyncio.wait_for(reader.readexactly(size), timeout)
+            # ensure frames (address 134) are followed by the sound index and 1 byte that is 1 if the sound is already
+            # loaded, in which case the server doesn't expect the upload captured after it
+            elif frame[2] == 134:
+                if reply[0] == 2:
+                    slot = await asyncio.wait_for(reader.readexactly(5), timeout)
+                    if slot[4] == 1:
+                        break
+            else:
+                has_upload = True
+
+        if has_upload:
+            writer.write_eof()
+            final = await asyncio.wait_for(reader.readexactly(2), timeout)
+            if final != b'OK':
+                stats.errors['final_reply'] += 1
+                return
+        stats.sessions_ok += 1
+    except asyncio.TimeoutError:
+        stats.errors['timeout'] += 1
+    except (OSError, asyncio.IncompleteReadError):
+        stats.errors['disconnected'] += 1
+    finally:
+        stats.session_durations.append(time.perf_counter() - session_start)
+        writer.close()
+
+
+async def replay(capture_path, address='localhost', port=9999, sessions=None, speed=1.0, keep_offsets=True,
+                 timeout=10.0):
+    """
+    Replays the sessions recorded by the server (started with '--capture') concurrently.
+
+    :param capture_path: The capture file
+    :param address: (Optional) Address of the server
+    :param port: (Optional) Port of the server
+    :param sessions: (Optional) Number of sessions to replay. If larger than the number of captured sessions, these
+        are repeated. Default: all the captured sessions
+    :param speed: (Optional) Time compression factor (2 replays twice as fast). With 0, the frames are sent as fast as
+        possible
+    :param keep_offsets: (Optional) Start the sessions with the same offsets as when they were captured, otherwise all
+        start at the same time
+    :param timeout: (Optional) Timeout for each reply, in seconds
+    :return: The ReplayStats of the run
+    """
+    captured = read_capture(capture_path)
+    if not captured:
+        raise ValueError(f'No sessions found in {capture_path}')
+
+    count = sessions if sessions is not None else len(captured)
+    first_start = captured[0].start
+    stats = ReplayStats()
+
+    start = time.perf_counter()
+    tasks = []
+    for i in range(count):
+        session = captured[i % len(captured)]
+        offset = (session.start - first_start) / speed if (keep_offsets and speed > 0) else 0.0
+        tasks.append(replay_session(session, address, port, speed, start + offset, stats, timeout))
+    await asyncio.gather(*tasks)
+    stats.total_time = time.perf_counter() - start
+    return stats
+
+
+def print_stats(stats):
+    print(f'Sessions: {stats.sessions_ok} ok of {len(stats.session_durations)}')
+    print(f'Frames sent: {stats.frames_sent} ({stats.bytes_sent} bytes) in {int(round(stats.total_time * 1000))} ms')
+    print(f'Throughput: {format_bandwidth(stats.bytes_sent, stats.total_time)}')
+    print(f'Frame latency: {format_latencies(stats.frame_latencies)}')
+    print(f'Time to first reply: {format_latencies(stats.first_reply_times)}')
+    print(f'Session duration: {format_latencies(stats.session_durations)}')
+    print(f'Retransmissions: {stats.retransmissions}')
+    print(f'Errors: {dict(stats.errors) if stats.errors else "none"}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replays sessions captured by the Sound Card TCP server')
+    parser.add_argument('capture', help='capture file recorded by the server with --capture')
+    parser.add_argument('--address', default='localhost')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--sessions', type=int, default=None, help='number of sessions to replay (default: all)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='time compression factor, 0 to send as fast as possible (default: 1)')
+    parser.add_argument('--no-offsets', action='store_true', help='start all the sessions at the same time')
+    parser.add_argument('--timeout', type=float, default=10.0, help='timeout for each reply in seconds')
+    args = parser.parse_args()
+
+    stats = asyncio.get_event_loop().run_until_complete(
+        replay(args.capture, args.address, args.port, args.sessions, args.speed, not args.no_offsets, args.timeout))
+    print_stats(stats)
@@ -0,0 +1,32 @@
+import numpy as np
+
+
+def get_percentiles(values, percentiles=(50, 95, 99)):
+    """
+    :param values: List of values (e.g., latencies in seconds)
+    :param percentiles: (Optional) Percentiles to calculate
+    :return: Dictionary with the percentiles, e.g. {'p50': ..., 'p95': ..., 'p99': ...}, with None if there are no values
+    """
+    if len(values) == 0:
+        return {f'p{p}': None for p in percentiles}
+    result = np.percentile(np.asarray(values, dtype=np.float64), percentiles)
+    return {f'p{p}': float(r) for p, r in zip(percentiles, result)}
+
+
+def format_latencies(values, unit=1000.0, suffix='ms'):
+    """
+    :return: String with the p50/p95/p99 of the values, converted with 'unit' (seconds to ms by default)
+    """
+    res = get_percentiles(values)
+    if res['p50'] is None:
+        return 'n/a'
+    return ' '.join(f'{name}={value * unit:.1f}{suffix}' for name, value in res.items())
+
+
+def format_bandwidth(size, total_time):
+    """
+    :return: String with the bandwidth in Mbit/s of 'size' bytes transferred in 'total_time' seconds
+    """
+    if total_time <= 0:
+        return 'n/a'
+    return f'{((size / total_time) * 8) / 2**20:.1f} Mbit/s'
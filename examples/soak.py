@@ -0,0 +1,666 @@
+import argparse
+import array
+import asyncio
+import collections
+import errno
+import json
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+import numpy as np
+
+from device import SoundCardDevice
+from health import DeviceWatchdog
+from ingest import SessionDeadlines
+from server import SoundCardTCPServer
+from .communication import Communication
+from .protocol import Protocol
+from .report import format_bandwidth, format_latencies
+
+
+FAULT_WRITE_TIMEOUT = 'write_timeout'
+FAULT_READ_TIMEOUT = 'read_timeout'
+FAULT_VALUE_MISMATCH = 'value_mismatch'
+FAULT_DISCONNECT = 'disconnect'
+FAULT_CORRUPTED_CHUNK = 'corrupted_chunk'
+FAULT_CLIENT_DROP = 'client_drop'
+FAULTS = (FAULT_WRITE_TIMEOUT, FAULT_READ_TIMEOUT, FAULT_VALUE_MISMATCH, FAULT_DISCONNECT, FAULT_CORRUPTED_CHUNK,
+          FAULT_CLIENT_DROP)
+
+DATA_BLOCK_SIZE = 32768
+DATA_CMD_SIZE = 7 + 4 + DATA_BLOCK_SIZE + 1
+
+
+class FaultRates:
+    def __init__(self,
+                 write_timeout=0.0,
+                 read_timeout=0.0,
+                 value_mismatch=0.0,
+                 disconnect=0.0,
+                 disconnect_duration=2.0,
+                 corrupted_chunk=0.0,
+                 client_drop=0.0):
+        """
+        Probabilities of the faults injected during the soak.
+
+        :param write_timeout: (Optional) Probability of a USB write timing out, per command written to the device
+        :param read_timeout: (Optional) Probability of the reply of the device not arriving, per command
+        :param value_mismatch: (Optional) Probability of the reply having a wrong random value, per command
+        :param disconnect: (Optional) Probability of the device disappearing, per command
+        :param disconnect_duration: (Optional) Mean time in seconds the device is away after disappearing
+        :param corrupted_chunk: (Optional) Probability of a data command arriving corrupted to the server, per data
+            command sent by the clients
+        :param client_drop: (Optional) Probability of a client dropping the connection in the middle of an upload,
+            per upload
+        """
+        self.write_timeout = write_timeout
+        self.read_timeout = read_timeout
+        self.value_mismatch = value_mismatch
+        self.disconnect = disconnect
+        self.disconnect_duration = disconnect_duration
+        self.corrupted_chunk = corrupted_chunk
+        self.client_drop = client_drop
+
+
+class SoakConfiguration:
+    def __init__(self,
+                 clients=2,
+                 run_duration=60.0,
+                 sound_durations=(0.5, 2.0),
+                 first_sound_index=2,
+                 pause=0.0,
+                 upload_timeout=120.0,
+                 usb_mbps=80.0,
+                 write_timeout=100,
+                 ack_timeout=400,
+                 report_interval=10.0,
+                 seed=None):
+        """
+
+        :param clients: (Optional) Number of concurrent clients, each one uploading to its own sound index
+        :param run_duration: (Optional) Duration of the soak in seconds. No new uploads are started after this time
+        :param sound_durations: (Optional) Range of the sound durations in seconds
+        :param first_sound_index: (Optional) Sound index of the first client (the next ones use the following indexes)
+        :param pause: (Optional) Pause in seconds between the uploads of each client
+        :param upload_timeout: (Optional) Time in seconds after which an upload is given up
+        :param usb_mbps: (Optional) Speed of the stand-in device in Mbit/s
+        :param write_timeout: (Optional) Timeout (in ms) of the USB writes, which a write timeout fault waits for
+        :param ack_timeout: (Optional) Timeout (in ms) of the acknowledges, which a read timeout fault waits for (the
+            one of the metadata command is 2.5 times longer)
+        :param report_interval: (Optional) Interval in seconds between the samples of throughput and memory
+        :param seed: (Optional) Seed for the random choices, to repeat a run
+        """
+        self.clients = clients
+        self.run_duration = run_duration
+        self.sound_durations = sound_durations
+        self.first_sound_index = first_sound_index
+        self.pause = pause
+        self.upload_timeout = upload_timeout
+        self.usb_mbps = usb_mbps
+        self.write_timeout = write_timeout
+        self.ack_timeout = ack_timeout
+        self.report_interval = report_interval
+        self.seed = seed
+
+
+class FaultLog:
+    """
+    The faults injected and the time the server took to recover from each one.
+
+    A device fault is recovered when the device acknowledges a command again, a corrupted chunk when its
+    retransmission is acknowledged and a client drop when the next upload of the client is accepted.
+    """
+    def __init__(self):
+        self.injected = collections.Counter()
+        self.recovery_times = collections.defaultdict(list)
+        self._pending_device_faults = []
+        self._lock = threading.Lock()
+
+    def inject(self, fault):
+        """
+        :return: Token to pass to 'recover'
+        """
+        with self._lock:
+            self.injected[fault] += 1
+        return fault, time.perf_counter()
+
+    def recover(self, token):
+        fault, start = token
+        with self._lock:
+            self.recovery_times[fault].append(time.perf_counter() - start)
+
+    def inject_device_fault(self, fault):
+        self._pending_device_faults.append(self.inject(fault))
+
+    def device_recovered(self):
+        # only called from the thread of the server, as 'inject_device_fault'
+        pending, self._pending_device_faults = self._pending_device_faults, []
+        for token in pending:
+            self.recover(token)
+
+    def as_dict(self):
+        with self._lock:
+            result = {}
+            for fault in FAULTS:
+                times = self.recovery_times[fault]
+                result[fault] = {
+                    'injected': self.injected[fault],
+                    'recovered': len(times),
+                    'max_ms': max(times) * 1000.0 if times else None,
+                    'recovery_ms': format_latencies(times),
+                }
+            return result
+
+
+class StandInCard:
+    """
+    Stand-in for the Sound Card behind the USB connection. It keeps the checksum of each block of data written to each
+    sound index (a data command goes to the sound of the last metadata command) and injects the device faults.
+    """
+    def __init__(self, rates, faults, usb_mbps=80.0, seed=None):
+        self.rates = rates
+        self.faults = faults
+        self.usb_mbps = usb_mbps
+        self.duplicate_writes = 0
+        self._rng = random.Random(seed)
+        self._sounds = {}
+        self._sound_index = None
+        self._last = None
+        self._away_until = 0.0
+        self._lock = threading.Lock()
+
+    def is_connected(self):
+        return time.perf_counter() >= self._away_until
+
+    def get_sound(self, index):
+        """
+        :return: Dictionary with the checksum of each block of data of the sound, by dataIndex
+        """
+        with self._lock:
+            return dict(self._sounds.get(index, {}))
+
+    def _fails(self, fault):
+        return self._rng.random() < getattr(self.rates, fault)
+
+    def write(self, endpoint, data, timeout):
+        import usb.core
+
+        if not self.is_connected():
+            raise usb.core.USBError('No such device (it may have been disconnected)')
+
+        # only the metadata and data commands fail, not the reset command
+        if len(data) > 5:
+            if self._fails(FAULT_DISCONNECT):
+                self._away_until = time.perf_counter() + self._rng.uniform(0.5, 1.5) * self.rates.disconnect_duration
+                self.faults.inject_device_fault(FAULT_DISCONNECT)
+                raise usb.core.USBError('No such device (it may have been disconnected)')
+            if self._fails(FAULT_WRITE_TIMEOUT):
+                time.sleep(timeout / 1000.0)
+                self.faults.inject_device_fault(FAULT_WRITE_TIMEOUT)
+                raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+
+        time.sleep(len(data) * 8 / (self.usb_mbps * 2**20))
+        self._last = bytes(data)
+        return len(data)
+
+    def read(self, endpoint, buffer, timeout):
+        import usb.core
+
+        if not self.is_connected():
+            raise usb.core.USBError('No such device (it may have been disconnected)')
+
+        # the command reached the device, even if the reply is lost or corrupted
+        self._store(self._last)
+
+        if self._fails(FAULT_READ_TIMEOUT):
+            time.sleep(timeout / 1000.0)
+            self.faults.inject_device_fault(FAULT_READ_TIMEOUT)
+            raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+
+        rand_val = int.from_bytes(self._last[4:8], byteorder='little', signed=True)
+        if self._fails(FAULT_VALUE_MISMATCH):
+            self.faults.inject_device_fault(FAULT_VALUE_MISMATCH)
+            rand_val = rand_val + 1 if rand_val < 2**31 - 1 else 0
+        else:
+            self.faults.device_recovered()
+
+        buffer[:4] = array.array('b', [99, 109, 100, -127])
+        buffer[4:8] = array.array('b', rand_val.to_bytes(4, byteorder='little', signed=True))
+        buffer[8:12] = array.array('b', [0, 0, 0, 0])
+        return 12
+
+    def _store(self, command):
+        with self._lock:
+            if command[3] == 0x80:
+                # metadata command: 'cmd' 0x80 + random + metadata (starting with the sound index) + first block
+                self._sound_index = int.from_bytes(command[8:12], byteorder='little', signed=True)
+                self._sounds[self._sound_index] = {0: zlib.crc32(command[24: 24 + DATA_BLOCK_SIZE])}
+            elif command[3] == 0x81 and self._sound_index is not None:
+                sound = self._sounds[self._sound_index]
+                data_index = int.from_bytes(command[8:12], byteorder='little')
+                if data_index in sound:
+                    self.duplicate_writes += 1
+                sound[data_index] = zlib.crc32(command[12: 12 + DATA_BLOCK_SIZE])
+
+
+class StandInDevice(SoundCardDevice):
+    """
+    SoundCardDevice connected to a StandInCard instead of the USB device.
+    """
+    def __init__(self, card, watchdog=None):
+        super().__init__(watchdog)
+        self.card = card
+
+    def open(self):
+        if not self.card.is_connected():
+            return False
+        self._dev = self.card
+        self.conn_open = True
+        return True
+
+    def close(self):
+        self.conn_open = False
+
+
+class ServerThread:
+    """
+    Runs the server, with a stand-in device, in its own thread and event loop, so that the USB calls of the server
+    (and the recovery of the device) block the server as they would, but not the clients.
+    """
+    def __init__(self, card, port, max_retransmissions=3, deadlines=None, watchdog=None):
+        self.server = SoundCardTCPServer('localhost', port, deadlines=deadlines,
+                                         max_retransmissions=max_retransmissions,
+                                         device_factory=lambda: StandInDevice(card, watchdog))
+        self._loop = asyncio.new_event_loop()
+        self._task = self._loop.create_task(self.server.start_server())
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._task.cancel)
+        self._thread.join(10)
+
+
+class ClientDropped(Exception):
+    pass
+
+
+class FaultyWriter:
+    """
+    Writer of a client that corrupts data commands and drops the connection, according to the fault rates.
+    """
+    def __init__(self, writer, client, drop_at):
+        self._writer = writer
+        self._client = client
+        self._drop_at = drop_at
+
+    def write(self, data):
+        if len(data) == DATA_CMD_SIZE:
+            if int.from_bytes(data[7:11], byteorder='little') == self._drop_at:
+                self._writer.transport.abort()
+                raise ClientDropped()
+            data = self._client.corrupt(data)
+        self._writer.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+class FaultyCommunication(Communication):
+    def __init__(self, client, protocol, address, port, drop_at=None):
+        super().__init__(protocol, None, address, port)
+        self._client = client
+        self._drop_at = drop_at
+
+    async def open(self):
+        await super().open()
+        self._writer = FaultyWriter(self._writer, self._client, self._drop_at)
+
+    async def get_reply(self):
+        reply = await super().get_reply()
+        if reply[0] == 2:
+            self._client.acknowledged()
+        return reply
+
+
+class SoakClient:
+    def __init__(self, client_id, sound_index, config, rates, faults, card, rng):
+        self.client_id = client_id
+        self.sound_index = sound_index
+        self.uploads = 0
+        self.errors = collections.Counter()
+        self.verified_chunks = 0
+        self.lost_chunks = 0
+        self.bytes_sent = 0
+        self.upload_times = []
+        # (time the upload finished, bytes of the sound) of the successful uploads
+        self.completed = []
+        self._config = config
+        self._rates = rates
+        self._faults = faults
+        self._card = card
+        self._rng = rng
+        self._corrupted = []
+        self._dropped = None
+
+    def corrupt(self, data_cmd):
+        if self._rng.random() >= self._rates.corrupted_chunk:
+            return data_cmd
+        self._corrupted.append(self._faults.inject(FAULT_CORRUPTED_CHUNK))
+        corrupted = bytearray(data_cmd)
+        corrupted[self._rng.randrange(11, DATA_CMD_SIZE - 1)] ^= 0x5A
+        return corrupted
+
+    def acknowledged(self):
+        for token in self._corrupted:
+            self._faults.recover(token)
+        self._corrupted = []
+        if self._dropped is not None:
+            self._faults.recover(self._dropped)
+            self._dropped = None
+
+    def _create_sound(self):
+        duration = self._rng.uniform(*self._config.sound_durations)
+        samples = int(duration * 96000) * 2
+        wave_int = np.random.default_rng(self._rng.getrandbits(32)).integers(-2**31, 2**31, samples, dtype=np.int32)
+
+        # checksum of each block as sent (the last one is padded with zeros)
+        wave_int8 = wave_int.view(np.int8)
+        padded = np.zeros(-(-len(wave_int8) // DATA_BLOCK_SIZE) * DATA_BLOCK_SIZE, dtype=np.int8)
+        padded[:len(wave_int8)] = wave_int8
+        checksums = [zlib.crc32(padded[i: i + DATA_BLOCK_SIZE]) for i in range(0, len(padded), DATA_BLOCK_SIZE)]
+        return wave_int, checksums
+
+    async def run(self, address, port, end_time):
+        while time.perf_counter() < end_time:
+            try:
+                await asyncio.wait_for(self.upload(address, port), self._config.upload_timeout)
+            except asyncio.TimeoutError:
+                self.errors['timeout'] += 1
+            await asyncio.sleep(self._config.pause)
+
+    async def upload(self, address, port):
+        wave_int, checksums = self._create_sound()
+        protocol = Protocol(wave_int)
+        protocol.prepare_header()
+        protocol.add_metadata([self.sound_index, protocol.sound_file_size_in_samples, 96000, 0])
+        protocol.add_filemetadata()
+        protocol.add_first_data_block()
+        protocol.update_header_checksum()
+
+        drop_at = None
+        if protocol.commands_to_send > 1 and self._rng.random() < self._rates.client_drop:
+            drop_at = self._rng.randrange(1, protocol.commands_to_send)
+
+        comm = FaultyCommunication(self, protocol, address, port, drop_at)
+        start = time.perf_counter()
+        try:
+            await comm.open()
+            comm.send_header(protocol.header)
+            if (await comm.get_reply())[0] != 2:
+                self.errors['header'] += 1
+                return
+            has_error, _ = await comm.send_sound()
+            if has_error:
+                self.errors['data'] += 1
+                return
+            if await comm.get_final_reply() != b'OK':
+                self.errors['final_reply'] += 1
+                return
+        except ClientDropped:
+            self._dropped = self._faults.inject(FAULT_CLIENT_DROP)
+            self._corrupted = []
+            return
+        except (OSError, asyncio.IncompleteReadError):
+            self.errors['connection'] += 1
+            return
+        finally:
+            comm.close()
+
+        elapsed = time.perf_counter() - start
+        self.uploads += 1
+        self.bytes_sent += len(wave_int) * 4
+        self.upload_times.append(elapsed)
+        self.completed.append((time.perf_counter(), len(wave_int) * 4))
+        self._verify(checksums)
+
+    def _verify(self, checksums):
+        # the final reply is only sent once every command was written, so the sound is complete in the device
+        sound = self._card.get_sound(self.sound_index)
+        self.verified_chunks += len(checksums)
+        self.lost_chunks += sum(1 for i, checksum in enumerate(checksums) if sound.get(i) != checksum)
+
+
+def get_memory_usage():
+    """
+    :return: Memory used by the process in bytes (resident size where available, otherwise the peak), or None
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+def get_trend(samples):
+    """
+    :param samples: List of (time in seconds, value)
+    :return: Slope of the linear fit of the values, per hour (None if there are less than 3 samples)
+    """
+    if len(samples) < 3:
+        return None
+    times, values = zip(*samples)
+    return float(np.polyfit(np.asarray(times) / 3600.0, np.asarray(values, dtype=np.float64), 1)[0])
+
+
+async def wait_for_server(address, port, timeout=30.0):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        comm = Communication(None, None, address, port)
+        try:
+            await comm.open()
+            status = await comm.get_status()
+            if status is not None and status['device']['ready']:
+                return
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            comm.close()
+        await asyncio.sleep(0.1)
+    raise TimeoutError('The server did not start in time')
+
+
+async def run_soak(config, rates, port=9998, max_retransmissions=3, output=sys.stdout):
+    """
+    Runs the server with a stand-in device and the clients for the duration of the soak, injecting the faults.
+    :param output: (Optional) File where the progress is printed (None to print nothing)
+    :return: Dictionary with the results
+    """
+    rng = random.Random(config.seed)
+    faults = FaultLog()
+    card = StandInCard(rates, faults, config.usb_mbps, rng.random())
+    # the clients aren't evicted while the server recovers the device
+    watchdog = DeviceWatchdog(write_timeout=config.write_timeout, ack_timeout=config.ack_timeout,
+                              metadata_ack_timeout=int(config.ack_timeout * 2.5))
+    server = ServerThread(card, port, max_retransmissions, SessionDeadlines(chunk_gap=None, first_block=None),
+                          watchdog)
+    server.start()
+    try:
+        await wait_for_server('localhost', port)
+
+        start = time.perf_counter()
+        end_time = start + config.run_duration
+        clients = [SoakClient(i, config.first_sound_index + i, config, rates, faults, card, random.Random(rng.random()))
+                   for i in range(config.clients)]
+        tasks = [asyncio.ensure_future(client.run('localhost', port, end_time)) for client in clients]
+
+        memory = [(0.0, get_memory_usage())]
+        throughput = []
+        last_sample = start
+        pending = tasks
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=config.report_interval)
+            now = time.perf_counter()
+            memory.append((now - start, get_memory_usage()))
+            # the last window is usually cut short when the clients finish, and too short to be meaningful
+            if now - last_sample >= config.report_interval / 2 or not throughput:
+                size = sum(s for c in clients for t, s in c.completed if last_sample < t <= now)
+                throughput.append((now - start, (size * 8 / 2**20) / (now - last_sample)))
+                last_sample = now
+            if output is not None:
+                print(f'{int(now - start):6d}s  uploads={sum(c.uploads for c in clients)}  '
+                      f'errors={sum(sum(c.errors.values()) for c in clients)}  '
+                      f'faults={sum(faults.injected.values())}  throughput={throughput[-1][1]:.1f} Mbit/s  '
+                      f'memory={(memory[-1][1] or 0) / 2**20:.1f} MB', file=output, flush=True)
+        total_time = time.perf_counter() - start
+
+        comm = Communication(None, None, 'localhost', port)
+        await comm.open()
+        status = await comm.get_status()
+        comm.close()
+    finally:
+        server.stop()
+
+    # the first and last quarters of the run, to see if the throughput degrades over time
+    quarter = max(1, len(throughput) // 4)
+    memory_mb = [(t, m / 2**20) for t, m in memory if m is not None]
+    return {
+        'duration_s': total_time,
+        'uploads': sum(c.uploads for c in clients),
+        'errors': dict(sum((c.errors for c in clients), collections.Counter())),
+        'bytes_sent': sum(c.bytes_sent for c in clients),
+        'upload_time': format_latencies([t for c in clients for t in c.upload_times]),
+        'chunks_verified': sum(c.verified_chunks for c in clients),
+        'chunks_lost': sum(c.lost_chunks for c in clients),
+        'duplicate_writes': card.duplicate_writes,
+        'faults': faults.as_dict(),
+        'throughput_mbps': {
+            'mean': (sum(c.bytes_sent for c in clients) * 8 / 2**20) / total_time,
+            'first_quarter': float(np.mean([v for _, v in throughput[:quarter]])),
+            'last_quarter': float(np.mean([v for _, v in throughput[-quarter:]])),
+            'trend_per_hour': get_trend(throughput),
+        },
+        'memory_mb': {
+            'start': memory_mb[0][1] if memory_mb else None,
+            'end': memory_mb[-1][1] if memory_mb else None,
+            'max': max(m for _, m in memory_mb) if memory_mb else None,
+            'growth_per_hour': get_trend(memory_mb),
+        },
+        'server': (status or {}).get('metrics', {}),
+        'device': {'retries': (status or {}).get('device', {}).get('retries'),
+                   'health': (status or {}).get('device', {}).get('health', {}).get('state')},
+    }
+
+
+def print_report(results):
+    print()
+    print(f'{results["uploads"]} uploads in {int(round(results["duration_s"]))} s, errors: {results["errors"] or 0}')
+    print(f'Throughput: {format_bandwidth(results["bytes_sent"], results["duration_s"])}, first quarter '
+          f'{results["throughput_mbps"]["first_quarter"]:.1f} Mbit/s, last quarter '
+          f'{results["throughput_mbps"]["last_quarter"]:.1f} Mbit/s')
+    print(f'Upload time: {results["upload_time"]}')
+    print(f'Chunks verified: {results["chunks_verified"]}, lost: {results["chunks_lost"]}, '
+          f'written more than once: {results["duplicate_writes"]}')
+    memory = results['memory_mb']
+    if memory['start'] is not None:
+        growth = memory['growth_per_hour']
+        print(f'Memory: {memory["start"]:.1f} MB -> {memory["end"]:.1f} MB (max {memory["max"]:.1f} MB'
+              + (f', {growth:+.1f} MB/hour)' if growth is not None else ')'))
+    print()
+    print('fault              injected  recovered  recovery time')
+    for fault, stats in results['faults'].items():
+        print(f'{fault:17}  {stats["injected"]:8d}  {stats["recovered"]:9d}  {stats["recovery_ms"]}')
+    print()
+    print(f'Server: {results["server"]}')
+    print(f'Device: {results["device"]}')
+
+
+def parse_duration(value):
+    """
+    :return: The duration in seconds of a value like '90', '90s', '30m' or '12h'
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Soak test of the server with a stand-in Sound Card and fault '
+                                                 'injection')
+    parser.add_argument('--port', type=int, default=9998, help='port of the server started by the soak test')
+    parser.add_argument('--duration', default='1m', help='duration of the soak, e.g. 90s, 30m or 12h')
+    parser.add_argument('--clients', type=int, default=2, help='number of concurrent clients')
+    parser.add_argument('--sound-durations', default='0.5-2', help='range of sound durations in seconds, e.g. 0.5-2')
+    parser.add_argument('--pause', type=float, default=0.0, help='pause in seconds between uploads of each client')
+    parser.add_argument('--usb-mbps', type=float, default=80.0, help='speed of the stand-in device in Mbit/s')
+    parser.add_argument('--write-timeout', type=int, default=100, help='timeout in ms of the USB writes')
+    parser.add_argument('--ack-timeout', type=int, default=400, help='timeout in ms of the acknowledges')
+    parser.add_argument('--report-interval', type=float, default=10.0,
+                        help='seconds between the samples of throughput and memory')
+    parser.add_argument('--max-retransmissions', type=int, default=3)
+    parser.add_argument('--write-timeout-rate', type=float, default=0.001, help='per command written to the device')
+    parser.add_argument('--read-timeout-rate', type=float, default=0.001, help='per command written to the device')
+    parser.add_argument('--value-mismatch-rate', type=float, default=0.001, help='per command written to the device')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0002, help='per command written to the device')
+    parser.add_argument('--disconnect-duration', type=float, default=2.0,
+                        help='mean seconds the device is away after disconnecting')
+    parser.add_argument('--corrupt-rate', type=float, default=0.005, help='per data command sent by the clients')
+    parser.add_argument('--drop-rate', type=float, default=0.02, help='per upload')
+    parser.add_argument('--server-log', default=os.devnull, help='file for the output of the server')
+    parser.add_argument('--json', default=None, metavar='FILE', help='write the results to FILE')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = SoakConfiguration(clients=args.clients,
+                               run_duration=parse_duration(args.duration),
+                               sound_durations=tuple(float(v) for v in args.sound_durations.split('-')),
+                               pause=args.pause,
+                               usb_mbps=args.usb_mbps,
+                               write_timeout=args.write_timeout,
+                               ack_timeout=args.ack_timeout,
+                               report_interval=args.report_interval,
+                               seed=args.seed)
+    rates = FaultRates(write_timeout=args.write_timeout_rate,
+                       read_timeout=args.read_timeout_rate,
+                       value_mismatch=args.value_mismatch_rate,
+                       disconnect=args.disconnect_rate,
+                       disconnect_duration=args.disconnect_duration,
+                       corrupted_chunk=args.corrupt_rate,
+                       client_drop=args.drop_rate)
+
+    # the server prints (and shows progress bars) for every upload
+    output = sys.stdout
+    server_log = open(args.server_log, 'w')
+    sys.stdout = sys.stderr = server_log
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(run_soak(config, rates, args.port, args.max_retransmissions, output))
+    finally:
+        sys.stdout, sys.stderr = output, sys.__stderr__
+        server_log.close()
+        loop.close()
+
+    print_report(results)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
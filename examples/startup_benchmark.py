@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from .communication import Communication
+from .report import format_latencies
+
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+
+
+async def measure_cold_start(port, server_args, timeout=30.0):
+    """
+    Starts the server in a new process and measures the time until it accepts the first connection and answers a
+    status request.
+    :return: (time to first accept in seconds, status of the server)
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, SERVER_PATH, '--port', str(port)] + server_args,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError('The server did not start in time')
+            comm = Communication(None, None, 'localhost', port)
+            try:
+                await comm.open()
+            except OSError:
+                await asyncio.sleep(0.001)
+                continue
+            accepted = time.perf_counter() - start
+            status = await comm.get_status()
+            comm.close()
+            return accepted, status
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def run_benchmark(runs, port, server_args):
+    accept_times = []
+    listening_times = []
+    for _ in range(runs):
+        accepted, status = await measure_cold_start(port, server_args)
+        accept_times.append(accepted)
+        if status is not None:
+            listening_times.append(status['startup']['listening_s'])
+    return accept_times, listening_times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measures the cold start of the Sound Card TCP server, from starting '
+                                                 'the process until the first connection is accepted')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--port', type=int, default=9998)
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='arguments passed to the server (e.g. --event-loop uvloop)')
+    args = parser.parse_args()
+
+    accept_times, listening_times = asyncio.get_event_loop().run_until_complete(
+        run_benchmark(args.runs, args.port, args.server_args))
+    print(f'Cold start to first accept: {format_latencies(accept_times)}')
+    print(f'Listening after (measured by the server): {format_latencies(listening_times)}')
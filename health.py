@@ -0,0 +1,268 @@
+import collections
+import math
+import time
+import numpy as np
+
+
+HEALTH_OK = 'ok'
+HEALTH_DEGRADED = 'degraded'
+HEALTH_WEDGED = 'wedged'
+
+
+class LatencyTracker(object):
+    """
+    Keeps a sliding window of round trip latencies and derives a timeout from the observed distribution.
+
+    Until enough samples are collected, the default timeout is used.
+    """
+    def __init__(self, default_timeout, min_timeout=None, max_timeout=None, window=512, percentile=99.0,
+                 margin=3.0, min_samples=32):
+        """
+        :param default_timeout: Timeout (in ms) used while there are not enough samples
+        :param min_timeout: (Optional) Lower bound (in ms) for the learned timeout. Default: default_timeout / 4
+        :param max_timeout: (Optional) Upper bound (in ms) for the learned timeout. Default: default_timeout * 10
+        :param window: (Optional) Number of latency samples kept
+        :param percentile: (Optional) Percentile of the latency distribution used as reference
+        :param margin: (Optional) Multiplier applied to the reference percentile
+        :param min_samples: (Optional) Number of samples needed before the learned timeout is used
+        """
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout if min_timeout is not None else max(1, default_timeout // 4)
+        self.max_timeout = max_timeout if max_timeout is not None else default_timeout * 10
+        self.percentile = percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self._samples = collections.deque(maxlen=window)
+        # timeout (in ms) used after a call timed out, until enough new samples are collected
+        self._backoff = None
+        self._samples_since_backoff = 0
+
+    def add(self, latency):
+        """
+        Adds a latency sample
+        :param latency: Latency in seconds
+        """
+        self._samples.append(latency)
+        if self._backoff is not None:
+            self._samples_since_backoff += 1
+            if self._samples_since_backoff >= self.min_samples:
+                self._backoff = None
+
+    def back_off(self):
+        """
+        Doubles the timeout (up to the maximum) after a call timed out, as the latencies might have gone up since the
+        timeout was learned. It is learned again from the new samples.
+        """
+        self._backoff = min(self.max_timeout, 2 * self.timeout)
+        self._samples_since_backoff = 0
+
+    def clear(self):
+        self._samples.clear()
+        self._backoff = None
+
+    def get_percentile(self, percentile):
+        """
+        :return: The given percentile of the latencies in ms, or None if there are no samples yet
+        """
+        if not self._samples:
+            return None
+        return float(np.percentile(np.fromiter(self._samples, dtype=np.float64), percentile)) * 1000.0
+
+    @property
+    def timeout(self):
+        """
+        :return: The timeout in ms to use in the next USB call
+        """
+        if len(self._samples) < self.min_samples:
+            timeout = self.default_timeout
+        else:
+            learned = int(math.ceil(self.get_percentile(self.percentile) * self.margin))
+            timeout = max(self.min_timeout, min(self.max_timeout, learned))
+        return max(timeout, self._backoff) if self._backoff is not None else timeout
+
+    def as_dict(self):
+        return {
+            'timeout_ms': self.timeout,
+            'samples': len(self._samples),
+            'p50_ms': self.get_percentile(50),
+            'p99_ms': self.get_percentile(99),
+        }
+
+
+class DeviceWatchdog(object):
+    """
+    Monitors the health of the USB connection to the sound card.
+
+    The write and acknowledge round trips are timed to learn the timeouts to use for each device, and the throughput
+    of the data commands is followed to detect when the device starts to degrade. When the device looks wedged (several
+    consecutive failures or a throughput collapse) the server should restart or reset the connection.
+    """
+    def __init__(self, write_timeout=100, ack_timeout=400, metadata_ack_timeout=1000, degraded_ratio=0.5,
+                 wedged_ratio=0.1, wedged_failures=3, warmup_chunks=16, wedged_chunks=8):
+        """
+        :param write_timeout: (Optional) Default timeout (in ms) for the USB writes
+        :param ack_timeout: (Optional) Default timeout (in ms) for the data command acknowledge
+        :param metadata_ack_timeout: (Optional) Default timeout (in ms) for the metadata command acknowledge
+        :param degraded_ratio: (Optional) Fraction of the baseline throughput below which the device is degraded
+        :param wedged_ratio: (Optional) Fraction of the baseline throughput below which the device is wedged
+        :param wedged_failures: (Optional) Number of consecutive failures after which the device is wedged
+        :param warmup_chunks: (Optional) Number of data commands needed before the throughput baseline is trusted
+        :param wedged_chunks: (Optional) Number of consecutive data commands below the wedged throughput needed to
+            consider the device wedged, so that a short hiccup doesn't trigger a recovery
+        """
+        self.write = LatencyTracker(write_timeout)
+        self.ack = LatencyTracker(ack_timeout)
+        self.metadata_ack = LatencyTracker(metadata_ack_timeout, min_samples=4)
+
+        self.degraded_ratio = degraded_ratio
+        self.wedged_ratio = wedged_ratio
+        self.wedged_failures = wedged_failures
+        self.warmup_chunks = warmup_chunks
+        self.wedged_chunks = wedged_chunks
+
+        self.consecutive_failures = 0
+        self.failures = collections.Counter()
+        self.restarts = 0
+        self.resets = 0
+        self._recoveries_without_success = 0
+        # True when the last recovery was due to a throughput collapse rather than failures
+        self._throughput_recovery = False
+
+        self._chunks = 0
+        self._slow_chunks = 0
+        self._throughput_short = None
+        self._throughput_baseline = None
+        self._last_change = time.time()
+        self._state = HEALTH_OK
+
+    @property
+    def write_timeout(self):
+        return self.write.timeout
+
+    @property
+    def ack_timeout(self):
+        return self.ack.timeout
+
+    @property
+    def metadata_ack_timeout(self):
+        return self.metadata_ack.timeout
+
+    @property
+    def state(self):
+        return self._state
+
+    def record_write(self, elapsed):
+        self.write.add(elapsed)
+
+    def record_ack(self, elapsed, metadata=False):
+        (self.metadata_ack if metadata else self.ack).add(elapsed)
+
+    def record_success(self, nbytes=0, elapsed=0.0):
+        """
+        Registers a successful round trip to the device, updating the throughput trend.
+        :param nbytes: Number of bytes of sound data sent on the round trip
+        :param elapsed: Duration of the round trip in seconds
+        """
+        self.consecutive_failures = 0
+
+        data_chunk = bool(nbytes and elapsed > 0)
+        # a recovery only succeeded once the commands get through, and at the usual throughput again if it was
+        # collapsed, otherwise the next recovery is a reset
+        if not self._throughput_recovery:
+            self._recoveries_without_success = 0
+        elif data_chunk and nbytes / elapsed >= self.degraded_ratio * self._throughput_baseline:
+            self._recoveries_without_success = 0
+            self._throughput_recovery = False
+
+        if data_chunk:
+            throughput = nbytes / elapsed
+            self._chunks += 1
+            if self._throughput_short is None:
+                self._throughput_short = throughput
+                self._throughput_baseline = throughput
+            else:
+                self._throughput_short += 0.2 * (throughput - self._throughput_short)
+                # the baseline is the average of the warm up period and then only follows the trend slowly, so that a
+                # degradation doesn't become the new normal
+                weight = 1.0 / self._chunks if self._chunks <= self.warmup_chunks else 0.01
+                self._throughput_baseline += weight * (throughput - self._throughput_baseline)
+
+        self._update_state(data_chunk)
+
+    def record_failure(self, kind, timed_out=False, metadata=False):
+        """
+        Registers a failed round trip to the device.
+        :param kind: 'write', 'ack', 'value' or 'error'
+        :param timed_out: (Optional) True if the write or the acknowledge timed out, which widens its timeout
+        :param metadata: (Optional) True if the command was the metadata command
+        """
+        if timed_out and kind == 'write':
+            self.write.back_off()
+        elif timed_out and kind == 'ack':
+            (self.metadata_ack if metadata else self.ack).back_off()
+        self.failures[kind] += 1
+        self.consecutive_failures += 1
+        self._update_state()
+
+    def recovery_action(self):
+        """
+        :return: 'restart' or 'reset' when the device is wedged, None otherwise. A reset is only requested after a
+            restart didn't bring the device back.
+        """
+        if self._state != HEALTH_WEDGED:
+            return None
+        return 'restart' if self._recoveries_without_success == 0 else 'reset'
+
+    def record_recovery(self, action):
+        if action == 'reset':
+            self.resets += 1
+        else:
+            self.restarts += 1
+        self._recoveries_without_success += 1
+        self._throughput_recovery = self.consecutive_failures < self.wedged_failures
+        self.consecutive_failures = 0
+        self._slow_chunks = 0
+        # the connection is new, so previous latencies and throughput might not be representative anymore
+        self.write.clear()
+        self.ack.clear()
+        self.metadata_ack.clear()
+        self._throughput_short = self._throughput_baseline
+        self._update_state()
+
+    def _update_state(self, data_chunk=False):
+        """
+        :param data_chunk: (Optional) True when a data command was just acknowledged. Only data commands count towards
+            the consecutive slow chunks, not failures, recoveries or metadata commands
+        """
+        state = HEALTH_OK
+        if self.consecutive_failures >= self.wedged_failures:
+            state = HEALTH_WEDGED
+        elif self.consecutive_failures > 0:
+            state = HEALTH_DEGRADED
+        elif self._chunks >= self.warmup_chunks:
+            ratio = self._throughput_short / self._throughput_baseline
+            if data_chunk:
+                self._slow_chunks = self._slow_chunks + 1 if ratio < self.wedged_ratio else 0
+            if self._slow_chunks >= self.wedged_chunks:
+                state = HEALTH_WEDGED
+            elif ratio < self.degraded_ratio:
+                state = HEALTH_DEGRADED
+
+        if state != self._state:
+            self._state = state
+            self._last_change = time.time()
+
+    def as_dict(self):
+        return {
+            'state': self._state,
+            'since': self._last_change,
+            'consecutive_failures': self.consecutive_failures,
+            'failures': dict(self.failures),
+            'restarts': self.restarts,
+            'resets': self.resets,
+            'throughput_bps': self._throughput_short,
+            'baseline_throughput_bps': self._throughput_baseline,
+            'write': self.write.as_dict(),
+            'ack': self.ack.as_dict(),
+            'metadata_ack': self.metadata_ack.as_dict(),
+        }
@@ -0,0 +1,292 @@
+import asyncio
+import time
+import numpy as np
+
+
+PREAMBLE_SIZE = 7
+METADATA_SIZE = 16
+DATA_BLOCK_SIZE = 32768
+FILE_METADATA_SIZE = 2048
+SOURCE_RATE_SIZE = 4
+CONTENT_HASH_SIZE = 32
+# Data command: preamble (7 bytes) + dataIndex (4 bytes) + 32768 + checksum
+DATA_CMD_SIZE = PREAMBLE_SIZE + 4 + DATA_BLOCK_SIZE + 1
+DATA_CMD_INDEX = PREAMBLE_SIZE
+DATA_CMD_BLOCK_INDEX = DATA_CMD_INDEX + 4
+
+FRAME_HEADER_WITH_DATA = 128
+FRAME_HEADER = 129
+FRAME_HEADER_WITHOUT_FILE_METADATA = 130
+FRAME_CONTROL = 131
+FRAME_DATA = 132
+FRAME_HEADER_RESAMPLED = 133
+FRAME_ENSURE = 134
+# reply asking the client to send a corrupted data command again, followed by its dataIndex (4 bytes, little endian)
+REPLY_RETRANSMIT = 135
+
+# commands of the control frames
+CONTROL_STATUS = 0
+CONTROL_PROFILE = 1
+
+# Ensure frame: preamble (5 bytes) + content hash (32 bytes) + flags (4 bytes) + checksum
+ENSURE_FRAME_SIZE = 5 + CONTENT_HASH_SIZE + 4 + 1
+ENSURE_HASH_INDEX = 5
+ENSURE_FLAGS_INDEX = ENSURE_HASH_INDEX + CONTENT_HASH_SIZE
+ENSURE_PIN = 1
+ENSURE_UNPIN = 2
+
+STATE_PREAMBLE = 0
+STATE_HEADER = 1
+STATE_DATA = 2
+
+PHASE_HANDSHAKE = 'handshake'
+PHASE_FIRST_BLOCK = 'first_block'
+PHASE_CHUNK_GAP = 'chunk_gap'
+PHASE_THROUGHPUT = 'throughput'
+
+
+class HeaderLayout(object):
+    """
+    Layout of the first command of an upload.
+    """
+    def __init__(self, size, metadata_index, with_data, with_file_metadata, with_source_rate=False):
+        self.size = size
+        self.metadata_index = metadata_index
+        self.with_data = with_data
+        self.with_file_metadata = with_file_metadata
+        self.data_index = metadata_index + METADATA_SIZE
+        # the sample rate of the data sent by the client, when the server has to convert it to the card's sample rate
+        self.source_rate_index = self.data_index if with_source_rate else None
+        # the file metadata comes right after the metadata when the header doesn't include the first data block
+        self.file_metadata_index = self.data_index + (DATA_BLOCK_SIZE if with_data else 0) + \
+            (SOURCE_RATE_SIZE if with_source_rate else 0)
+
+
+HEADER_LAYOUTS = {
+    FRAME_HEADER_WITH_DATA: HeaderLayout(7 + METADATA_SIZE + DATA_BLOCK_SIZE + FILE_METADATA_SIZE + 1, 7, True, True),
+    FRAME_HEADER: HeaderLayout(7 + METADATA_SIZE + FILE_METADATA_SIZE + 1, 7, False, True),
+    FRAME_HEADER_WITHOUT_FILE_METADATA: HeaderLayout(5 + METADATA_SIZE + 1, 5, False, False),
+    FRAME_HEADER_RESAMPLED: HeaderLayout(7 + METADATA_SIZE + SOURCE_RATE_SIZE + FILE_METADATA_SIZE + 1, 7, False, True,
+                                         with_source_rate=True),
+}
+MAX_HEADER_SIZE = max(layout.size for layout in HEADER_LAYOUTS.values())
+
+# frames that aren't uploads but have more than the preamble, after which the client may start an upload
+REQUEST_SIZES = {
+    FRAME_ENSURE: ENSURE_FRAME_SIZE,
+}
+
+
+def get_frame_type(preamble):
+    """
+    :return: The address of the Harp message, which defines the type of frame
+    """
+    # messages longer than 254 bytes use 255 in the length byte followed by the length in 2 bytes, which moves the
+    # address from index 2 to index 4
+    return preamble[4] if preamble[1] == 255 else preamble[2]
+
+
+def calc_checksum(data):
+    return int(np.frombuffer(data, dtype=np.uint8).sum()) & 0xFF
+
+
+class Frame(object):
+    """
+    A complete frame received from the client. 'data' is a view on the receive buffer, only valid until the next
+    frame is requested.
+    """
+    __slots__ = ('frame_type', 'data', 'layout')
+
+    def __init__(self, frame_type, data, layout=None):
+        self.frame_type = frame_type
+        self.data = data
+        self.layout = layout
+
+    def is_valid(self):
+        return calc_checksum(self.data[:-1]) == self.data[-1]
+
+
+class SessionDeadlines(object):
+    """
+    Limits on how long a session waits for its client. None (or 0) disables a limit.
+    """
+    def __init__(self, handshake=10.0, first_block=10.0, chunk_gap=10.0, min_throughput=None, throughput_grace=5.0):
+        """
+        :param handshake: (Optional) Seconds to receive the first frame after the connection is made
+        :param first_block: (Optional) Seconds to receive the first data command after the header
+        :param chunk_gap: (Optional) Seconds to receive each of the next data commands
+        :param min_throughput: (Optional) Minimum throughput of the client in bytes per second, measured over the time
+            spent waiting for its data commands (the time the server spends writing to the device doesn't count)
+        :param throughput_grace: (Optional) Seconds waiting for data commands before the minimum throughput is checked
+        """
+        self.handshake = handshake or None
+        self.first_block = first_block or None
+        self.chunk_gap = chunk_gap or None
+        self.min_throughput = min_throughput or None
+        self.throughput_grace = throughput_grace
+
+    def get_timeout(self, phase):
+        return {PHASE_HANDSHAKE: self.handshake, PHASE_FIRST_BLOCK: self.first_block}.get(phase, self.chunk_gap)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the client of a session doesn't meet one of the SessionDeadlines.
+    """
+    def __init__(self, phase, frame_type=None):
+        super().__init__(f'Client exceeded the {phase} deadline')
+        self.phase = phase
+        # type of the frame that was expected (None if unknown)
+        self.frame_type = frame_type
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    Receives the frames of a session directly into preallocated buffers.
+
+    The parser goes through the preamble, header and data phases, asking the transport for exactly the bytes missing
+    in the current phase, so no intermediate objects are created. Reading is paused once a frame is complete, until
+    the session handler asks for the next one.
+    """
+    def __init__(self, session_handler, deadlines=None):
+        """
+        :param session_handler: Coroutine function called with (frame_protocol, transport) when the connection is made
+        :param deadlines: (Optional) SessionDeadlines enforced by 'read_frame'
+        """
+        self._session_handler = session_handler
+        self._deadlines = deadlines
+        self._header = bytearray(MAX_HEADER_SIZE)
+        self._data = bytearray(DATA_CMD_SIZE)
+
+        self._state = STATE_PREAMBLE
+        self._buffer = self._header
+        self._filled = 0
+        self._expected = PREAMBLE_SIZE
+
+        self._frame = None
+        self._delivered = False
+        self._waiter = None
+        self._eof = False
+        self._frames_delivered = 0
+        # time spent waiting for data commands, to check the throughput of the client
+        self._data_wait = 0.0
+        self.transport = None
+        self.task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.task = asyncio.ensure_future(self._session_handler(self, transport))
+
+    def get_buffer(self, sizehint):
+        return memoryview(self._buffer)[self._filled: self._expected]
+
+    def buffer_updated(self, nbytes):
+        self._filled += nbytes
+        if self._filled < self._expected:
+            return
+
+        if self._state == STATE_PREAMBLE:
+            frame_type = get_frame_type(self._header)
+            layout = HEADER_LAYOUTS.get(frame_type)
+            size = layout.size if layout is not None else REQUEST_SIZES.get(frame_type)
+            if size is None:
+                # control frames (and unknown ones) have the size of the preamble
+                self._complete(Frame(frame_type, memoryview(self._header)[:PREAMBLE_SIZE]), STATE_PREAMBLE)
+                return
+            self._state = STATE_HEADER
+            self._expected = size
+            if self._filled < self._expected:
+                return
+
+        if self._state == STATE_HEADER:
+            frame_type = get_frame_type(self._header)
+            layout = HEADER_LAYOUTS.get(frame_type)
+            if layout is None:
+                # a request is followed by a new frame, not by data commands
+                self._complete(Frame(frame_type, memoryview(self._header)[:self._expected]), STATE_PREAMBLE)
+                return
+            self._complete(Frame(frame_type, memoryview(self._header)[:layout.size], layout), STATE_DATA)
+        else:
+            self._complete(Frame(get_frame_type(self._data), memoryview(self._data)), STATE_DATA)
+
+    def _complete(self, frame, next_state):
+        self._frame = frame
+        self._state = next_state
+        self.transport.pause_reading()
+        self._wake_up()
+
+    def eof_received(self):
+        self._eof = True
+        self._wake_up()
+        # keep the transport open to send the final reply
+        return True
+
+    def connection_lost(self, exc):
+        self._eof = True
+        self._wake_up()
+
+    def _wake_up(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _get_phase(self):
+        if self._frames_delivered == 0:
+            return PHASE_HANDSHAKE
+        return PHASE_FIRST_BLOCK if self._frames_delivered == 1 else PHASE_CHUNK_GAP
+
+    def _get_expected_frame_type(self):
+        if self._state == STATE_DATA:
+            return FRAME_DATA
+        # the type of the first frame is only known if its preamble was (partially) received
+        if self._filled >= 5 or (self._filled >= 3 and self._header[1] != 255):
+            return get_frame_type(self._header)
+        return None
+
+    async def read_frame(self):
+        """
+        Waits for the next complete frame.
+        :return: The Frame or None if the client finished sending (a partial frame is discarded)
+        :raises DeadlineExceeded: If the client didn't meet the deadlines of the session
+        """
+        if self._delivered:
+            # the previous frame was handled, so its buffer can be used for the next one
+            self._delivered = False
+            self._filled = 0
+            if self._state == STATE_DATA:
+                self._buffer = self._data
+                self._expected = DATA_CMD_SIZE
+            else:
+                self._buffer = self._header
+                self._expected = PREAMBLE_SIZE
+            if not self._eof:
+                self.transport.resume_reading()
+
+        phase = self._get_phase()
+        if self._frame is None and not self._eof:
+            self._waiter = asyncio.get_event_loop().create_future()
+            timeout = self._deadlines.get_timeout(phase) if self._deadlines is not None else None
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(self._waiter, timeout)
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(phase, self._get_expected_frame_type()) from None
+            finally:
+                self._waiter = None
+                if phase != PHASE_HANDSHAKE:
+                    self._data_wait += time.perf_counter() - start
+
+        frame, self._frame = self._frame, None
+        if frame is not None:
+            self._delivered = True
+            self._frames_delivered += 1
+            if phase != PHASE_HANDSHAKE:
+                self._check_throughput()
+        return frame
+
+    def _check_throughput(self):
+        deadlines = self._deadlines
+        if deadlines is None or deadlines.min_throughput is None or self._data_wait <= deadlines.throughput_grace:
+            return
+        received = (self._frames_delivered - 1) * DATA_CMD_SIZE
+        if received / self._data_wait < deadlines.min_throughput:
+            raise DeadlineExceeded(PHASE_THROUGHPUT, FRAME_DATA)
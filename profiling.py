@@ -0,0 +1,137 @@
+import os
+import cProfile
+import json
+import pstats
+import time
+import tracemalloc
+
+
+class ProfiledSession(object):
+    """
+    An upload session, profiled or not. The session handler sets the number of blocks of data it handled.
+    """
+    def __init__(self, upload_id, frame_type, profile=None, run_id=''):
+        self.upload_id = upload_id
+        self.run_id = run_id
+        self.frame_type = frame_type
+        self.chunks = 0
+        self.profile = profile
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._started_tracemalloc = False
+
+    @property
+    def active(self):
+        return self.profile is not None
+
+    @property
+    def name(self):
+        return f'upload-{self.run_id}-{self.upload_id:06d}-{self.frame_type}'
+
+
+class SessionProfiler(object):
+    """
+    Profiles the next sessions handled by the server (CPU with cProfile and allocations with tracemalloc), writing the
+    results of each one to a directory.
+
+    Only one session is profiled at a time: sessions that run while another one is being profiled aren't profiled
+    and don't count. cProfile profiles the whole event loop thread, so the other sessions running at the same time
+    (e.g., control frames) show up in the profile too.
+    """
+    def __init__(self, directory, batch=1, top=20):
+        """
+        :param directory: Directory where the profiles are written
+        :param batch: (Optional) Number of sessions profiled each time profiling is enabled
+        :param top: (Optional) Number of functions and allocation sites in the summary of each session
+        """
+        self.directory = directory
+        self.batch = batch
+        self.top = top
+        # the upload ids start again on each run of the server, so the names of the profiles include the run
+        self.run_id = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+        self._remaining = 0
+        self._active = None
+        self._profiled = []
+
+    @property
+    def remaining(self):
+        return self._remaining
+
+    def enable(self, sessions=None):
+        """
+        Profiles the next sessions.
+        :param sessions: (Optional) Number of sessions to profile (by default, the batch given in the constructor)
+        """
+        self._remaining += sessions if sessions is not None else self.batch
+
+    def start(self, upload_id, frame_type):
+        """
+        :return: The ProfiledSession, which is only profiled if profiling was enabled and no other session is
+            being profiled
+        """
+        if self._remaining <= 0 or self._active is not None:
+            return ProfiledSession(upload_id, frame_type, run_id=self.run_id)
+
+        self._remaining -= 1
+        session = self._active = ProfiledSession(upload_id, frame_type, cProfile.Profile(), self.run_id)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            session._started_tracemalloc = True
+        session.profile.enable()
+        return session
+
+    def finish(self, session):
+        """
+        Stops profiling the session and writes its CPU profile, allocation snapshot and summary.
+        :return: Path of the summary, or None if the session wasn't profiled
+        """
+        if not session.active:
+            return None
+        session.profile.disable()
+        elapsed = time.perf_counter() - session._start
+        snapshot = tracemalloc.take_snapshot()
+        if session._started_tracemalloc:
+            tracemalloc.stop()
+        self._active = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, session.name)
+        session.profile.dump_stats(base + '.prof')
+        snapshot.dump(base + '.tracemalloc')
+
+        summary = {
+            'upload_id': session.upload_id,
+            'run_id': session.run_id,
+            'frame_type': session.frame_type,
+            'chunks': session.chunks,
+            'started': session.started,
+            'elapsed_s': elapsed,
+            'bandwidth_mbps': (32768 * session.chunks * 8 / 2**20) / elapsed if elapsed > 0 else 0.0,
+            'profile': base + '.prof',
+            'snapshot': base + '.tracemalloc',
+            'top_functions': self._get_top_functions(session.profile),
+            'top_allocations': [{'location': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                                for stat in snapshot.statistics('lineno')[:self.top]],
+        }
+        with open(base + '.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        self._profiled.append(session.name)
+        print(f'Profile of upload {session.upload_id} written to {base}.prof')
+        return base + '.json'
+
+    def _get_top_functions(self, profile):
+        stats = pstats.Stats(profile)
+        functions = []
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            functions.append({'function': f'{filename}:{line}({name})', 'calls': calls, 'tottime': tottime,
+                              'cumtime': cumtime})
+        return sorted(functions, key=lambda f: f['tottime'], reverse=True)[:self.top]
+
+    def as_dict(self):
+        return {
+            'directory': self.directory,
+            'remaining': self._remaining,
+            'active': self._active.name if self._active is not None else None,
+            'profiled': self._profiled[-self.top:],
+        }
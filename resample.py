@@ -0,0 +1,166 @@
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+DATA_BLOCK_SIZE = 32768
+SAMPLE_SIZE = 4
+
+DATA_TYPE_INT32 = 0
+DATA_TYPE_FLOAT32 = 1
+
+# the size of the filter grows with the number of phases, so rates without a reasonable common divisor are refused
+MAX_PHASES = 4096
+
+
+class PolyphaseResampler(object):
+    """
+    Streaming rational resampler (target_rate / source_rate) with a windowed sinc low-pass filter in polyphase form.
+
+    The input is given block by block and the last input frames are kept between blocks, so the output doesn't depend
+    on how the sound is split in blocks.
+    """
+    def __init__(self, source_rate, target_rate, channels=2, taps_per_phase=32, beta=8.0):
+        """
+        :param source_rate: Sample rate of the input
+        :param target_rate: Sample rate of the output
+        :param channels: (Optional) Number of interleaved channels
+        :param taps_per_phase: (Optional) Length of the filter of each phase (quality vs speed)
+        :param beta: (Optional) Beta of the Kaiser window applied to the sinc
+        """
+        if source_rate <= 0 or target_rate <= 0:
+            raise ValueError(f'Invalid sample rates {source_rate} -> {target_rate}')
+        g = math.gcd(int(source_rate), int(target_rate))
+        self.up = int(target_rate) // g
+        self.down = int(source_rate) // g
+        if self.up > MAX_PHASES:
+            raise ValueError(f'Conversion from {source_rate} to {target_rate} needs {self.up} phases (max {MAX_PHASES})')
+        self.channels = channels
+        self.taps = taps_per_phase
+
+        # low-pass filter at the upsampled rate, with the cutoff at the lowest of the two Nyquist frequencies. It has
+        # an odd length (padded with a zero to fill the phases) so that its delay is a whole number of samples.
+        length = self.taps * self.up - 1
+        cutoff = 0.5 / max(self.up, self.down)
+        n = np.arange(length) - (length - 1) // 2
+        h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(length, beta) * self.up
+        h = np.append(h, 0.0)
+
+        # polyphase[p, k] = h[p + k * up], reversed so that each output is a dot product with the input window
+        self._polyphase = h.reshape(self.taps, self.up).T[:, ::-1].copy()
+        # delay of the filter in the upsampled domain, compensated so that the output is aligned with the input
+        self._delay = (length - 1) // 2
+
+        self._history = np.zeros((self.taps - 1, channels), dtype=np.float64)
+        # number of input frames received and output frames produced
+        self._received = 0
+        self._produced = 0
+
+    def get_output_frames(self, input_frames):
+        """
+        :return: Number of output frames for a sound with the given number of input frames
+        """
+        return -(-input_frames * self.up // self.down)
+
+    def process(self, frames):
+        """
+        Resamples the next input frames.
+        :param frames: Array with shape (number of frames, channels)
+        :return: Array (float64) with the output frames that can already be calculated
+        """
+        buffer = np.concatenate((self._history, np.asarray(frames, dtype=np.float64)))
+        buffer_start = self._received - (self.taps - 1)
+        self._received += len(frames)
+
+        # output m needs the input frames up to n = (m * down + delay) // up
+        last = (self._received * self.up - self._delay - 1) // self.down
+        outputs = np.arange(self._produced, max(self._produced, last + 1))
+        self._history = buffer[len(buffer) - (self.taps - 1):]
+        if len(outputs) == 0:
+            return np.zeros((0, self.channels))
+
+        t = outputs * self.down + self._delay
+        positions = t // self.up - buffer_start - (self.taps - 1)
+        phases = t % self.up
+        windows = sliding_window_view(buffer, self.taps, axis=0)
+        self._produced += len(outputs)
+        return np.einsum('mcj,mj->mc', windows[positions], self._polyphase[phases])
+
+    def flush(self):
+        """
+        :return: The output frames that depend on input frames after the end of the sound (taken as silence)
+        """
+        padding = self._delay // self.up + 1
+        return self.process(np.zeros((padding, self.channels)))
+
+
+class ResampledUpload(object):
+    """
+    Converts the blocks of an upload at the source sample rate into blocks of data for the sound card at its sample
+    rate, as the blocks arrive.
+    """
+    def __init__(self, source_rate, target_rate, source_samples, data_type, channels=2):
+        """
+        :param source_rate: Sample rate of the sound sent by the client
+        :param target_rate: Sample rate of the sound card
+        :param source_samples: Number of samples (of all channels) sent by the client
+        :param data_type: DATA_TYPE_INT32 or DATA_TYPE_FLOAT32
+        :param channels: (Optional) Number of interleaved channels
+        """
+        if data_type not in (DATA_TYPE_INT32, DATA_TYPE_FLOAT32) or source_samples < 0:
+            raise ValueError(f'Invalid data type {data_type} or size {source_samples}')
+        self._resampler = PolyphaseResampler(source_rate, target_rate, channels)
+        self._channels = channels
+        self._dtype = np.float32 if data_type == DATA_TYPE_FLOAT32 else np.int32
+        self._source_remaining = source_samples
+        self._output_frames = self._resampler.get_output_frames(source_samples // channels)
+        self._output_remaining = self._output_frames
+        self._pending = bytearray()
+
+        self.total_samples = self._output_frames * channels
+        self.commands_to_send = -(-self.total_samples * SAMPLE_SIZE // DATA_BLOCK_SIZE)
+        # number of data commands sent by the client
+        self.source_commands = -(-source_samples * SAMPLE_SIZE // DATA_BLOCK_SIZE)
+
+    @property
+    def complete(self):
+        """
+        True once all the samples declared by the client were received.
+        """
+        return self._source_remaining <= 0
+
+    def add_block(self, data_block):
+        """
+        :param data_block: Block of data at the source sample rate, as received in a data command
+        :return: List with the complete blocks at the target sample rate that are ready to be sent
+        """
+        samples = np.frombuffer(data_block, dtype=self._dtype)
+        # the last block is padded by the client, so the samples after the declared size are discarded
+        samples = samples[:max(0, min(len(samples), self._source_remaining))]
+        self._source_remaining -= len(samples)
+        samples = samples[:len(samples) - len(samples) % self._channels]
+        output = self._resampler.process(samples.reshape(-1, self._channels))
+        return self._add_output(output)
+
+    def finish(self):
+        """
+        :return: List with the remaining blocks at the target sample rate, the last one padded with zeros
+        """
+        blocks = self._add_output(self._resampler.flush())
+        if self._pending:
+            blocks.append(bytes(self._pending) + bytes(DATA_BLOCK_SIZE - len(self._pending)))
+            self._pending = bytearray()
+        return blocks
+
+    def _add_output(self, output):
+        output = output[:self._output_remaining]
+        self._output_remaining -= len(output)
+        if self._dtype == np.int32:
+            output = np.clip(np.rint(output), -2**31, 2**31 - 1)
+        self._pending += output.astype(self._dtype).tobytes()
+
+        blocks = []
+        while len(self._pending) >= DATA_BLOCK_SIZE:
+            blocks.append(bytes(self._pending[:DATA_BLOCK_SIZE]))
+            del self._pending[:DATA_BLOCK_SIZE]
+        return blocks
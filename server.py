@@ -1,219 +1,477 @@
 import os
+import argparse
+import signal
 import asyncio
-import array
-import usb.core
-import usb.util
-from usb.backend import libusb1 as libusb
+import collections
+import json
+import logging
+import sys
 import time
 import math
 import numpy as np
-from asyncio import IncompleteReadError, BoundedSemaphore
-from tqdm import tqdm
+from asyncio import BoundedSemaphore
+from device import SoundCardDevice
+from spool import Spool, JOB_READY, JOB_DRAINING
+from capture import CaptureWriter
+from profiling import SessionProfiler
+from resample import ResampledUpload
+from sounds import SoundCache, SoundCacheFull, SLOT_LOADING
+from events import EventLog, LogWriter, NullProgress
+from ingest import FrameProtocol, SessionDeadlines, DeadlineExceeded, calc_checksum, FRAME_CONTROL, FRAME_DATA, FRAME_ENSURE, METADATA_SIZE, \
+    DATA_BLOCK_SIZE, FILE_METADATA_SIZE, SOURCE_RATE_SIZE, CONTENT_HASH_SIZE, DATA_CMD_INDEX, DATA_CMD_BLOCK_INDEX, CONTROL_STATUS, \
+    CONTROL_PROFILE, ENSURE_HASH_INDEX, ENSURE_FLAGS_INDEX, ENSURE_PIN, ENSURE_UNPIN, REPLY_RETRANSMIT
 
 
 class SoundCardTCPServer(object):
 
-    def __init__(self, addr, port):
+    def __init__(self, addr, port, spool_dir=None, spool_max_jobs=8, spool_max_bytes=1024 * 2**20, capture_path=None,
+                 device_wait=10.0, profile_dir=None, profile_sessions=1, deadlines=None, device_process=False,
+                 device_slots=8, sound_cache=None, max_retransmissions=3, device_factory=SoundCardDevice,
+                 event_log=None, drain_attempts=3):
+        """
+        :param addr: Address where the server listens for requests
+        :param port: Port where the server listens for requests
+        :param spool_dir: (Optional) Directory to stage the uploads in. If given, uploads are received at network speed
+            and written to the sound card in the background, instead of waiting for the sound card.
+        :param spool_max_jobs: (Optional) Maximum number of uploads staged at the same time
+        :param spool_max_bytes: (Optional) Maximum number of bytes used by the staged uploads
+        :param capture_path: (Optional) File where the frames received on each connection are recorded, with their
+            timing, to be replayed later with 'examples/replay.py'
+        :param device_wait: (Optional) Time in seconds an upload waits for the sound card to be available before
+            getting an error reply (e.g. when the server was just started)
+        :param profile_dir: (Optional) Directory where the profiles of the upload sessions are written. Profiling is
+            only available if given, and is enabled at runtime with 'enable_profiling' (or a control frame)
+        :param profile_sessions: (Optional) Number of sessions profiled each time profiling is enabled
+        :param deadlines: (Optional) SessionDeadlines for the clients. Sessions that don't meet them are aborted with an
+            error reply, so that a stalled client doesn't keep the sound card from other uploads
+        :param device_process: (Optional) If True, the sound card is driven by a separate process, which receives the
+            commands through a ring buffer in shared memory, so that the USB transfers don't compete for the GIL
+        :param device_slots: (Optional) Number of commands in the ring buffer of the device process
+        :param sound_cache: (Optional) SoundCache with the sound indexes the clients can load sounds to by content
+            (with ensure frames), instead of choosing the index themselves
+        :param max_retransmissions: (Optional) Number of times a corrupted data command is requested again before the
+            upload is aborted
+        :param device_factory: (Optional) Callable that creates the device (e.g. a stand-in device for tests)
+        :param event_log: (Optional) EventLog for the service mode: the events and a summary of each upload are
+            logged to it instead of printed, and there are no progress bars
+        :param drain_attempts: (Optional) Number of times a staged upload is written to the device before it is given
+            up (and reported in the status of the spool)
+        """
         self.address = addr
         self.port = port
-        self._conn_open = False
         self._sem = None
+        self._device_ready = None
+        self._device_wait = device_wait
+        self._created = time.perf_counter()
+        self._startup = {}
+        if device_process:
+            # the driver process needs Python 3.8 or later, so it is only imported when requested
+            from driver import DeviceProcess
+            self._device = DeviceProcess(device_slots, device_factory)
+        else:
+            self._device = device_factory()
+        self._spool_dir = spool_dir
+        self._spool_max_jobs = spool_max_jobs
+        self._spool_max_bytes = spool_max_bytes
+        self._spool = None
+        self._capture = CaptureWriter(capture_path) if capture_path else None
+        self._capture_ids = {}
+        self._metrics = collections.Counter()
+        # time each upload waited for the device (or for space in the spool) before being received
+        self._queue_waits = collections.deque(maxlen=1024)
+        self._profiler = SessionProfiler(profile_dir, profile_sessions) if profile_dir else None
+        self._deadlines = deadlines if deadlines is not None else SessionDeadlines()
+        self._sounds = sound_cache
+        self._max_retransmissions = max_retransmissions
+        # slots of the sound cache being loaded by staged jobs, by job id
+        self._slot_jobs = {}
+        self._events = event_log
+        self._drain_attempts = drain_attempts
+
+    async def start_server(self, semaphore=None):
+        self._sem = semaphore if semaphore is not None else BoundedSemaphore(value=1)
+        self._device_ready = asyncio.Event()
+
+        self.init_data()
+
+        if self._sounds is not None:
+            loaded = self._sounds.load()
+            self._log('sound_cache', f'{loaded} sounds in the sound cache', sounds=loaded)
+
+        if self._spool_dir is not None:
+            self._spool = Spool(self._spool_dir, self._spool_max_jobs, self._spool_max_bytes)
+            recovered = self._spool.recover()
+            if recovered:
+                self._log('spool_recovered', f'Recovered {len(recovered)} staged uploads from {self._spool_dir}',
+                          jobs=len(recovered))
+            asyncio.ensure_future(self._drain_spool())
+
+        # Start server to listen for incoming requests, before the (slow) connection to the sound card, so that the
+        # clients aren't refused after a reboot
+        server = await self.listen()
+        self._startup['listening_s'] = time.perf_counter() - self._created
+        self._log('started', 'SoundCardTCPServer started and waiting for requests', address=self.address,
+                  port=self.port)
 
-    async def start_server(self, semaphore):
-        self._sem = semaphore
         # init connection to soundcard through the usb connection
-        self._conn_open = self.open()
+        asyncio.ensure_future(self._open_device())
 
-        self.init_data()
+        await server.serve_forever()
 
-        # Start server to listen for incoming requests
-        await asyncio.start_server(self._handle_request, self.address, int(self.port))
-        print('SoundCardTCPServer started and waiting for requests')
+    async def _open_device(self):
+        """
+        Opens the USB connection to the sound card in the background, trying again until it is available.
+        """
+        loop = asyncio.get_event_loop()
         while True:
+            try:
+                opened = await loop.run_in_executor(None, self.open)
+            except Exception as e:
+                self._log('device_error', f'Exception while opening the USB connection with message {e}',
+                          logging.WARNING)
+                opened = False
+            if opened:
+                break
             await asyncio.sleep(1)
 
-    def open(self):
-        if self._conn_open is True:
-            return True
+        self._startup['device_ready_s'] = time.perf_counter() - self._created
+        self._device_ready.set()
+        self._log('device_ready', 'Sound card ready', seconds=round(self._startup['device_ready_s'], 3))
 
-        print('Trying to open USB connection to the Harp sound card')
-        backend = libusb.get_backend()
-        # backend = libusb.get_backend(find_library=lambda x: "libusb-1.0.dll")
-        self._dev = usb.core.find(backend=backend, idVendor=0x04d8, idProduct=0xee6a)
-        if self._dev is None:
-            print(f'\tError while trying to connect to the Harp sound card. Please make sure it is connected to the computer and try again.')
+    async def _wait_for_device_ready(self):
+        """
+        :return: True if the sound card is available, False if it wasn't opened within the device wait time
+        """
+        if self._device_ready is None or self._device_ready.is_set():
+            return True
+        try:
+            await asyncio.wait_for(self._device_ready.wait(), self._device_wait)
+        except asyncio.TimeoutError:
             return False
-
-        print(f'backend used: {self._dev.backend}')
-        if self._dev is None:
-            print('\tSoundCard not found. Please connect it to the USB port before proceeding.')
-        else:
-            # set the active configuration. With no arguments, the first configuration will be the active one
-            # note: some devices reset when setting an already selected configuration so we should check for it before
-            _cfg = self._dev.get_active_configuration()
-            if _cfg is None or _cfg.bConfigurationValue != 1:
-                self._dev.set_configuration(1)
-            usb.util.claim_interface(self._dev, 0)
-
-        self._conn_open = True
         return True
 
-    def restart(self):
-        print('Restarting USB connection')
-        self.close()
-        self.open()
-
-    def reset(self):
+    async def listen(self):
         """
-        Resets the device, waits 700ms and tries to connect again so that the current instance of the SoundCard object can still be used.
-        :note Necessary at the moment after sending a sound
+        Starts listening for requests. Each connection is received through a FrameProtocol.
         """
-        print('Resetting device')
-        if not self._dev:
-            raise Exception("Sound card might not be connected. Please connect it before any operation.")
+        loop = asyncio.get_event_loop()
+        return await loop.create_server(lambda: FrameProtocol(self._handle_request, self._deadlines), self.address,
+                                        int(self.port))
+
+    def open(self):
+        return self._device.open()
 
-        # Reset command length:    'c' 'm' 'd' '0x88' + 'f'
-        reset_cmd = [ord('c'), ord('m'), ord('d'), 0x88, ord('f')]
-        # cmd = 'cmd' + chr(0x88) + 'f'
-        wrt = self._dev.write(1, reset_cmd, 100)
-        if wrt != len(reset_cmd):
-            raise AssertionError("Error while sending reset command to device")
+    def restart(self):
+        self._device.restart()
+
+    def reset(self):
+        self._device.reset()
 
-        time.sleep(700.0 / 1000.0)
-        self.open()
+    def stop_capture(self):
+        if self._capture is not None:
+            self._log('capture', f'Sessions captured to {self._capture.path}', path=self._capture.path)
+            self._capture.close()
+            self._capture = None
 
     def close(self):
-        print('Closing USB connection')
-        # close usb connection
-        if self._dev:
-            usb.util.dispose_resources(self._dev)
+        self._device.close()
 
     def init_data(self):
         # prepare message to reply to client (5 bytes for preamble, 6 bytes for timestamp and 1 for checksum)
         self._reply = np.zeros(5 + 6 + 1, dtype=np.int8)
         # prepare with 'ok' reply by default
-        self._reply[:5] = np.array([2, 10, 128, 255, 16], dtype=np.int8)
+        self._reply[:5] = np.array([2, 10, 128, 255, 16], dtype=np.uint8).view(np.int8)
 
         self._int32_size = np.dtype(np.int32).itemsize
+        self._data_cmd = self._create_data_cmd()
+        self._data_cmd_data_index = 4 + self._int32_size + self._int32_size
+
+    def _create_data_cmd(self):
+        """
+        :return: Buffer for the data commands sent to the device, with the fixed bytes already set
+        """
+        int32_size = np.dtype(np.int32).itemsize
         # prepare command to send and to receive
         # Data command length:     'c' 'm' 'd' '0x81' + random + dataIndex + 32768 + 'f'
-        package_size = 4 + self._int32_size + self._int32_size + 32768 + 1
+        package_size = 4 + int32_size + int32_size + 32768 + 1
         # align = 64
         # padding = (align - (package_size % align)) % align
 
-        self._data_cmd = np.zeros(package_size, dtype=np.int8)
-        self._data_cmd_data_index = 4 + self._int32_size + self._int32_size
-
-        self._data_cmd[0] = ord('c')
-        self._data_cmd[1] = ord('m')
-        self._data_cmd[2] = ord('d')
-        self._data_cmd[3] = 0x81
-        # self._data_cmd[package_size - 1] = ord('f')
-        self._data_cmd[-1] = ord('f')
-
-        # Data command reply:     'c' 'm' 'd' '0x81' + random + error
-        self._data_cmd_reply = array.array('b', [0] * (4 + self._int32_size + self._int32_size))
+        data_cmd = np.zeros(package_size, dtype=np.int8)
+        data_cmd[0] = ord('c')
+        data_cmd[1] = ord('m')
+        data_cmd[2] = ord('d')
+        data_cmd[3:4] = np.array([0x81], dtype=np.uint8).view(np.int8)
+        # data_cmd[package_size - 1] = ord('f')
+        data_cmd[-1] = ord('f')
+        return data_cmd
 
     def set_reply_type(self, reply_type):
-        self._reply[2] = np.array([reply_type], dtype=np.int8)
+        self._reply[2:3] = np.array([reply_type], dtype=np.uint8).view(np.int8)
 
     def clear_data(self):
         self.init_data()
 
-    def _send_data_to_device(self, data_to_send: bytes, rand_val, read_timeout=400):
-        try:
-            res_write = self._dev.write(0x01, data_to_send, 100)
-        except usb.core.USBError as e:
-            print(f'Exception while writing to device with message {e}')
-            time.sleep(1)
-            self._wait_for_device_connection()
-            self._send_data_to_device(data_to_send, rand_val, read_timeout)
+    def get_status(self):
+        """
+        :return: Dictionary with the state of the server and of the connection to the device
+        """
+        status = {
+            'device': {
+                'ready': self._device_ready is not None and self._device_ready.is_set(),
+                **self._device.as_dict(),
+            },
+        }
+        if self._spool is not None:
+            status['spool'] = self._spool.as_dict()
+
+        if self._profiler is not None:
+            status['profiling'] = self._profiler.as_dict()
+
+        if self._sounds is not None:
+            status['sounds'] = self._sounds.as_dict()
+
+        if self._events is not None:
+            status['log'] = self._events.as_dict()
+
+        status['startup'] = self._startup
+        status['metrics'] = dict(self._metrics)
+        if self._queue_waits:
+            waits = np.percentile(np.fromiter(self._queue_waits, dtype=np.float64), [50, 95, 99]) * 1000.0
+            status['metrics']['queue_wait_ms'] = {'p50': waits[0], 'p95': waits[1], 'p99': waits[2]}
+        return status
+
+    async def _handle_request(self, frames, writer):
+        if self._capture is None:
+            await self._handle_session(frames, writer)
             return
 
-        if res_write == len(data_to_send):
-            raise AssertionError("Written data size on device different than data sent size")
+        self._capture_ids[frames] = self._capture.open_connection(writer.get_extra_info('peername'))
+        try:
+            await self._handle_session(frames, writer)
+        finally:
+            connection_id = self._capture_ids.pop(frames)
+            if self._capture is not None:
+                self._capture.close_connection(connection_id)
 
-        self._receive_reply_from_device(rand_val, read_timeout)
+    def _record_frame(self, frames, frame):
+        if self._capture is not None and frames in self._capture_ids:
+            self._capture.record_frame(self._capture_ids[frames], frame.data)
 
-    def _receive_reply_from_device(self, rand_val, read_timeout=400):
+    async def _handle_session(self, frames, writer):
         try:
-            ret = self._dev.read(0x81, self._data_cmd_reply, read_timeout)
-        except usb.core.USBError as e:
-            print(f'Exception while reading from device with message {e}')
-            time.sleep(1)
-            self._wait_for_device_connection()
+            await self._dispatch_session(frames, writer)
+        except DeadlineExceeded as e:
+            # evict the client: the device (or the spool job) was already released while the exception propagated
+            self._metrics['evictions'] += 1
+            self._metrics[f'evictions_{e.phase}'] += 1
+            peer = writer.get_extra_info('peername')
+            self._log('eviction', f'Evicting client {peer}: {e}', logging.WARNING, peer=peer, phase=e.phase)
+            self.send_reply(writer, with_error=True, reply_type=e.frame_type if e.frame_type is not None else 0)
+        finally:
+            writer.close()
+
+    async def _dispatch_session(self, frames, writer):
+        # the first frame defines the type of session
+        frame = await frames.read_frame()
+        if frame is None:
             return
+        self._record_frame(frames, frame)
 
-        # get the random received and the error received from the reply command
-        rand_val_received = int.from_bytes(self._data_cmd_reply[4: 4 + self._int32_size], byteorder='little', signed=True)
-        error_received = int.from_bytes(self._data_cmd_reply[8: 8 + self._int32_size], byteorder='little', signed=False)
+        # control frames don't need the device, so they are answered even while an upload is in progress
+        if frame.frame_type == FRAME_CONTROL:
+            self._handle_control(writer, frame.data)
+            return
+
+        if frame.frame_type == FRAME_ENSURE:
+            await self._handle_ensure(frames, writer, frame)
+            return
 
-        if ret != 12:
-            raise AssertionError("Reply from device is not 12 bytes")
+        if frame.layout is None:
+            self.send_reply(writer, with_error=True, reply_type=frame.frame_type)
+            return
 
-        if rand_val_received != rand_val:
-            raise AssertionError("Random value received different than the random value sent")
+        # the upload overwrites whatever sound the cache had in that index
+        if self._sounds is not None:
+            self._sounds.invalidate(self._get_sound_index(frame))
+        await self._handle_upload(frames, writer, frame)
 
-        if error_received != 0:
-            raise AssertionError("Error received from device")
+    async def _handle_upload(self, frames, writer, header, slot=None):
+        """
+        :param slot: (Optional) SoundSlot of the sound cache the upload is loading
+        :return: The number of blocks of data received, or None if the upload failed
+        """
+        # with a spool, uploads don't need to wait for the device
+        if self._spool is not None:
+            return await self._profile_session(header.frame_type, self._stage_data(writer, frames, header, slot))
 
-    async def _handle_request(self, reader, writer):
+        wait_start = time.perf_counter()
         async with self._sem:
-            await self._recv_data(writer, reader)
-
-    async def _recv_data(self, writer, stream):
-        if self._conn_open is False:
-            self._wait_for_device_connection()
-
-        start = initial_time = time.time()
-
-        with_data = True
-        with_file_metadata = True
-
-        # get first 7 bytes to know which type of frame we are going to receive
-        preamble_size = 7
-        preamble_bytes = await stream.readexactly(preamble_size)
-
-        # size of header will depend on preamble data (index 4 defines type of frame)
-        frame_type = preamble_bytes[4]
-        self.set_reply_type(frame_type)
-        header_size = 7 + 16 + 1
-        metadata_index = 7
-        if frame_type == 128:
-            header_size += 32768 + 2048
-        elif frame_type == 129:
-            header_size += 2048
-            with_data = False
-        elif preamble_bytes[2] == 130:
-            header_size = 22
-            metadata_index = 5
-            with_data = False
-            with_file_metadata = False
-            self.set_reply_type(130)
-
-        # read remaining of header
-        header_bytes = await stream.readexactly(header_size - preamble_size)
-
-        complete_header = preamble_bytes + header_bytes
-
-        # calculate checksum for verification
-        checksum = self._calc_checksum(complete_header[:-1])
-        if checksum != complete_header[-1]:
-            self.send_reply(writer, with_error=True)
+            self._queue_waits.append(time.perf_counter() - wait_start)
+            self._metrics['uploads'] += 1
+            try:
+                return await self._profile_session(header.frame_type, self._recv_data(writer, frames, header))
+            except DeadlineExceeded:
+                self.clear_data()
+                raise
+            except AssertionError as e:
+                # a command failed even after its retries, or the device had to be restarted or reset
+                self._log('upload_failed', f'Upload failed with message {e}', logging.WARNING)
+                self._metrics['failed_uploads'] += 1
+                self.clear_data()
+                self.send_reply(writer, with_error=True)
+
+    def _get_sound_index(self, header):
+        layout = header.layout
+        return int(np.frombuffer(header.data[layout.metadata_index: layout.metadata_index + 4], dtype=np.int32)[0])
+
+    async def _handle_ensure(self, frames, writer, frame):
+        """
+        Handles an ensure frame: [2, 40, 134, 255, 1] + content hash (32 bytes) + flags (4 bytes) + checksum
+        The reply is followed by the sound index where the sound is (4 bytes, little endian) and 1 byte that is 1 if
+        the sound is already loaded. If it isn't, the client sends the upload in the same connection, with any sound
+        index in the metadata: the sound is written to the index given by the server.
+        The flags pin the sound (ENSURE_PIN), so that it is never evicted, or unpin it (ENSURE_UNPIN).
+        """
+        if self._sounds is None or not frame.is_valid():
+            self.send_reply(writer, with_error=True, reply_type=FRAME_ENSURE)
             return
 
-        # get total number of commands to send to the board
-        sound_file_size_in_samples = np.frombuffer(complete_header[metadata_index + 4: metadata_index + 4 + 4], dtype=np.int32)[0]
-        commands_to_send = self._get_total_commands_to_send(sound_file_size_in_samples)
+        content_hash = bytes(frame.data[ENSURE_HASH_INDEX: ENSURE_HASH_INDEX + CONTENT_HASH_SIZE])
+        flags = int.from_bytes(frame.data[ENSURE_FLAGS_INDEX: ENSURE_FLAGS_INDEX + 4], byteorder='little')
+        try:
+            slot, loaded = self._sounds.ensure(content_hash, pin=bool(flags & ENSURE_PIN),
+                                               unpin=bool(flags & ENSURE_UNPIN))
+        except SoundCacheFull as e:
+            self._log('sound_cache_full', f'Refusing sound: {e}', logging.WARNING)
+            self.send_reply(writer, with_error=True, reply_type=FRAME_ENSURE)
+            return
+
+        self.send_reply(writer, reply_type=FRAME_ENSURE)
+        writer.write(slot.index.to_bytes(4, byteorder='little') + bytes([loaded]))
+        if loaded:
+            return
+
+        try:
+            header = await frames.read_frame()
+            if header is None:
+                return
+            self._record_frame(frames, header)
+            if header.layout is None or not header.is_valid():
+                self.send_reply(writer, with_error=True, reply_type=header.frame_type)
+                return
+
+            # write the sound to the index of the slot
+            metadata_index = header.layout.metadata_index
+            header.data[metadata_index: metadata_index + 4] = slot.index.to_bytes(4, byteorder='little', signed=True)
+            header.data[-1] = calc_checksum(header.data[:-1])
+
+            blocks = await self._handle_upload(frames, writer, header, slot)
+            if blocks and self._spool is None:
+                self._sounds.commit(slot)
+        finally:
+            # a staged upload keeps its slot until it is written to the device
+            if slot.state == SLOT_LOADING:
+                self._sounds.release(slot)
+
+    def enable_profiling(self, sessions=None):
+        """
+        Profiles the next upload sessions (CPU and allocations), writing the results to the profile directory.
+        :param sessions: (Optional) Number of sessions to profile (by default, the number given in the constructor)
+        :return: False if the server wasn't started with a profile directory
+        """
+        if self._profiler is None:
+            return False
+        self._profiler.enable(sessions)
+        self._log('profiling', f'Profiling the next {self._profiler.remaining} upload sessions',
+                  sessions=self._profiler.remaining)
+        return True
+
+    async def _profile_session(self, frame_type, handler):
+        """
+        Runs the handler of an upload session, profiling it if profiling was enabled.
+        :param handler: Coroutine that handles the session and returns the number of blocks of data received
+        :return: The value returned by the handler
+        """
+        self._metrics['sessions'] += 1
+        if self._profiler is None:
+            return await handler
 
+        session = self._profiler.start(self._metrics['sessions'], frame_type)
+        try:
+            chunks = await handler
+            session.chunks = chunks or 0
+            return chunks
+        finally:
+            self._profiler.finish(session)
+
+    def _handle_control(self, writer, frame):
+        """
+        Handles a control frame: [1, 5, 131, 255, 1, command, checksum]
+        Command 0 requests the status of the server, which is sent after the reply as a 4 bytes (little endian) length
+        followed by a JSON document.
+        Command 1 enables the profiling of the next upload sessions (error reply if profiling isn't available).
+        """
+        checksum = self._calc_checksum(frame[:-1])
+        if checksum != frame[-1] or frame[5] not in (CONTROL_STATUS, CONTROL_PROFILE):
+            self.send_reply(writer, with_error=True, reply_type=FRAME_CONTROL)
+            return
+
+        if frame[5] == CONTROL_PROFILE:
+            self.send_reply(writer, with_error=not self.enable_profiling(), reply_type=FRAME_CONTROL)
+            return
+
+        status = json.dumps(self.get_status()).encode()
+        self.send_reply(writer, reply_type=FRAME_CONTROL)
+        writer.write(len(status).to_bytes(4, byteorder='little') + status)
+
+    async def _read_data_cmd(self, writer, frames, data_index, reply_type=None):
+        """
+        Waits for a data command from the client: preamble (7 bytes) + dataIndex + 32768 + checksum
+        A corrupted data command, or one with another dataIndex (e.g. a stale retransmission), is requested again with
+        an error reply with address 135, followed by the dataIndex expected (4 bytes, little endian), up to the maximum
+        number of retransmissions.
+        :param data_index: The dataIndex of the data command expected
+        :return: The data command as a Frame, None if the client finished the upload or False if the upload has to be
+            aborted (an error reply is sent in that case)
+        """
+        retransmissions = 0
+        while True:
+            frame = await frames.read_frame()
+            if frame is None:
+                return None
+            self._record_frame(frames, frame)
+
+            if frame.frame_type == FRAME_DATA and frame.is_valid():
+                received_index = int.from_bytes(frame.data[DATA_CMD_INDEX: DATA_CMD_INDEX + 4], byteorder='little')
+                if received_index == data_index:
+                    return frame
+
+            if retransmissions >= self._max_retransmissions:
+                self._log('upload_aborted', f'Data command {data_index} still not received after {retransmissions} '
+                          f'retransmissions, aborting the upload', logging.WARNING, data_index=data_index)
+                self._metrics['aborted_uploads'] += 1
+                self.send_reply(writer, with_error=True, reply_type=reply_type)
+                return False
+
+            retransmissions += 1
+            self._metrics['retransmissions'] += 1
+            self.send_reply(writer, with_error=True, reply_type=REPLY_RETRANSMIT)
+            writer.write(data_index.to_bytes(4, byteorder='little'))
+
+    def _send_metadata_to_device(self, metadata, data_block, file_metadata=None):
+        """
+        Sends the metadata command to the device.
+        :param metadata: The 16 bytes of metadata (sound index, size in samples, sample rate, data type)
+        :param data_block: The first block of sound data
+        :param file_metadata: (Optional) The 2048 bytes with the file metadata
+        """
         # NOTE: convert data before sending to board (only needed until new firmware is ready)
         int32_size = np.dtype(np.int32).itemsize
         # Metadata command length: 'c' 'm' 'd' '0x80' + random + metadata + 32768 + 2048 + 'f'
         metadata_size = 4 * int32_size
         data_size = 32768
-        data_index = preamble_size + metadata_size
         file_metadata_size = 2048
-        file_metadata_index = data_index + data_size
 
         metadata_cmd_header_size = 4 + int32_size + metadata_size
         metadata_cmd = np.zeros(metadata_cmd_header_size + data_size + file_metadata_size + 1, dtype=np.int8)
@@ -221,123 +479,511 @@ class SoundCardTCPServer(object):
         metadata_cmd[0] = ord('c')
         metadata_cmd[1] = ord('m')
         metadata_cmd[2] = ord('d')
-        metadata_cmd[3] = 0x80
+        metadata_cmd[3:4] = np.array([0x80], dtype=np.uint8).view(np.int8)
         metadata_cmd[-1] = ord('f')
 
         rand_val = np.random.randint(-32768, 32768, size=1, dtype=np.int32)
         # copy that random data
         metadata_cmd[4: 4 + int32_size] = rand_val.view(np.int8)
         # metadata
-        metadata_cmd[8: 8 + (metadata_size)] = np.frombuffer(complete_header[metadata_index: metadata_index + metadata_size], dtype=np.int8)
+        metadata_cmd[8: 8 + (metadata_size)] = np.frombuffer(metadata, dtype=np.int8)
 
         # add first data block of data to the metadata_cmd
-        data_cmd_size = 7 + 4 + 32768 + 1
         metadata_cmd_data_index = metadata_cmd_header_size
-        if with_data is False:
+        metadata_cmd[metadata_cmd_data_index: metadata_cmd_data_index + len(data_block)] = np.frombuffer(data_block, dtype=np.int8)
+
+        # add user metadata (2048 bytes) to metadata_cmd
+        if file_metadata is not None:
+            user_metadata_index = metadata_cmd_data_index + data_size
+            metadata_cmd[user_metadata_index: user_metadata_index + file_metadata_size] = np.frombuffer(file_metadata, dtype=np.int8)
+
+        # send info to board
+        self._device.send_command(metadata_cmd.tobytes(), rand_val, is_metadata=True)
+
+    def _send_data_block_to_device(self, index_bytes, data_block, data_cmd=None):
+        """
+        Sends a data command to the device.
+        :param index_bytes: The dataIndex (4 bytes) received from the client
+        :param data_block: The block of sound data (up to 32768 bytes)
+        :param data_cmd: (Optional) Buffer for the command, for callers outside the event loop (by default, the one of
+            the upload in progress)
+        """
+        int32_size = self._int32_size
+        if data_cmd is None:
+            data_cmd = self._data_cmd
+
+        # it has to be as an np.array of int32 and later get a view as int8s
+        rand_val = np.random.randint(-32768, 32768, size=1, dtype=np.int32)
+        # copy that random data
+        data_cmd[4: 4 + int32_size] = rand_val.view(np.int8)
+
+        # write dataIndex to the data_cmd
+        data_cmd[8: 8 + int32_size] = np.frombuffer(index_bytes, dtype=np.int8)
+
+        # write data from chunk to cmd
+        data_cmd[self._data_cmd_data_index: self._data_cmd_data_index + len(data_block)] = np.frombuffer(data_block, dtype=np.int8)
+
+        # send data to device
+        self._device.send_command(data_cmd.tobytes(), rand_val, data_size=len(data_block))
+
+    async def _wait_for_device_slot(self):
+        """
+        Waits, without blocking the event loop, until the device takes the next command without blocking (the ring
+        buffer of the driver process might be full).
+        """
+        if not self._device.wait_for_slot(blocking=False):
+            await asyncio.get_event_loop().run_in_executor(None, self._device.wait_for_slot)
+
+    async def _recv_data(self, writer, frames, header):
+        initial_time = time.time()
+        layout = header.layout
+        complete_header = header.data
+
+        self.set_reply_type(header.frame_type)
+        if not header.is_valid():
+            self.send_reply(writer, with_error=True)
+            return
+
+        # the sound card might still be opening (e.g., the server was just started)
+        if not await self._wait_for_device_ready():
+            self._log('device_unavailable', 'Sound card not available, refusing upload', logging.WARNING)
+            self.send_reply(writer, with_error=True)
+            return
+        # with the driver process, it waits for the process to open the device (e.g. after it was started again)
+        await asyncio.get_event_loop().run_in_executor(None, self._device.wait_for_connection)
+        # failures of the commands of an upload that was aborted aren't reported to this one (the device might also
+        # be recovered between uploads, or wait for a free slot of the driver process)
+        await asyncio.get_event_loop().run_in_executor(None, self._device.start_session)
+
+        if layout.source_rate_index is not None:
+            return await self._recv_resampled_data(writer, frames, header, initial_time)
+
+        # get total number of commands to send to the board
+        sound_file_size_in_samples = np.frombuffer(complete_header[layout.metadata_index + 4: layout.metadata_index + 4 + 4], dtype=np.int32)[0]
+        commands_to_send = self._get_total_commands_to_send(sound_file_size_in_samples)
+
+        if layout.with_data is False:
             # send reply to client (to trigger the client to send the first data block)
             self.send_reply(writer)
 
             # await reply from client
-            try:
-                chunk = await stream.readexactly(data_cmd_size)
-            except IncompleteReadError:
-                return
-
-            # calculate checksum for verification
-            checksum = self._calc_checksum(chunk[:-1])
-
-            # if checksum is different, send reply with error
-            if checksum != chunk[-1]:
-                self.set_reply_type(132)
-                self.send_reply(writer, with_error=True)
+            chunk = await self._read_data_cmd(writer, frames, 0, reply_type=FRAME_DATA)
+            if not chunk:
                 return
 
             # get data block from data_cmd and write it to the current "header"
-            data_block = chunk[7 + int32_size: 7 + int32_size + 32768]
+            data_block = chunk.data[DATA_CMD_BLOCK_INDEX: DATA_CMD_BLOCK_INDEX + DATA_BLOCK_SIZE]
         else:
-            data_block = complete_header[data_index: data_index + data_size]
+            data_block = complete_header[layout.data_index: layout.data_index + DATA_BLOCK_SIZE]
 
-        metadata_cmd[metadata_cmd_data_index: metadata_cmd_data_index + data_size] = np.frombuffer(data_block, dtype=np.int8)
+        file_metadata = None
+        if layout.with_file_metadata is True:
+            file_metadata = complete_header[layout.file_metadata_index: layout.file_metadata_index + FILE_METADATA_SIZE]
 
-        # add user metadata (2048 bytes) to metadata_cmd
-        if with_file_metadata is True:
-            user_metadata_index = metadata_cmd_data_index + data_size
-            data_block = complete_header[file_metadata_index: file_metadata_index + file_metadata_size]
-            metadata_cmd[user_metadata_index: user_metadata_index + file_metadata_size] = np.frombuffer(data_block, dtype=np.int8)
-
-        # send info to board
-        start = time.time()
-
-        self._send_data_to_device(metadata_cmd.tobytes(), rand_val, 1000)
+        await self._wait_for_device_slot()
+        self._send_metadata_to_device(complete_header[layout.metadata_index: layout.metadata_index + METADATA_SIZE], data_block, file_metadata)
 
         # if reached here, send ok reply to client
         self.send_reply(writer)
 
         # init progress bar
-        pbar = tqdm(total=commands_to_send, unit_scale=False, unit=" packets")
+        pbar = self._create_progress(commands_to_send)
         pbar.update()
         # because we already got the first "data_cmd" from the client
-        if with_data is False:
+        if layout.with_data is False:
             pbar.update()
 
-        chunk_sending_timings = []
+        chunks_sent = 0
 
         # update reply type for the data commands
-        self.set_reply_type(132)
+        self.set_reply_type(FRAME_DATA)
 
-        while True:
-            try:
-                chunk = await stream.readexactly(data_cmd_size)
-            except IncompleteReadError:
-                break
+        # the progress bar is closed even if the client is evicted (DeadlineExceeded)
+        try:
+            while True:
+                chunk = await self._read_data_cmd(writer, frames, chunks_sent + 1)
+                if chunk is None:
+                    break
+                if chunk is False:
+                    self.clear_data()
+                    return
+
+                # send to board
+                await self._wait_for_device_slot()
+                self._send_data_block_to_device(chunk.data[DATA_CMD_INDEX: DATA_CMD_BLOCK_INDEX], chunk.data[DATA_CMD_BLOCK_INDEX: DATA_CMD_BLOCK_INDEX + DATA_BLOCK_SIZE])
+                chunks_sent += 1
+
+                self.send_reply(writer)
+
+                # update progress bar
+                pbar.update()
+        finally:
+            pbar.close()
+
+        if chunks_sent + 1 < commands_to_send:
+            self._refuse_truncated_upload(writer, chunks_sent + 1, commands_to_send)
+            self.clear_data()
+            return
 
-            # calculate checksum for verification
-            checksum = self._calc_checksum(chunk[:-1])
+        # wait for the commands still queued to the device (when it is driven by another process)
+        await asyncio.get_event_loop().run_in_executor(None, self._device.flush)
+        writer.write('OK'.encode())
 
-            # if checksum is different, send reply with error
-            if checksum != chunk[-1]:
-                self.send_reply(writer, with_error=True)
-                continue
+        self._report_upload(initial_time, chunks_sent + 1, frame_type=header.frame_type)
+
+        self.clear_data()
+        return chunks_sent + 1
+
+    def _create_resampled_upload(self, header):
+        """
+        Reads the rates of an upload that has to be converted to the sample rate of the sound card. The sample rate in
+        the metadata is the card's, the data is sent at the source rate that follows the metadata.
+        :return: (ResampledUpload, metadata for the device with the size of the converted sound), or (None, None) if
+            the header isn't valid
+        """
+        layout = header.layout
+        metadata = np.frombuffer(header.data[layout.metadata_index: layout.metadata_index + METADATA_SIZE], dtype=np.int32).copy()
+        source_rate = int(np.frombuffer(header.data[layout.source_rate_index: layout.source_rate_index + SOURCE_RATE_SIZE], dtype=np.int32)[0])
+        try:
+            upload = ResampledUpload(source_rate, int(metadata[2]), int(metadata[1]), int(metadata[3]))
+        except ValueError as e:
+            self._log('upload_refused', f'Refusing upload: {e}', logging.WARNING)
+            return None, None
+        metadata[1] = upload.total_samples
+        return upload, metadata.tobytes()
+
+    async def _recv_resampled_data(self, writer, frames, header, initial_time):
+        """
+        Receives an upload at the source sample rate and writes it to the device at the card's sample rate. The data
+        commands for the device are sent as soon as enough converted data is available, so they don't match the ones
+        received from the client.
+        """
+        layout = header.layout
+        upload, metadata = self._create_resampled_upload(header)
+        if upload is None:
+            self.send_reply(writer, with_error=True)
+            return
+        # the header is a view on the receive buffer, which is reused for the next frames
+        file_metadata = bytes(header.data[layout.file_metadata_index: layout.file_metadata_index + FILE_METADATA_SIZE])
+
+        # send reply to client (to trigger the client to send the first data block)
+        self.send_reply(writer)
 
-            start = time.time()
+        pbar = self._create_progress(upload.commands_to_send)
+        blocks_sent = 0
+        chunks_received = 0
 
-            # send to board
-            # it has to be as an np.array of int32 and later get a view as int8s
-            rand_val = np.random.randint(-32768, 32768, size=1, dtype=np.int32)
-            # copy that random data
-            self._data_cmd[4: 4 + int32_size] = rand_val.view(np.int8)
+        # update reply type for the data commands
+        self.set_reply_type(FRAME_DATA)
 
-            # write dataIndex to the data_cmd
-            self._data_cmd[8: 8 + int32_size] = np.frombuffer(chunk[7:7 + int32_size], dtype=np.int32).view(np.int8)
+        try:
+            while True:
+                chunk = await self._read_data_cmd(writer, frames, chunks_received)
+                if chunk is None:
+                    break
+                if chunk is False:
+                    self.clear_data()
+                    return
+                chunks_received += 1
+
+                blocks = upload.add_block(chunk.data[DATA_CMD_BLOCK_INDEX: DATA_CMD_BLOCK_INDEX + DATA_BLOCK_SIZE])
+                blocks_sent = await self._send_resampled_blocks(blocks, blocks_sent, metadata, file_metadata)
+                self.send_reply(writer)
+                pbar.update(len(blocks))
+
+            if not upload.complete:
+                self._refuse_truncated_upload(writer, chunks_received, upload.source_commands)
+                self.clear_data()
+                return
 
-            # write data from chunk to cmd
-            data_block = chunk[7 + int32_size: 7 + int32_size + 32768]
-            self._data_cmd[self._data_cmd_data_index: self._data_cmd_data_index + len(data_block)] = np.frombuffer(data_block, dtype=np.int8)
+            blocks = upload.finish()
+            if blocks_sent == 0 and not blocks:
+                blocks = [bytes(DATA_BLOCK_SIZE)]
+            blocks_sent = await self._send_resampled_blocks(blocks, blocks_sent, metadata, file_metadata)
+            pbar.update(len(blocks))
+        finally:
+            pbar.close()
 
-            start = time.time()
+        await asyncio.get_event_loop().run_in_executor(None, self._device.flush)
+        writer.write('OK'.encode())
 
-            # send data to device
-            self._send_data_to_device(self._data_cmd.tobytes(), rand_val)
+        self._report_upload(initial_time, blocks_sent, frame_type=header.frame_type)
 
-            chunk_sending_timings.append(time.time() - start)
+        self.clear_data()
+        return blocks_sent
 
-            self.send_reply(writer)
+    async def _send_resampled_blocks(self, blocks, blocks_sent, metadata, file_metadata):
+        """
+        Sends converted blocks to the device, the first one in the metadata command.
+        :return: The number of blocks sent so far
+        """
+        for block in blocks:
+            await self._wait_for_device_slot()
+            if blocks_sent == 0:
+                self._send_metadata_to_device(metadata, block, file_metadata)
+            else:
+                self._send_data_block_to_device(blocks_sent.to_bytes(4, byteorder='little'), block)
+            blocks_sent += 1
+        return blocks_sent
+
+    async def _stage_data(self, writer, frames, header, slot=None):
+        """
+        Receives an upload into the spool, without waiting for the device. The client gets the same replies as in a
+        direct upload, and the final 'OK' is followed by the job id (4 bytes, little endian).
+        :param slot: (Optional) SoundSlot of the sound cache that becomes resident once the job is written to the device
+        """
+        layout = header.layout
+        complete_header = header.data
+        frame_type = header.frame_type
 
-            # update progress bar
-            pbar.update()
+        if not header.is_valid():
+            self.send_reply(writer, with_error=True, reply_type=frame_type)
+            return
 
-        pbar.close()
+        if layout.source_rate_index is not None:
+            return await self._stage_resampled_data(writer, frames, header, slot)
 
-        writer.write('OK'.encode())
+        sound_file_size_in_samples = np.frombuffer(complete_header[layout.metadata_index + 4: layout.metadata_index + 4 + 4], dtype=np.int32)[0]
+        commands_to_send = self._get_total_commands_to_send(sound_file_size_in_samples)
 
-        total_time = time.time() - initial_time
-        bandwidth = (((32768 * len(chunk_sending_timings)) / total_time) * 8) / 2**20
-        print(f'Elapsed time: {int(round(total_time * 1000))} ms')
-        print(f'Bandwidth: {round(bandwidth, 1)} Mbit/s{os.linesep}')
+        wait_start = time.perf_counter()
+        job = await self._spool.allocate(frame_type, commands_to_send)
+        self._queue_waits.append(time.perf_counter() - wait_start)
+        self._metrics['uploads'] += 1
+        try:
+            job.write_metadata(complete_header[layout.metadata_index: layout.metadata_index + METADATA_SIZE])
+            if layout.with_data is True:
+                job.write_first_block(complete_header[layout.data_index: layout.data_index + DATA_BLOCK_SIZE])
+            if layout.with_file_metadata is True:
+                job.write_file_metadata(complete_header[layout.file_metadata_index: layout.file_metadata_index + FILE_METADATA_SIZE])
+
+            if layout.with_data is False:
+                self.send_reply(writer, reply_type=frame_type)
+                chunk = await self._read_data_cmd(writer, frames, 0, reply_type=FRAME_DATA)
+                if not chunk:
+                    await self._spool.release(job)
+                    return
+                job.write_first_block(chunk.data[DATA_CMD_BLOCK_INDEX: DATA_CMD_BLOCK_INDEX + DATA_BLOCK_SIZE])
+
+            self.send_reply(writer, reply_type=frame_type)
+
+            while True:
+                chunk = await self._read_data_cmd(writer, frames, job.received + 1, reply_type=FRAME_DATA)
+                if chunk is None:
+                    break
+                if chunk is False:
+                    await self._spool.release(job)
+                    return
+
+                if not job.append_chunk(chunk.data[DATA_CMD_INDEX: DATA_CMD_BLOCK_INDEX], chunk.data[DATA_CMD_BLOCK_INDEX: DATA_CMD_BLOCK_INDEX + DATA_BLOCK_SIZE]):
+                    self.send_reply(writer, with_error=True, reply_type=FRAME_DATA)
+                    continue
+                self.send_reply(writer, reply_type=FRAME_DATA)
+        except BaseException:
+            await self._spool.release(job)
+            raise
+
+        if job.received + 1 < commands_to_send:
+            self._refuse_truncated_upload(writer, job.received + 1, commands_to_send, reply_type=FRAME_DATA)
+            await self._spool.release(job)
+            return
 
-        self.clear_data()
+        self._commit_job(job, slot)
+        writer.write('OK'.encode() + job.job_id.to_bytes(4, byteorder='little'))
+        self._log('upload_staged', f'Upload staged as job {job.job_id} ({job.received + 1} packets)',
+                  job_id=job.job_id, frame_type=frame_type, packets=job.received + 1)
+        return job.received + 1
+
+    async def _stage_resampled_data(self, writer, frames, header, slot=None):
+        """
+        Receives an upload at the source sample rate into the spool, staging the blocks already converted to the
+        card's sample rate.
+        """
+        layout = header.layout
+        frame_type = header.frame_type
+        upload, metadata = self._create_resampled_upload(header)
+        if upload is None:
+            self.send_reply(writer, with_error=True, reply_type=frame_type)
+            return
+        file_metadata = bytes(header.data[layout.file_metadata_index: layout.file_metadata_index + FILE_METADATA_SIZE])
+
+        wait_start = time.perf_counter()
+        job = await self._spool.allocate(frame_type, upload.commands_to_send)
+        self._queue_waits.append(time.perf_counter() - wait_start)
+        self._metrics['uploads'] += 1
+        try:
+            job.write_metadata(metadata)
+            job.write_file_metadata(file_metadata)
+            self.send_reply(writer, reply_type=frame_type)
+
+            blocks_staged = 0
+            chunks_received = 0
+            while True:
+                chunk = await self._read_data_cmd(writer, frames, chunks_received, reply_type=FRAME_DATA)
+                if chunk is None:
+                    break
+                if chunk is False:
+                    await self._spool.release(job)
+                    return
+                chunks_received += 1
+
+                blocks = upload.add_block(chunk.data[DATA_CMD_BLOCK_INDEX: DATA_CMD_BLOCK_INDEX + DATA_BLOCK_SIZE])
+                blocks_staged = self._stage_resampled_blocks(job, blocks, blocks_staged)
+                self.send_reply(writer, reply_type=FRAME_DATA)
+
+            if not upload.complete:
+                self._refuse_truncated_upload(writer, chunks_received, upload.source_commands,
+                                              reply_type=FRAME_DATA)
+                await self._spool.release(job)
+                return
+
+            blocks = upload.finish()
+            if blocks_staged == 0 and not blocks:
+                blocks = [bytes(DATA_BLOCK_SIZE)]
+            self._stage_resampled_blocks(job, blocks, blocks_staged)
+        except BaseException:
+            await self._spool.release(job)
+            raise
+
+        self._commit_job(job, slot)
+        writer.write('OK'.encode() + job.job_id.to_bytes(4, byteorder='little'))
+        self._log('upload_staged', f'Upload staged as job {job.job_id} ({job.received + 1} packets)',
+                  job_id=job.job_id, frame_type=frame_type, packets=job.received + 1)
+        return job.received + 1
+
+    def _refuse_truncated_upload(self, writer, received, expected, reply_type=None):
+        """
+        Replies with an error to a client that finished the upload before sending all the data commands, so that the
+        sound isn't reported (nor cached) as loaded.
+        """
+        self._log('upload_truncated', f'Upload finished after {received} of {expected} packets, refusing it',
+                  logging.WARNING, received=received, expected=expected)
+        self._metrics['truncated_uploads'] += 1
+        self.send_reply(writer, with_error=True, reply_type=reply_type)
+
+    def _commit_job(self, job, slot):
+        self._spool.commit(job)
+        if slot is not None:
+            self._sounds.stage(slot)
+            self._slot_jobs[job.job_id] = slot
+
+    def _stage_resampled_blocks(self, job, blocks, blocks_staged):
+        """
+        Stages converted blocks, the first one in the place of the first data block of the header.
+        :return: The number of blocks staged so far
+        """
+        for block in blocks:
+            if blocks_staged == 0:
+                job.write_first_block(block)
+            else:
+                job.append_chunk(blocks_staged.to_bytes(4, byteorder='little'), block)
+            blocks_staged += 1
+        return blocks_staged
+
+    async def _drain_spool(self):
+        """
+        Writes the staged jobs to the device, one at a time and in the order they were received.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            job = await self._spool.get_ready()
+            drained = False
+            error = None
+            # a failed job is written again before the next ones, which might overwrite the same sound index
+            while not drained and job.attempts < self._drain_attempts:
+                if job.attempts > 0:
+                    await asyncio.sleep(1)
+                await self._device_ready.wait()
+                async with self._sem:
+                    try:
+                        await loop.run_in_executor(None, self._drain_job, job)
+                        drained = True
+                    except Exception as e:
+                        error = str(e) or type(e).__name__
+                        job.attempts += 1
+                        # back to ready, so that it is written again after a restart of the server
+                        job.set_state(JOB_READY)
+                        self._log('job_failed', f'Exception while writing job {job.job_id} to the device (attempt '
+                                  f'{job.attempts} of {self._drain_attempts}) with message {e}', logging.ERROR,
+                                  job_id=job.job_id, attempt=job.attempts)
+
+            if drained:
+                await self._spool.release(job)
+            else:
+                self._metrics['failed_jobs'] += 1
+                await self._spool.fail(job, error)
+
+            slot = self._slot_jobs.pop(job.job_id, None)
+            if slot is not None:
+                if drained:
+                    self._sounds.commit(slot)
+                else:
+                    self._sounds.release(slot)
+
+    def _drain_job(self, job):
+        error = None
+        try:
+            self._write_job(job)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        # raised outside of the except block, so that the traceback doesn't keep views on the mapped file of the job,
+        # which couldn't be unmapped then
+        if error is not None:
+            raise AssertionError(error)
+
+    def _write_job(self, job):
+        self._device.wait_for_connection()
+        self._device.start_session()
+
+        initial_time = time.time()
+        job.map()
+        job.set_state(JOB_DRAINING)
+
+        file_metadata = job.get_file_metadata() if job.frame_type != 130 else None
+        self._send_metadata_to_device(job.get_metadata(), job.get_first_block(), file_metadata)
+
+        # the buffers of the event loop (e.g. the reply) aren't touched from this thread
+        data_cmd = self._create_data_cmd()
+        for position in range(job.received):
+            self._send_data_block_to_device(*job.get_chunk(position), data_cmd=data_cmd)
+        self._device.flush()
+
+        self._report_upload(initial_time, job.received + 1, f'Job {job.job_id} written to the device. ',
+                            event='job_written', job_id=job.job_id, frame_type=job.frame_type)
+
+    def _log(self, event, message, level=logging.INFO, **fields):
+        """
+        Reports an event of the server: to the event log in service mode, otherwise printed to the console.
+        :param fields: Values of the event, only written to the event log
+        """
+        if self._events is not None:
+            self._events.emit(event, message, level, **fields)
+        else:
+            print(message)
+
+    def _create_progress(self, total):
+        """
+        :return: Progress bar of an upload with 'total' packets (a NullProgress in service mode)
+        """
+        if self._events is not None:
+            return NullProgress()
+        from tqdm import tqdm
+        return tqdm(total=total, unit_scale=False, unit=" packets")
 
-        return preamble_bytes
+    def _report_upload(self, initial_time, chunks_sent, prefix='', event='upload', **fields):
+        """
+        Reports the duration and bandwidth of an upload written to the device, as a summary record in service mode.
+        :param chunks_sent: Number of blocks of data written to the device
+        """
+        total_time = time.time() - initial_time
+        bandwidth = (((32768 * chunks_sent) / total_time) * 8) / 2**20
+        if self._events is None:
+            print(f'{prefix}Elapsed time: {int(round(total_time * 1000))} ms')
+            print(f'Bandwidth: {round(bandwidth, 1)} Mbit/s{os.linesep}')
+            return
+        self._events.emit(event, f'{prefix}{chunks_sent} packets in {int(round(total_time * 1000))} ms',
+                          blocks=chunks_sent, elapsed_ms=round(total_time * 1000, 1),
+                          bandwidth_mbps=round(bandwidth, 1), **fields)
 
     def _get_timestamp(self):
         curr = time.time()
@@ -357,22 +1003,109 @@ class SoundCardTCPServer(object):
                 1 if ((sound_file_size_in_samples * 4) % 32768) != 0 else 0))
 
     def _calc_checksum(self, data):
-        return sum(data) & 0xFF
+        return calc_checksum(data)
 
-    def _wait_for_device_connection(self):
-        self._conn_open = False
-        while self.open() is False:
-            # wait a bit before trying again
-            time.sleep(1)
+    def send_reply(self, writer, with_error=False, reply_type=None):
+        # a reply with a specific type doesn't change the reply used by the session in progress
+        reply = self._reply
+        if reply_type is not None:
+            reply = self._reply.copy()
+            reply[2:3] = np.array([reply_type], dtype=np.uint8).view(np.int8)
 
-    def send_reply(self, writer, with_error=False):
         # send reply with error
-        self._reply[0] = 10 if with_error else 2
-        self._reply[5: 5 + 6] = self._get_timestamp()
-        checksum = self._calc_checksum(self._reply[:-1])
-        self._reply[-1] = np.array([checksum], dtype=np.int8)
-
-        writer.write(bytes(self._reply))
+        reply[0] = 10 if with_error else 2
+        reply[5: 5 + 6] = self._get_timestamp()
+        checksum = self._calc_checksum(reply[:-1].view(np.uint8))
+        reply[-1:] = np.array([checksum], dtype=np.uint8).view(np.int8)
+
+        writer.write(bytes(reply))
+
+
+def load_config(parser, path):
+    """
+    Reads a JSON config file with the options of the server, by the names of the command line options (e.g.
+    {"address": "0.0.0.0", "port": 9999, "spool-max-mb": 512, "service": true}).
+    :return: Dictionary with the options, to be used as defaults of the parser
+    """
+    with open(path) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        parser.error(f'the config file {path} must have a JSON object')
+
+    options = vars(parser.parse_args([]))
+    config = {key.replace('-', '_'): value for key, value in config.items()}
+    unknown = sorted(key for key in config if key not in options or key == 'config')
+    if unknown:
+        parser.error(f'unknown options in the config file {path}: {", ".join(unknown)}')
+    return config
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line options, with the defaults given by the config file of '--config'.
+    :param argv: (Optional) The arguments (by default, the ones of the command line)
+    :return: The options, as an argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description='Harp Sound card TCP Server')
+    parser.add_argument('--config', default=None, metavar='FILE',
+                        help='JSON file with options of the server (the command line options take precedence)')
+    parser.add_argument('--address', default='localhost', help='address where the server listens for requests')
+    parser.add_argument('--port', type=int, default=9999, help='port where the server listens for requests')
+    parser.add_argument('--spool-dir', default=None,
+                        help='stage uploads in this directory and write them to the sound card in the background')
+    parser.add_argument('--spool-max-jobs', type=int, default=8, help='maximum number of staged uploads')
+    parser.add_argument('--spool-max-mb', type=int, default=1024, help='maximum size of the staged uploads in MB')
+    parser.add_argument('--drain-attempts', type=int, default=3,
+                        help='times a staged upload is written to the sound card before giving up (default: 3)')
+    parser.add_argument('--device-wait', type=float, default=10.0,
+                        help='seconds an upload waits for the sound card to be available (default: 10)')
+    parser.add_argument('--device-process', action='store_true',
+                        help='drive the sound card from a separate process, fed through shared memory')
+    parser.add_argument('--device-slots', type=int, default=8,
+                        help='number of commands queued to the device process (default: 8)')
+    parser.add_argument('--sound-cache', default=None, metavar='FILE',
+                        help='load sounds by content (ensure frames), keeping the table of loaded sounds in FILE')
+    parser.add_argument('--sound-cache-first', type=int, default=2,
+                        help='first sound index used by the sound cache (default: 2)')
+    parser.add_argument('--sound-cache-last', type=int, default=31,
+                        help='last sound index used by the sound cache (default: 31)')
+    parser.add_argument('--max-retransmissions', type=int, default=3,
+                        help='times a corrupted data command is requested again before aborting the upload '
+                             '(default: 3)')
+    parser.add_argument('--event-loop', choices=['asyncio', 'uvloop'], default='asyncio',
+                        help='event loop implementation (uvloop has to be installed)')
+    parser.add_argument('--capture', default=None, metavar='FILE',
+                        help='record the frames received on each connection to FILE, to be replayed later')
+    parser.add_argument('--profile-dir', default=None,
+                        help='allow profiling the upload sessions (with SIGUSR1 or a control frame), writing the '
+                             'profiles to this directory')
+    parser.add_argument('--profile-sessions', type=int, default=1,
+                        help='number of sessions profiled each time profiling is enabled (default: 1)')
+    parser.add_argument('--profile-now', action='store_true', help='profile the first sessions after starting')
+    parser.add_argument('--handshake-timeout', type=float, default=10.0,
+                        help='seconds to receive the first frame of a connection (0 to disable, default: 10)')
+    parser.add_argument('--first-block-timeout', type=float, default=10.0,
+                        help='seconds to receive the first data command after the header (0 to disable, default: 10)')
+    parser.add_argument('--chunk-timeout', type=float, default=10.0,
+                        help='seconds to receive each of the next data commands (0 to disable, default: 10)')
+    parser.add_argument('--min-throughput-kbps', type=float, default=0,
+                        help='minimum throughput of the clients in KB/s (0 to disable, default)')
+    parser.add_argument('--throughput-grace', type=float, default=5.0,
+                        help='seconds waiting for a client before its throughput is checked (default: 5)')
+    parser.add_argument('--service', action='store_true',
+                        help='run headless: log structured events (JSON lines) from a background thread, with a '
+                             'summary of each upload, instead of printing to the console')
+    parser.add_argument('--log-file', default=None,
+                        help='file where the events are appended in service mode (default: stderr)')
+    parser.add_argument('--log-rate', type=float, default=10.0,
+                        help='maximum events per second of each kind in service mode (default: 10)')
+    parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], default='info',
+                        help='minimum level of the events logged in service mode (default: info)')
+    args = parser.parse_args(argv)
+    if args.config is not None:
+        parser.set_defaults(**load_config(parser, args.config))
+        args = parser.parse_args(argv)
+    return args
 
 
 if __name__ == "__main__":
@@ -382,15 +1115,59 @@ if __name__ == "__main__":
         # Call again
         loop.call_later(0.1, wakeup)
 
-    srv = SoundCardTCPServer("localhost", 9999)
-
-    loop = asyncio.SelectorEventLoop()
-    loop.call_later(0.1, wakeup)
+    args = parse_arguments()
+
+    event_log = None
+    if args.service:
+        event_log = EventLog(args.log_file, rate=args.log_rate, level=args.log_level.upper())
+        event_log.start()
+        # whatever other modules print (e.g. the device) goes to the log as well, never to the console
+        sys.stdout = LogWriter(event_log)
+        sys.stderr = LogWriter(event_log, 'error_output', logging.WARNING)
+
+    deadlines = SessionDeadlines(handshake=args.handshake_timeout,
+                                 first_block=args.first_block_timeout,
+                                 chunk_gap=args.chunk_timeout,
+                                 min_throughput=args.min_throughput_kbps * 1024,
+                                 throughput_grace=args.throughput_grace)
+
+    sound_cache = None
+    if args.sound_cache is not None:
+        sound_cache = SoundCache(args.sound_cache_first, args.sound_cache_last, args.sound_cache)
+
+    srv = SoundCardTCPServer(args.address, args.port, spool_dir=args.spool_dir, spool_max_jobs=args.spool_max_jobs,
+                             spool_max_bytes=args.spool_max_mb * 2**20, capture_path=args.capture,
+                             device_wait=args.device_wait, profile_dir=args.profile_dir,
+                             profile_sessions=args.profile_sessions, deadlines=deadlines,
+                             device_process=args.device_process, device_slots=args.device_slots,
+                             sound_cache=sound_cache, max_retransmissions=args.max_retransmissions,
+                             event_log=event_log, drain_attempts=args.drain_attempts)
+    if args.profile_now:
+        srv.enable_profiling()
+
+    loop = None
+    if args.event_loop == 'uvloop':
+        try:
+            import uvloop
+            loop = uvloop.new_event_loop()
+        except ImportError:
+            print('uvloop is not installed, using the default event loop')
+    if loop is None:
+        loop = asyncio.SelectorEventLoop()
+        if sys.platform == 'win32':
+            loop.call_later(0.1, wakeup)
     asyncio.set_event_loop(loop)
-    sem = BoundedSemaphore(value=1, loop=loop)
+
+    if args.profile_dir is not None and hasattr(signal, 'SIGUSR1'):
+        loop.add_signal_handler(signal.SIGUSR1, srv.enable_profiling)
 
     try:
-        loop.run_until_complete(srv.start_server(sem))
+        loop.run_until_complete(srv.start_server())
     except KeyboardInterrupt as k:
         print(f'Event captured: {k}')
+        srv.stop_capture()
         srv.close()
+    finally:
+        if event_log is not None:
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+            event_log.stop()
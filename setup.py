@@ -5,7 +5,7 @@ from setuptools import setup, find_packages
 
 requirements = [
     'pyusb>=1.0.2',
-    'numpy',
+    'numpy>=1.20',
     'tqdm'
 ]
 
@@ -0,0 +1,204 @@
+import os
+import collections
+import json
+import time
+
+
+SLOT_LOADING = 0
+SLOT_STAGED = 1
+SLOT_RESIDENT = 2
+
+SLOT_STATES = ('loading', 'staged', 'resident')
+
+
+class SoundCacheFull(Exception):
+    """
+    Raised when a sound has to be loaded but every slot of the cache is pinned or being loaded.
+    """
+
+
+class SoundSlot(object):
+    """
+    A sound index of the sound card managed by the SoundCache, with the content hash of the sound it holds.
+    """
+    def __init__(self, index, content_hash, pinned=False, state=SLOT_LOADING, loaded=None, hits=0):
+        self.index = index
+        self.content_hash = content_hash
+        self.pinned = pinned
+        self.state = state
+        self.loaded = loaded
+        self.hits = hits
+
+    def as_dict(self):
+        return {
+            'index': self.index,
+            'content_hash': self.content_hash.hex(),
+            'state': SLOT_STATES[self.state],
+            'pinned': self.pinned,
+            'loaded': self.loaded,
+            'hits': self.hits,
+        }
+
+
+class SoundCache(object):
+    """
+    Keeps track of the sounds loaded in a range of sound indexes of the sound card, by the content hash given by the
+    clients, so that a sound that is already loaded isn't uploaded again.
+
+    When a sound isn't loaded, it is given a free index or, if there's none, the least recently used index that isn't
+    pinned. A slot only becomes resident once the sound was completely written to the sound card, and the table of
+    resident slots is saved to a file (if given) whenever it changes, as the sound card keeps its sounds after the
+    server is restarted.
+    """
+    def __init__(self, first_index=2, last_index=31, path=None):
+        """
+        :param first_index: (Optional) First sound index managed by the cache
+        :param last_index: (Optional) Last sound index managed by the cache (inclusive)
+        :param path: (Optional) JSON file where the table of resident slots is kept between runs
+        """
+        if first_index > last_index:
+            raise ValueError(f'Invalid range of sound indexes {first_index}-{last_index}')
+        self.first_index = first_index
+        self.last_index = last_index
+        self.path = path
+        # slots in use, from the least to the most recently used
+        self._slots = collections.OrderedDict()
+        self._resident = {}
+        self._metrics = collections.Counter()
+
+    def load(self):
+        """
+        Loads the table of resident slots saved by a previous run.
+        :return: The number of resident slots
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)['slots']
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Ignoring the sound cache in {self.path}: {e}')
+            return 0
+
+        for entry in entries:
+            index = entry['index']
+            if not self.first_index <= index <= self.last_index or index in self._slots:
+                continue
+            slot = SoundSlot(index, bytes.fromhex(entry['content_hash']), entry.get('pinned', False), SLOT_RESIDENT,
+                             entry.get('loaded'), entry.get('hits', 0))
+            self._slots[index] = slot
+            self._resident[slot.content_hash] = slot
+        return len(self._resident)
+
+    def save(self):
+        if self.path is None:
+            return
+        entries = [slot.as_dict() for slot in self._slots.values() if slot.state == SLOT_RESIDENT]
+        # write to a temporary file first, so that a crash never leaves a partial table
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'slots': entries}, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def ensure(self, content_hash, pin=False, unpin=False):
+        """
+        Looks for the slot with a sound, reserving one to load it if it isn't resident.
+
+        :param content_hash: Hash of the content of the sound (given by the client)
+        :param pin: (Optional) If True, the slot is pinned and never evicted
+        :param unpin: (Optional) If True, the slot can be evicted again
+        :return: (SoundSlot, True if the sound is already loaded). When it isn't, the sound has to be written to the
+            slot's index and the slot committed (or released if that fails)
+        :raises SoundCacheFull: If every slot is pinned or being loaded
+        """
+        slot = self._resident.get(content_hash)
+        if slot is not None:
+            self._slots.move_to_end(slot.index)
+            slot.hits += 1
+            self._metrics['hits'] += 1
+            if pin or unpin:
+                slot.pinned = pin
+                self.save()
+            return slot, True
+
+        index = self._get_free_index()
+        if index is None:
+            index = self._evict()
+        slot = self._slots[index] = SoundSlot(index, content_hash, pinned=pin)
+        self._metrics['misses'] += 1
+        return slot, False
+
+    def _get_free_index(self):
+        for index in range(self.first_index, self.last_index + 1):
+            if index not in self._slots:
+                return index
+        return None
+
+    def _evict(self):
+        for slot in self._slots.values():
+            if slot.state == SLOT_RESIDENT and not slot.pinned:
+                self._remove(slot)
+                self._metrics['evictions'] += 1
+                # the sound is about to be overwritten, so it can't be in the table anymore
+                self.save()
+                return slot.index
+        raise SoundCacheFull(f'All the {self.last_index - self.first_index + 1} slots are pinned or being loaded')
+
+    def _remove(self, slot):
+        del self._slots[slot.index]
+        if self._resident.get(slot.content_hash) is slot:
+            del self._resident[slot.content_hash]
+
+    def stage(self, slot):
+        """
+        Marks a slot as staged: its sound was received but is still waiting to be written to the sound card.
+        """
+        if self._slots.get(slot.index) is slot:
+            slot.state = SLOT_STAGED
+
+    def commit(self, slot):
+        """
+        Marks a slot as resident, once its sound was completely written to the sound card.
+        :return: False if the slot was invalidated in the meantime
+        """
+        if self._slots.get(slot.index) is not slot:
+            return False
+        # the same sound might have been loaded to another slot by a concurrent client, which is now free
+        previous = self._resident.get(slot.content_hash)
+        if previous is not None and previous is not slot:
+            slot.pinned = slot.pinned or previous.pinned
+            self._remove(previous)
+
+        slot.state = SLOT_RESIDENT
+        slot.loaded = time.time()
+        self._resident[slot.content_hash] = slot
+        self._slots.move_to_end(slot.index)
+        self.save()
+        return True
+
+    def release(self, slot):
+        """
+        Frees a slot whose sound couldn't be loaded.
+        """
+        if self._slots.get(slot.index) is slot and slot.state != SLOT_RESIDENT:
+            del self._slots[slot.index]
+
+    def invalidate(self, index):
+        """
+        Forgets the sound in an index, when it is written by an upload that doesn't go through the cache.
+        """
+        slot = self._slots.get(index)
+        if slot is None:
+            return
+        self._remove(slot)
+        if slot.state == SLOT_RESIDENT:
+            self.save()
+
+    def as_dict(self):
+        return {
+            'first_index': self.first_index,
+            'last_index': self.last_index,
+            'free': self.last_index - self.first_index + 1 - len(self._slots),
+            'slots': [slot.as_dict() for slot in self._slots.values()],
+            **self._metrics,
+        }
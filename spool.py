@@ -0,0 +1,302 @@
+import os
+import asyncio
+import collections
+import mmap
+import struct
+import time
+
+
+# Staging file layout
+#   header (64 bytes): magic, version, state, job id, frame type, commands to send, received chunks, creation time
+#   metadata (16 bytes) + first data block (32768 bytes) + file metadata (2048 bytes)
+#   data commands received from the client, each as dataIndex (4 bytes) + data block (32768 bytes)
+SPOOL_MAGIC = b'HSPL'
+SPOOL_VERSION = 1
+SPOOL_HEADER = struct.Struct('<4sHHQIIId')
+SPOOL_HEADER_SIZE = 64
+
+METADATA_SIZE = 16
+DATA_BLOCK_SIZE = 32768
+FILE_METADATA_SIZE = 2048
+METADATA_OFFSET = SPOOL_HEADER_SIZE
+FIRST_BLOCK_OFFSET = METADATA_OFFSET + METADATA_SIZE
+FILE_METADATA_OFFSET = FIRST_BLOCK_OFFSET + DATA_BLOCK_SIZE
+CHUNKS_OFFSET = FILE_METADATA_OFFSET + FILE_METADATA_SIZE
+CHUNK_SIZE = 4 + DATA_BLOCK_SIZE
+
+JOB_WRITING = 0
+JOB_READY = 1
+JOB_DRAINING = 2
+
+
+class SpoolJob(object):
+    """
+    An upload staged in a memory-mapped file, waiting to be written to the sound card.
+    """
+    def __init__(self, path, job_id, frame_type=0, commands_to_send=0, state=JOB_WRITING, received=0, created=None):
+        self.path = path
+        self.job_id = job_id
+        self.frame_type = frame_type
+        self.commands_to_send = commands_to_send
+        self.state = state
+        self.received = received
+        self.created = created if created is not None else time.time()
+        # times writing the job to the sound card failed
+        self.attempts = 0
+        self._file = None
+        self._map = None
+
+    @property
+    def size(self):
+        return get_job_file_size(self.commands_to_send)
+
+    def map(self):
+        if self._map is None:
+            self._file = open(self.path, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), self.size)
+        return self._map
+
+    def unmap(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+            self._map = None
+            self._file = None
+
+    def write_header(self):
+        SPOOL_HEADER.pack_into(self.map(), 0, SPOOL_MAGIC, SPOOL_VERSION, self.state, self.job_id, self.frame_type,
+                               self.commands_to_send, self.received, self.created)
+
+    def set_state(self, state):
+        self.state = state
+        self.write_header()
+        self._map.flush(0, mmap.PAGESIZE)
+
+    def write_metadata(self, metadata):
+        self.map()[METADATA_OFFSET: METADATA_OFFSET + METADATA_SIZE] = metadata
+
+    def write_first_block(self, data_block):
+        self.map()[FIRST_BLOCK_OFFSET: FIRST_BLOCK_OFFSET + len(data_block)] = data_block
+
+    def write_file_metadata(self, file_metadata):
+        self.map()[FILE_METADATA_OFFSET: FILE_METADATA_OFFSET + len(file_metadata)] = file_metadata
+
+    def append_chunk(self, index_bytes, data_block):
+        """
+        Stages a data command received from the client.
+        :return: False if the job has no space left for more data commands
+        """
+        if self.received >= self.commands_to_send:
+            return False
+        offset = CHUNKS_OFFSET + self.received * CHUNK_SIZE
+        m = self.map()
+        m[offset: offset + 4] = index_bytes
+        m[offset + 4: offset + 4 + len(data_block)] = data_block
+        self.received += 1
+        return True
+
+    def get_metadata(self):
+        return memoryview(self.map())[METADATA_OFFSET: METADATA_OFFSET + METADATA_SIZE]
+
+    def get_first_block(self):
+        return memoryview(self.map())[FIRST_BLOCK_OFFSET: FIRST_BLOCK_OFFSET + DATA_BLOCK_SIZE]
+
+    def get_file_metadata(self):
+        return memoryview(self.map())[FILE_METADATA_OFFSET: FILE_METADATA_OFFSET + FILE_METADATA_SIZE]
+
+    def get_chunk(self, position):
+        """
+        :return: (dataIndex bytes, data block) of the data command staged at the given position
+        """
+        offset = CHUNKS_OFFSET + position * CHUNK_SIZE
+        view = memoryview(self.map())
+        return view[offset: offset + 4], view[offset + 4: offset + CHUNK_SIZE]
+
+    def as_dict(self):
+        return {
+            'job_id': self.job_id,
+            'state': ('writing', 'ready', 'draining')[self.state],
+            'frame_type': self.frame_type,
+            'commands_to_send': self.commands_to_send,
+            'received': self.received,
+            'created': self.created,
+            'attempts': self.attempts,
+        }
+
+
+def get_job_file_size(commands_to_send):
+    return CHUNKS_OFFSET + commands_to_send * CHUNK_SIZE
+
+
+def get_job_id(name):
+    """
+    :return: The job id in the name of a staging file (e.g. 'job-0000000003.spool' or 'free-job-0000000003.spool'),
+        or None if it isn't the name of a staging file
+    """
+    if name.startswith('free-'):
+        name = name[len('free-'):]
+    if not name.startswith('job-') or not name.endswith('.spool'):
+        return None
+    try:
+        return int(name[len('job-'): -len('.spool')])
+    except ValueError:
+        return None
+
+
+def read_job(path):
+    """
+    Reads the header of a staging file.
+    :return: The SpoolJob or None if the file isn't a valid staging file
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(SPOOL_HEADER.size)
+    except OSError:
+        return None
+    if len(header) != SPOOL_HEADER.size:
+        return None
+    magic, version, state, job_id, frame_type, commands_to_send, received, created = SPOOL_HEADER.unpack(header)
+    if magic != SPOOL_MAGIC or version != SPOOL_VERSION:
+        return None
+    if os.path.getsize(path) < get_job_file_size(commands_to_send):
+        return None
+    return SpoolJob(path, job_id, frame_type, commands_to_send, state, received, created)
+
+
+class Spool(object):
+    """
+    Bounded directory of staging files for the uploads received while the sound card is busy.
+
+    Uploads are written to memory-mapped files at network speed, and drained to the sound card by the server in the
+    order they were completed. Drained files are kept for reuse (up to the maximum number of jobs) instead of being
+    deleted, and the jobs ready to be drained survive a restart of the server.
+    """
+    def __init__(self, directory, max_jobs=8, max_bytes=1024 * 2**20):
+        """
+        :param directory: Directory where the staging files are kept
+        :param max_jobs: (Optional) Maximum number of jobs staged at the same time
+        :param max_bytes: (Optional) Maximum number of bytes used by the staged jobs. A single job larger than this
+            is still accepted when the spool is empty.
+        """
+        self.directory = directory
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self._jobs = {}
+        self._free_files = []
+        self._next_job_id = 1
+        self._used_bytes = 0
+        self._ready = asyncio.Queue()
+        self._space = asyncio.Condition()
+        # the last jobs that couldn't be written to the sound card, for the status
+        self._failed = collections.deque(maxlen=32)
+
+    def recover(self):
+        """
+        Loads the staging files left by a previous run. Jobs that were completely received are queued to be drained
+        again, partial ones are recycled (their clients never got the final reply).
+        :return: The recovered jobs, in the order they will be drained
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        recovered = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            # the job ids keep growing across runs, so that the clients never get the id of a previous job and the
+            # files of the new jobs (and their free files) don't take the names of the files left
+            job_id = get_job_id(name)
+            if job_id is not None:
+                self._next_job_id = max(self._next_job_id, job_id + 1)
+            if name.startswith('free-'):
+                self._free_files.append(path)
+                continue
+            if not name.startswith('job-'):
+                continue
+            job = read_job(path)
+            if job is None or job.state == JOB_WRITING:
+                self._recycle_file(path)
+                continue
+            recovered.append(job)
+
+        for job in sorted(recovered, key=lambda j: j.job_id):
+            job.state = JOB_READY
+            self._jobs[job.job_id] = job
+            self._used_bytes += job.size
+            self._ready.put_nowait(job)
+        return recovered
+
+    async def allocate(self, frame_type, commands_to_send):
+        """
+        Creates a new job, waiting for space in the spool if needed.
+        """
+        size = get_job_file_size(commands_to_send)
+        async with self._space:
+            await self._space.wait_for(lambda: self._has_space(size))
+            job_id = self._next_job_id
+            self._next_job_id += 1
+            path = os.path.join(self.directory, f'job-{job_id:010d}.spool')
+            if self._free_files:
+                os.replace(self._free_files.pop(), path)
+            with open(path, 'ab') as f:
+                f.truncate(size)
+
+            job = SpoolJob(path, job_id, frame_type, commands_to_send)
+            job.write_header()
+            self._jobs[job_id] = job
+            self._used_bytes += size
+            return job
+
+    def _has_space(self, size):
+        if not self._jobs:
+            return True
+        return len(self._jobs) < self.max_jobs and self._used_bytes + size <= self.max_bytes
+
+    def commit(self, job):
+        """
+        Marks a job as completely received and queues it to be drained.
+        """
+        job.set_state(JOB_READY)
+        job.unmap()
+        self._ready.put_nowait(job)
+
+    async def get_ready(self):
+        """
+        Waits for the next job that is ready to be written to the sound card.
+        """
+        return await self._ready.get()
+
+    async def release(self, job):
+        """
+        Removes a job (drained or aborted) from the spool and keeps its file for reuse.
+        """
+        job.unmap()
+        async with self._space:
+            self._jobs.pop(job.job_id, None)
+            self._used_bytes -= job.size
+            self._recycle_file(job.path)
+            self._space.notify_all()
+
+    async def fail(self, job, error=None):
+        """
+        Gives up a job that couldn't be written to the sound card, keeping a record of it for the status.
+        """
+        self._failed.append({**job.as_dict(), 'error': error, 'failed': time.time()})
+        await self.release(job)
+
+    def _recycle_file(self, path):
+        if len(self._free_files) >= self.max_jobs:
+            os.remove(path)
+            return
+        free_path = os.path.join(self.directory, f'free-{os.path.basename(path)}')
+        os.replace(path, free_path)
+        if free_path not in self._free_files:
+            self._free_files.append(free_path)
+
+    def as_dict(self):
+        return {
+            'directory': self.directory,
+            'used_bytes': self._used_bytes,
+            'max_bytes': self.max_bytes,
+            'max_jobs': self.max_jobs,
+            'jobs': [job.as_dict() for job in sorted(self._jobs.values(), key=lambda j: j.job_id)],
+            'failed_jobs': list(self._failed),
+        }
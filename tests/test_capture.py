@@ -0,0 +1,57 @@
+from capture import CaptureWriter, read_capture
+
+
+def test_capture_round_trip(tmp_path):
+    path = str(tmp_path / 'sessions.cap')
+    writer = CaptureWriter(path)
+    first = writer.open_connection(('127.0.0.1', 5000))
+    second = writer.open_connection(('127.0.0.1', 5001))
+    writer.record_frame(first, b'\x02' * 24)
+    writer.record_frame(second, b'\x01\x05\x83\xff\x01\x00\x89')
+    writer.record_frame(first, b'\x03' * 32780)
+    writer.close_connection(first)
+    # connections without frames are not replayed
+    writer.open_connection(('127.0.0.1', 5002))
+    writer.close()
+
+    sessions = read_capture(path)
+
+    assert [s.connection_id for s in sessions] == [first, second]
+    assert sessions[0].peer == "('127.0.0.1', 5000)"
+    assert [frame for _, frame in sessions[0].frames] == [b'\x02' * 24, b'\x03' * 32780]
+    assert sessions[0].frames[0][0] <= sessions[0].frames[1][0]
+    assert sessions[0].size == 24 + 32780
+
+
+def test_interrupted_capture_is_read_up_to_last_record(tmp_path):
+    path = str(tmp_path / 'sessions.cap')
+    writer = CaptureWriter(path)
+    connection_id = writer.open_connection()
+    writer.record_frame(connection_id, b'\x02' * 24)
+    writer.record_frame(connection_id, b'\x03' * 32780)
+    writer.close()
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:-40])
+
+    sessions = read_capture(path)
+
+    assert len(sessions) == 1
+    assert sessions[0].frames[0][1] == b'\x02' * 24
+
+
+def test_frames_are_copied_when_recorded(tmp_path):
+    path = str(tmp_path / 'sessions.cap')
+    writer = CaptureWriter(path)
+    connection_id = writer.open_connection()
+    # the server reuses the receive buffer for the next frame, possibly before the record is written
+    buffer = bytearray(b'\x02' * 24)
+    writer.record_frame(connection_id, memoryview(buffer))
+    buffer[:] = b'\x00' * 24
+    writer.close()
+
+    sessions = read_capture(path)
+
+    assert sessions[0].frames[0][1] == b'\x02' * 24
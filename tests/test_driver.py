@@ -0,0 +1,177 @@
+import array
+import functools
+import os
+import pytest
+import numpy as np
+from device import DeviceRecoveredError, SoundCardDevice
+from driver import DeviceProcess
+
+
+class FakeUSB:
+    """
+    Replies to each command with its random value, and an error for commands whose data starts with 0xFF.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'ab')
+        self._last = None
+
+    def write(self, endpoint, data, timeout):
+        self._last = bytes(data)
+        self._file.write(self._last)
+        self._file.flush()
+        return len(data)
+
+    def read(self, endpoint, buffer, timeout):
+        buffer[:4] = array.array('b', [99, 109, 100, -127])
+        buffer[4:8] = array.array('b', self._last[4:8])
+        buffer[8:12] = array.array('b', [1 if self._last[12:13] == b'\xff' else 0, 0, 0, 0])
+        return 12
+
+
+class FakeDevice(SoundCardDevice):
+    def __init__(self, path):
+        super().__init__()
+        self._path = path
+
+    def open(self):
+        self._dev = FakeUSB(self._path)
+        self.conn_open = True
+        return True
+
+    def close(self):
+        self.conn_open = False
+
+
+def get_command(index, first_byte=0):
+    command = bytearray(4 + 4 + 4 + 32768 + 1)
+    command[:4] = b'cmd\x81'
+    rand_val = np.array([index * 7 - 100], dtype=np.int32)
+    command[4:8] = rand_val.tobytes()
+    command[8:12] = index.to_bytes(4, 'little')
+    command[12:] = bytes([first_byte]) + bytes([index % 256]) * 32768
+    return bytes(command), rand_val
+
+
+@pytest.fixture
+def device_process(tmp_path):
+    pytest.importorskip('multiprocessing.shared_memory')
+    path = str(tmp_path / 'writes.bin')
+    device = DeviceProcess(slots=4, device_factory=functools.partial(FakeDevice, path))
+    device.wait_for_connection()
+    yield device, path
+    device.close()
+
+
+def test_commands_are_written_in_order(device_process):
+    device, path = device_process
+    commands = [get_command(i) for i in range(20)]
+
+    for command, rand_val in commands:
+        device.send_command(command, rand_val, data_size=32768)
+    device.flush()
+
+    with open(path, 'rb') as f:
+        assert f.read() == b''.join(command for command, _ in commands)
+    assert device.as_dict()['process']['queued'] == 0
+    assert device.conn_open
+
+
+def test_errors_are_raised(device_process):
+    device, path = device_process
+
+    device.send_command(*get_command(1, first_byte=0xFF))
+    with pytest.raises(AssertionError):
+        device.flush()
+
+    # the device keeps working after the error
+    device.send_command(*get_command(2))
+    device.flush()
+    # the failed command was written again before giving up
+    assert os.path.getsize(path) == (1 + 3 + 1) * len(get_command(2)[0])
+    assert device.as_dict()['retries'] == 3
+
+
+def test_errors_of_an_aborted_session_are_discarded(device_process):
+    device, path = device_process
+
+    # an upload that is aborted without flushing its commands: its failure isn't raised to the next upload
+    device.send_command(*get_command(1, first_byte=0xFF))
+    device.start_session()
+    device.send_command(*get_command(2))
+    device.flush()
+
+    # the failure of a command of the current session is still raised
+    device.send_command(*get_command(3, first_byte=0xFF))
+    with pytest.raises(AssertionError):
+        device.flush()
+
+
+def test_process_is_started_again_after_exiting(device_process):
+    device, path = device_process
+    device._process.kill()
+    device._process.join()
+
+    device.send_command(*get_command(1))
+    with pytest.raises(AssertionError):
+        device.flush()
+
+    device.wait_for_connection()
+    device.send_command(*get_command(2))
+    device.flush()
+    assert device.as_dict()['process']['alive']
+    assert device.as_dict()['process']['queued'] == 0
+
+
+def test_failed_command_is_written_again(tmp_path):
+    device = FakeDevice(str(tmp_path / 'writes.bin'))
+    device.open()
+    usb = device._dev
+    read = usb.read
+    failures = []
+
+    def read_with_one_failure(endpoint, buffer, timeout):
+        ret = read(endpoint, buffer, timeout)
+        if not failures:
+            # a corrupted reply, as if the command didn't reach the device intact
+            failures.append(True)
+            buffer[4] = ~buffer[4]
+        return ret
+
+    usb.read = read_with_one_failure
+    device.send_command(*get_command(5))
+    assert device.retries == 1
+    assert os.path.getsize(tmp_path / 'writes.bin') == 2 * len(get_command(5)[0])
+
+
+def test_command_is_not_written_again_after_a_restart(tmp_path):
+    usb_core = pytest.importorskip('usb.core')
+    device = FakeDevice(str(tmp_path / 'writes.bin'))
+    device.open()
+
+    def write_with_error(endpoint, data, timeout):
+        raise usb_core.USBError('Pipe error')
+
+    device._dev.write = write_with_error
+    # the device is considered wedged, so the connection is restarted
+    device.watchdog.recovery_action = lambda: 'restart'
+
+    # after the restart the device lost the metadata of the sound: the upload has to be sent again
+    with pytest.raises(DeviceRecoveredError):
+        device.send_command(*get_command(5))
+    assert device.retries == 0
+    assert device.conn_open
+    assert os.path.getsize(tmp_path / 'writes.bin') == 0
+
+
+def test_throughput_collapse_recovers_between_uploads(tmp_path):
+    device = FakeDevice(str(tmp_path / 'writes.bin'))
+    device.open()
+    # the throughput collapsed without errors
+    device.watchdog.recovery_action = lambda: 'restart'
+
+    # the upload in progress isn't interrupted, the connection is restarted before the next one
+    device.send_command(*get_command(5))
+    assert device.watchdog.restarts == 0
+    device.start_session()
+    assert device.watchdog.restarts == 1
+    assert device.conn_open
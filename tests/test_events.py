@@ -0,0 +1,74 @@
+import json
+import logging
+
+from events import EventLog, LogWriter, RateLimitFilter
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_records_are_json_lines(tmp_path):
+    log = EventLog(str(tmp_path / 'events.log'), name='test_records')
+    log.start()
+    log.emit('upload', '24 packets in 35 ms', blocks=24, frame_type=128)
+    log.emit('eviction', 'Evicting client', logging.WARNING, phase='chunk')
+    log.stop()
+
+    records = read_records(tmp_path / 'events.log')
+    assert [r['event'] for r in records] == ['upload', 'eviction']
+    assert records[0]['blocks'] == 24 and records[0]['message'] == '24 packets in 35 ms'
+    assert records[1]['level'] == 'warning' and records[1]['phase'] == 'chunk'
+
+
+def test_records_are_rate_limited_per_event(tmp_path):
+    log = EventLog(str(tmp_path / 'events.log'), rate=2.0, name='test_rate')
+    log.start()
+    for _ in range(10):
+        log.emit('retransmission', 'Corrupted data command')
+    log.emit('upload', 'Upload finished')
+    assert log.as_dict()['suppressed'] == 8
+    log.stop()
+
+    records = read_records(tmp_path / 'events.log')
+    assert [r['event'] for r in records] == ['retransmission', 'retransmission', 'upload']
+
+
+def test_suppressed_records_are_counted_in_the_next_one():
+    rate_limit = RateLimitFilter(rate=1000.0, burst=1.0)
+    records = [logging.makeLogRecord({'event': 'chunk', 'fields': {}}) for _ in range(3)]
+    assert rate_limit.filter(records[0])
+    assert not rate_limit.filter(records[1])
+    rate_limit._buckets['chunk'] = (1.0, rate_limit._buckets['chunk'][1])
+    assert rate_limit.filter(records[2])
+    assert records[2].fields == {'suppressed': 1}
+    # the total isn't reset when the count of the event is carried
+    assert rate_limit.suppressed_total == 1
+
+
+def test_full_queue_drops_records():
+    # without a listener nothing is taken from the queue
+    log = EventLog(queue_size=2, rate=100.0, name='test_full')
+    log._logger.addHandler(log._handler)
+    try:
+        for i in range(5):
+            log.emit('upload', f'Upload {i}')
+    finally:
+        log._logger.removeHandler(log._handler)
+    assert log.as_dict()['queued'] == 2
+    assert log.as_dict()['dropped'] == 3
+
+
+def test_printed_lines_go_to_the_log(tmp_path):
+    log = EventLog(str(tmp_path / 'events.log'), name='test_writer')
+    log.start()
+    writer = LogWriter(log)
+    print('Trying to open USB connection', file=writer)
+    writer.write('Resetting ')
+    writer.write('device\n\n')
+    log.stop()
+
+    records = read_records(tmp_path / 'events.log')
+    assert [r['message'] for r in records] == ['Trying to open USB connection', 'Resetting device']
+    assert all(r['event'] == 'output' for r in records)
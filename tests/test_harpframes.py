@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+import numpy as np
+from examples.harpframes import write_harpframes, read_harpframes, send_harpframes, DATA_CMD_SIZE
+from examples.protocol import Protocol
+from examples.tools import generate_sound
+
+
+def get_protocol(sound, with_data):
+    protocol = Protocol(sound)
+    protocol.prepare_header(with_data=with_data, with_file_metadata=True)
+    protocol.add_metadata([2, protocol.sound_file_size_in_samples, 96000, 0])
+    protocol.add_filemetadata()
+    protocol.add_first_data_block()
+    protocol.update_header_checksum()
+    return protocol
+
+
+@pytest.mark.parametrize('with_data', [True, False])
+def test_file_has_the_frames(tmp_path, with_data):
+    sound = generate_sound(fs=96000, duration=1.3)
+    path = str(tmp_path / 'sound.harpframes')
+
+    write_harpframes(path, get_protocol(sound, with_data))
+    frames = read_harpframes(path)
+
+    protocol = get_protocol(sound, with_data)
+    content = open(path, 'rb').read()
+    assert frames.data_cmds == protocol.commands_to_send - protocol.first_data_cmd_index
+    assert content[frames.header_offset: frames.header_offset + frames.header_size] == protocol.header.tobytes()
+
+    offset, size = frames.get_data_cmd_range(frames.data_cmds - 1)
+    last_data_cmd = np.frombuffer(content[offset: offset + size], dtype=np.int8)
+    assert int.from_bytes(last_data_cmd[7:11].tobytes(), 'little') == protocol.commands_to_send - 1
+    assert last_data_cmd[-1] == last_data_cmd[:-1].sum(dtype=np.int8)
+
+
+def test_truncated_file(tmp_path):
+    path = str(tmp_path / 'sound.harpframes')
+    write_harpframes(path, get_protocol(generate_sound(fs=96000, duration=1), True))
+    with open(path, 'r+b') as f:
+        f.truncate(1000)
+
+    with pytest.raises(ValueError):
+        read_harpframes(path)
+
+
+@pytest.mark.asyncio
+async def test_send(tmp_path):
+    path = str(tmp_path / 'sound.harpframes')
+    frames = write_harpframes(path, get_protocol(generate_sound(fs=96000, duration=1), False))
+    received = []
+
+    async def handle(reader, writer):
+        received.append(await reader.readexactly(frames.header_size))
+        writer.write(bytes([2] + [0] * 11))
+        for _ in range(frames.data_cmds):
+            received.append(await reader.readexactly(DATA_CMD_SIZE))
+            writer.write(bytes([2] + [0] * 11))
+        await reader.read()
+        writer.write(b'OK')
+        writer.close()
+
+    server = await asyncio.start_server(handle, 'localhost', 0)
+    result = await send_harpframes(path, port=server.sockets[0].getsockname()[1])
+    server.close()
+
+    assert result.ok
+    assert b''.join(received) == open(path, 'rb').read()[frames.header_offset:]
@@ -0,0 +1,132 @@
+import pytest
+from health import LatencyTracker, DeviceWatchdog, HEALTH_OK, HEALTH_DEGRADED, HEALTH_WEDGED
+
+
+def test_latency_tracker_uses_default_timeout_without_samples():
+    tracker = LatencyTracker(400, min_samples=8)
+    for _ in range(7):
+        tracker.add(0.001)
+
+    assert tracker.timeout == 400
+
+
+@pytest.mark.parametrize('latency, expected', [(0.001, 100), (0.05, 150), (2.0, 4000)])
+def test_latency_tracker_learns_bounded_timeout(latency, expected):
+    tracker = LatencyTracker(400, margin=3.0, min_samples=8)
+    for _ in range(8):
+        tracker.add(latency)
+
+    assert tracker.timeout == expected
+
+
+def test_watchdog_wedged_after_consecutive_failures():
+    watchdog = DeviceWatchdog(wedged_failures=3)
+    watchdog.record_failure('write')
+    assert watchdog.state == HEALTH_DEGRADED
+    assert watchdog.recovery_action() is None
+
+    watchdog.record_failure('ack')
+    watchdog.record_failure('ack')
+    assert watchdog.state == HEALTH_WEDGED
+    assert watchdog.recovery_action() == 'restart'
+
+    # if the restart didn't bring the device back, a reset is requested
+    watchdog.record_recovery('restart')
+    for _ in range(3):
+        watchdog.record_failure('write')
+    assert watchdog.recovery_action() == 'reset'
+
+    watchdog.record_recovery('reset')
+    watchdog.record_success()
+    assert watchdog.state == HEALTH_OK
+    assert watchdog.as_dict()['restarts'] == 1
+    assert watchdog.as_dict()['resets'] == 1
+
+
+def test_watchdog_detects_throughput_collapse():
+    watchdog = DeviceWatchdog(warmup_chunks=16)
+    for _ in range(32):
+        watchdog.record_success(32768, 0.01)
+    assert watchdog.state == HEALTH_OK
+
+    for _ in range(32):
+        watchdog.record_success(32768, 1.0)
+    assert watchdog.state == HEALTH_WEDGED
+    assert watchdog.recovery_action() == 'restart'
+
+
+def test_watchdog_resets_when_a_restart_does_not_bring_the_throughput_back():
+    watchdog = DeviceWatchdog(warmup_chunks=16)
+    for _ in range(32):
+        watchdog.record_success(32768, 0.01)
+    for _ in range(32):
+        watchdog.record_success(32768, 1.0)
+    assert watchdog.recovery_action() == 'restart'
+    watchdog.record_recovery('restart')
+
+    # the commands keep succeeding after the restart, but as slow as before
+    for _ in range(32):
+        watchdog.record_success(32768, 1.0)
+    assert watchdog.recovery_action() == 'reset'
+
+
+def test_watchdog_baseline_is_the_warmup_average():
+    watchdog = DeviceWatchdog(warmup_chunks=16)
+    # a hiccup on the first chunk doesn't become the baseline
+    watchdog.record_success(32768, 0.1)
+    for _ in range(15):
+        watchdog.record_success(32768, 0.01)
+
+    baseline = watchdog.as_dict()['baseline_throughput_bps']
+    assert baseline == pytest.approx((32768 / 0.1 + 15 * 32768 / 0.01) / 16)
+    assert watchdog.state == HEALTH_OK
+
+
+def test_watchdog_short_dip_does_not_wedge():
+    watchdog = DeviceWatchdog(warmup_chunks=16, wedged_chunks=8)
+    for _ in range(32):
+        watchdog.record_success(32768, 0.01)
+
+    # a dip that goes below the wedged throughput for a few chunks, with metadata commands in between that don't
+    # count as slow chunks
+    states = []
+    for _ in range(15):
+        watchdog.record_success(32768, 1.0)
+        watchdog.record_success()
+        states.append(watchdog.state)
+    assert watchdog._slow_chunks > 0
+    for _ in range(8):
+        watchdog.record_success(32768, 0.01)
+        states.append(watchdog.state)
+    assert HEALTH_WEDGED not in states
+    assert watchdog.state != HEALTH_WEDGED
+
+    # a sustained collapse does
+    for _ in range(32):
+        watchdog.record_success(32768, 1.0)
+    assert watchdog.state == HEALTH_WEDGED
+
+
+def test_watchdog_timeout_follows_latencies_going_up():
+    watchdog = DeviceWatchdog()
+    for _ in range(64):
+        watchdog.record_ack(0.01)
+        watchdog.record_success()
+    assert watchdog.ack_timeout == 100
+
+    # the card now takes 60 to 300 ms to reply: the timeouts widen the timeout instead of wedging the device
+    timeouts = 0
+    for latency in [0.06, 0.3, 0.15, 0.25] * 16:
+        if latency * 1000 > watchdog.ack_timeout:
+            timeouts += 1
+            watchdog.record_failure('ack', timed_out=True)
+        else:
+            watchdog.record_ack(latency)
+            watchdog.record_success()
+        assert watchdog.recovery_action() is None
+    assert timeouts <= 2
+    assert watchdog.ack_timeout >= 300
+
+    # after a recovery the latencies are learned again
+    watchdog.record_recovery('restart')
+    assert watchdog.ack_timeout == 400
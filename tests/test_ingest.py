@@ -0,0 +1,225 @@
+import asyncio
+import pytest
+from ingest import FrameProtocol, SessionDeadlines, DeadlineExceeded, get_frame_type, calc_checksum, FRAME_CONTROL, \
+    FRAME_DATA, FRAME_HEADER_WITH_DATA, FRAME_HEADER_WITHOUT_FILE_METADATA, FRAME_ENSURE, DATA_CMD_SIZE, HEADER_LAYOUTS, \
+    ENSURE_FRAME_SIZE, ENSURE_HASH_INDEX, PHASE_HANDSHAKE, PHASE_FIRST_BLOCK, PHASE_CHUNK_GAP, PHASE_THROUGHPUT
+
+
+class FakeTransport:
+    def __init__(self):
+        self.paused = False
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+
+def with_checksum(frame):
+    frame = bytearray(frame)
+    frame[-1] = calc_checksum(frame[:-1])
+    return bytes(frame)
+
+
+def feed(protocol, data, step):
+    """
+    Feeds data to the protocol as the transport would, in reads of at most 'step' bytes, while reading isn't paused.
+    :return: Number of bytes consumed
+    """
+    offset = 0
+    while offset < len(data) and not protocol.transport.paused:
+        buffer = protocol.get_buffer(-1)
+        size = min(len(buffer), step, len(data) - offset)
+        buffer[:size] = data[offset: offset + size]
+        protocol.buffer_updated(size)
+        offset += size
+    return offset
+
+
+def get_header(frame_type):
+    layout = HEADER_LAYOUTS[frame_type]
+    header = bytearray(layout.size)
+    if frame_type == FRAME_HEADER_WITHOUT_FILE_METADATA:
+        header[:5] = [2, 20, 130, 255, 1]
+    else:
+        header[:7] = [2, 255, 0x10, 0x88, frame_type, 255, 1]
+    header[layout.metadata_index] = 7
+    return with_checksum(header)
+
+
+def get_data_cmd(index):
+    data_cmd = bytearray(DATA_CMD_SIZE)
+    data_cmd[:7] = [2, 255, 0x04, 0x80, 132, 255, 132]
+    data_cmd[7:11] = index.to_bytes(4, 'little')
+    data_cmd[11:-1] = bytes([index % 256]) * 32768
+    return with_checksum(data_cmd)
+
+
+@pytest.mark.parametrize('preamble, frame_type', [([2, 255, 0x10, 0x88, 128, 255, 1], 128),
+                                                  ([2, 20, 130, 255, 1, 0, 0], 130),
+                                                  ([1, 5, 131, 255, 1, 0, 0], 131),
+                                                  ([2, 255, 0x04, 0x80, 132, 255, 132], 132)])
+def test_frame_type_from_preamble(preamble, frame_type):
+    assert get_frame_type(bytes(preamble)) == frame_type
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('header_type', [FRAME_HEADER_WITH_DATA, FRAME_HEADER_WITHOUT_FILE_METADATA])
+@pytest.mark.parametrize('step', [1, 1000, 70000])
+async def test_session_frames_are_parsed(header_type, step):
+    received = []
+
+    async def handler(frames, transport):
+        while True:
+            frame = await frames.read_frame()
+            if frame is None:
+                break
+            received.append((frame.frame_type, bytes(frame.data), frame.is_valid()))
+
+    protocol = FrameProtocol(handler)
+    protocol.connection_made(FakeTransport())
+
+    stream = get_header(header_type) + get_data_cmd(1) + get_data_cmd(2)
+    offset = 0
+    while offset < len(stream):
+        offset += feed(protocol, stream[offset:], step)
+        # let the handler take the complete frame
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+    protocol.eof_received()
+    await protocol.task
+
+    assert [r[0] for r in received] == [header_type, FRAME_DATA, FRAME_DATA]
+    assert received[0][1] == get_header(header_type)
+    assert received[2][1] == get_data_cmd(2)
+    assert all(r[2] for r in received)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('step', [1, 100, 70000])
+async def test_ensure_frame_is_followed_by_an_upload(step):
+    received = []
+
+    async def handler(frames, transport):
+        while True:
+            frame = await frames.read_frame()
+            if frame is None:
+                break
+            received.append((frame.frame_type, bytes(frame.data), frame.layout))
+
+    protocol = FrameProtocol(handler)
+    protocol.connection_made(FakeTransport())
+
+    ensure = bytearray(ENSURE_FRAME_SIZE)
+    ensure[:5] = [2, 40, FRAME_ENSURE, 255, 1]
+    ensure[ENSURE_HASH_INDEX: ENSURE_HASH_INDEX + 32] = bytes(range(32))
+    ensure = with_checksum(ensure)
+
+    stream = ensure + get_header(FRAME_HEADER_WITHOUT_FILE_METADATA) + get_data_cmd(1)
+    offset = 0
+    while offset < len(stream):
+        offset += feed(protocol, stream[offset:], step)
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+    protocol.eof_received()
+    await protocol.task
+
+    assert [r[0] for r in received] == [FRAME_ENSURE, FRAME_HEADER_WITHOUT_FILE_METADATA, FRAME_DATA]
+    assert received[0][1] == ensure
+    assert received[0][2] is None
+    assert received[1][1] == get_header(FRAME_HEADER_WITHOUT_FILE_METADATA)
+
+
+@pytest.mark.asyncio
+async def test_control_frame_and_partial_frame():
+    received = []
+
+    async def handler(frames, transport):
+        received.append(await frames.read_frame())
+        received.append(await frames.read_frame())
+
+    protocol = FrameProtocol(handler)
+    protocol.connection_made(FakeTransport())
+
+    control = with_checksum([1, 5, 131, 255, 1, 0, 0])
+    feed(protocol, control, 100)
+    await asyncio.sleep(0)
+    assert received[0].frame_type == FRAME_CONTROL
+    assert received[0].is_valid()
+
+    # a partial frame is discarded when the client closes the connection
+    feed(protocol, get_header(FRAME_HEADER_WITH_DATA)[:100], 100)
+    protocol.connection_lost(None)
+    await protocol.task
+    assert received[1] is None
+
+
+async def run_session(deadlines, stream, pauses):
+    """
+    Feeds the stream to a session that reads frames until the client finishes, pausing after the given frames.
+    :return: (number of frames received, DeadlineExceeded or None)
+    """
+    result = {'frames': 0, 'error': None}
+
+    async def handler(frames, transport):
+        try:
+            while await frames.read_frame() is not None:
+                result['frames'] += 1
+        except DeadlineExceeded as e:
+            result['error'] = e
+
+    protocol = FrameProtocol(handler, deadlines)
+    protocol.connection_made(FakeTransport())
+    for i, frame in enumerate(stream):
+        await asyncio.sleep(pauses.get(i, 0))
+        if protocol.task.done():
+            break
+        offset = 0
+        while offset < len(frame):
+            offset += feed(protocol, frame[offset:], len(frame))
+            await asyncio.sleep(0)
+    protocol.eof_received()
+    await protocol.task
+    return result['frames'], result['error']
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('pause_before, phase, frames_received, frame_type', [
+    (0, PHASE_HANDSHAKE, 0, None),
+    (1, PHASE_FIRST_BLOCK, 1, FRAME_DATA),
+    (2, PHASE_CHUNK_GAP, 2, FRAME_DATA),
+])
+async def test_deadlines(pause_before, phase, frames_received, frame_type):
+    deadlines = SessionDeadlines(handshake=0.05, first_block=0.05, chunk_gap=0.05)
+    stream = [get_header(FRAME_HEADER_WITHOUT_FILE_METADATA), get_data_cmd(0), get_data_cmd(1)]
+
+    frames, error = await run_session(deadlines, stream, {pause_before: 0.2})
+
+    assert frames == frames_received
+    assert error.phase == phase
+    assert error.frame_type == frame_type
+
+
+@pytest.mark.asyncio
+async def test_deadlines_are_met():
+    deadlines = SessionDeadlines(handshake=0.2, first_block=0.2, chunk_gap=0.2, min_throughput=1000,
+                                 throughput_grace=0.01)
+    stream = [get_header(FRAME_HEADER_WITHOUT_FILE_METADATA), get_data_cmd(0), get_data_cmd(1)]
+
+    frames, error = await run_session(deadlines, stream, {1: 0.05, 2: 0.05})
+
+    assert frames == 3
+    assert error is None
+
+
+@pytest.mark.asyncio
+async def test_minimum_throughput():
+    # one data command per 50 ms is about 640 KB/s
+    deadlines = SessionDeadlines(min_throughput=2 * 2**20, throughput_grace=0.08)
+    stream = [get_header(FRAME_HEADER_WITHOUT_FILE_METADATA)] + [get_data_cmd(i) for i in range(5)]
+
+    frames, error = await run_session(deadlines, stream, {i: 0.05 for i in range(1, 6)})
+
+    assert error.phase == PHASE_THROUGHPUT
+    assert frames == 2
@@ -0,0 +1,71 @@
+import json
+import os
+import pstats
+import tracemalloc
+from profiling import SessionProfiler
+
+
+def work():
+    return [bytes(1000) for _ in range(100)]
+
+
+def test_sessions_are_only_profiled_when_enabled(tmp_path):
+    profiler = SessionProfiler(str(tmp_path))
+
+    session = profiler.start(1, 128)
+    assert not session.active
+    assert profiler.finish(session) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_profiled_session_is_written(tmp_path):
+    profiler = SessionProfiler(str(tmp_path))
+    profiler.enable(1)
+
+    session = profiler.start(7, 129)
+    assert session.active
+    work()
+    session.chunks = 10
+    summary_path = profiler.finish(session)
+
+    with open(summary_path) as f:
+        summary = json.load(f)
+    assert summary['upload_id'] == 7
+    assert summary['frame_type'] == 129
+    assert summary['chunks'] == 10
+    assert summary['bandwidth_mbps'] > 0
+    assert any('work' in function['function'] for function in summary['top_functions'])
+    pstats.Stats(summary['profile'])
+    assert tracemalloc.Snapshot.load(summary['snapshot']) is not None
+    assert not tracemalloc.is_tracing()
+
+    # only the enabled number of sessions is profiled
+    assert not profiler.start(8, 129).active
+
+
+def test_one_session_profiled_at_a_time(tmp_path):
+    profiler = SessionProfiler(str(tmp_path), batch=2)
+    profiler.enable()
+
+    first = profiler.start(1, 128)
+    second = profiler.start(2, 128)
+    assert first.active and not second.active
+    profiler.finish(second)
+    profiler.finish(first)
+
+    # the session that wasn't profiled didn't count
+    assert profiler.remaining == 1
+    assert profiler.start(3, 130).active
+
+
+def test_profiles_of_another_run_are_kept(tmp_path):
+    summaries = []
+    for run in range(2):
+        profiler = SessionProfiler(str(tmp_path))
+        profiler.run_id = f'run-{run}'
+        profiler.enable(1)
+        # the upload ids start again on each run of the server
+        summaries.append(profiler.finish(profiler.start(1, 128)))
+
+    assert summaries[0] != summaries[1]
+    assert len(os.listdir(tmp_path)) == 6
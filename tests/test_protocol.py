@@ -182,3 +182,110 @@ async def test_file_metadata_with_description_filename_content(prepare_sound, de
     metadata_filename_on_header = protocol.filemetadata[metadata_filename_content_index: metadata_filename_content_index + max_dimension]
     as_str = metadata_filename_on_header.tobytes().strip(b'\0')
     assert description_filename_content[:max_dimension] == "".join(map(chr, as_str))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('with_data, with_file_metadata, first_index', [(True, True, 1), (False, True, 0), (False, False, 0)])
+async def test_first_data_cmd_index(prepare_sound, with_data, with_file_metadata, first_index):
+    protocol = Protocol(prepare_sound(2, 4, 96000, 0))
+    protocol.prepare_header(with_data=with_data, with_file_metadata=with_file_metadata)
+
+    assert protocol.first_data_cmd_index == first_index
+
+
+@pytest.mark.asyncio
+async def test_file_metadata_without_data_follows_metadata(prepare_sound):
+    metadata_index = 7
+    protocol = Protocol(prepare_sound(2, 4, 96000, 0))
+    protocol.prepare_header(with_data=False, with_file_metadata=True)
+
+    protocol.add_sound_filename('sound.bin')
+    protocol.add_filemetadata()
+    protocol.add_first_data_block()
+
+    file_metadata_on_header = protocol.header[metadata_index + 16: metadata_index + 16 + 2048]
+    assert file_metadata_on_header.tobytes().strip(b'\0') == b'sound.bin'
+
+
+@pytest.mark.asyncio
+async def test_header_with_source_sample_rate(prepare_sound):
+    metadata_index = 7
+    protocol = Protocol(prepare_sound(2, 1, 48000, 0))
+    protocol.prepare_header(with_data=True, with_file_metadata=False, source_sample_rate=48000)
+
+    protocol.add_metadata([2, protocol.sound_file_size_in_samples, 96000, 0])
+    protocol.add_sound_filename('sound.bin')
+    protocol.add_filemetadata()
+    protocol.add_first_data_block()
+
+    # the first block of data is never in the header and the file metadata follows the source sample rate
+    assert len(protocol.header) == 7 + 16 + 4 + 2048 + 1
+    assert protocol.header[4] == -123  # 133 as int8
+    assert protocol.first_data_cmd_index == 0
+    assert protocol.header[metadata_index + 16: metadata_index + 20].view(np.int32)[0] == 48000
+    file_metadata_on_header = protocol.header[metadata_index + 20: metadata_index + 20 + 2048]
+    assert file_metadata_on_header.tobytes().strip(b'\0') == b'sound.bin'
+
+
+def get_data_cmds(protocol):
+    protocol.prepare_header(with_data=True, with_file_metadata=True)
+    protocol.add_first_data_block()
+    data_cmds = [protocol.header[23: 23 + 32768].tobytes()]
+    for i in range(protocol.first_data_cmd_index, protocol.commands_to_send):
+        if i == protocol.commands_to_send - 1:
+            protocol.clean_data_cmd()
+        protocol.write_data_index(i)
+        protocol.write_data_block(i)
+        data_cmds.append(protocol.data_cmd.tobytes())
+    return data_cmds
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('block_size', [1000, 32768, 100000])
+async def test_sound_from_iterator(prepare_sound, block_size):
+    sound = prepare_sound(2, 1.3, 96000, 0)
+    blocks = (sound[i: i + block_size] for i in range(0, len(sound), block_size))
+
+    protocol = Protocol.from_iterator(blocks, len(sound))
+
+    assert protocol.commands_to_send == Protocol(sound).commands_to_send
+    assert get_data_cmds(protocol) == get_data_cmds(Protocol(sound))
+
+
+@pytest.mark.asyncio
+async def test_sound_from_iterator_with_less_samples(prepare_sound):
+    sound = prepare_sound(2, 1, 96000, 0)
+    protocol = Protocol.from_iterator([sound[:1000]], len(sound))
+
+    with pytest.raises(ValueError):
+        get_data_cmds(protocol)
+
+
+@pytest.mark.asyncio
+async def test_sound_from_file(prepare_sound, tmp_path):
+    sound = prepare_sound(2, 1.3, 96000, 0)
+    path = tmp_path / 'sound.bin'
+    path.write_bytes(b'\0' * 8 + sound.tobytes())
+
+    protocol = Protocol.from_file(str(path), offset=8)
+
+    assert protocol.sound_file_size_in_samples == len(sound)
+    assert get_data_cmds(protocol) == get_data_cmds(Protocol(sound))
+
+
+def test_ensure_frame_and_sound_hash(prepare_sound):
+    from examples.protocol import build_ensure_frame, get_sound_hash, ENSURE_PIN
+
+    wave_int = prepare_sound(2, 0.5, 96000, 0)
+    content_hash = get_sound_hash(wave_int, 96000)
+    assert len(content_hash) == 32
+    # the same samples played at another sample rate are a different sound
+    assert content_hash != get_sound_hash(wave_int, 192000)
+    assert content_hash == get_sound_hash(wave_int.copy(), 96000)
+
+    frame = build_ensure_frame(content_hash, pin=True)
+    assert len(frame) == 42
+    assert frame[:5] == bytes([2, 40, 134, 255, 1])
+    assert frame[5: 37] == content_hash
+    assert int.from_bytes(frame[37: 41], 'little') == ENSURE_PIN
+    assert frame[-1] == sum(frame[:-1]) & 0xFF
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from unittest.mock import ANY
+
+from sounds import SoundCache
+from examples.client import tcp_ensure_sound_client
+from examples.communication import Communication
+from examples.replay import replay
+from tests.test_server import RecordingDevice, prepare_protocol, run_server, send_data_cmd
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('loaded', [False, True])
+async def test_ensured_sound_is_replayed(tmp_path, unused_tcp_port, loaded):
+    capture_path = str(tmp_path / 'sessions.cap')
+    sounds = SoundCache(2, 3)
+    async with run_server(unused_tcp_port, RecordingDevice(), sound_cache=sounds, capture_path=capture_path) as server:
+        result = await tcp_ensure_sound_client(None, np.arange(2 * 32768 // 4, dtype=np.int32), port=unused_tcp_port,
+                                               verbose=False)
+        assert result.ok and not result.loaded
+        server.stop_capture()
+
+    # when the sound is already loaded in the server of the replay, the upload captured after the ensure isn't sent
+    device = RecordingDevice()
+    async with run_server(unused_tcp_port, device, sound_cache=sounds if loaded else SoundCache(2, 3)):
+        stats = await replay(capture_path, port=unused_tcp_port, speed=0)
+
+    assert stats.sessions_ok == 1
+    assert not stats.errors
+    assert len(device.commands) == (0 if loaded else 2)
+
+
+@pytest.mark.asyncio
+async def test_retransmitted_data_command_is_replayed(tmp_path, unused_tcp_port):
+    capture_path = str(tmp_path / 'sessions.cap')
+    async with run_server(unused_tcp_port, RecordingDevice(), capture_path=capture_path) as server:
+        protocol = prepare_protocol(blocks=2)
+        comm = Communication(protocol, None, 'localhost', unused_tcp_port)
+        await comm.open()
+        comm.send_header(protocol.header)
+        assert (await comm.get_reply())[0] == 2
+
+        comm._prepare_data_cmd(1)
+        corrupted = bytearray(protocol.data_cmd)
+        corrupted[-1] ^= 0xFF
+        assert await send_data_cmd(comm, corrupted) == (ANY, 1)
+        reply, data_index = await send_data_cmd(comm, protocol.data_cmd)
+        assert reply[0] == 2 and data_index is None
+        comm._writer.write_eof()
+        assert await comm.get_final_reply() == b'OK'
+        comm.close()
+        server.stop_capture()
+
+    # the corrupted data command is captured too, so the server of the replay asks for it again
+    device = RecordingDevice()
+    async with run_server(unused_tcp_port, device) as server:
+        stats = await replay(capture_path, port=unused_tcp_port, speed=0)
+        assert server.get_status()['metrics']['retransmissions'] == 1
+
+    assert stats.sessions_ok == 1
+    assert stats.retransmissions == 1
+    assert not stats.errors
+    assert len(device.commands) == 2
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from resample import PolyphaseResampler, ResampledUpload, DATA_BLOCK_SIZE, DATA_TYPE_INT32, DATA_TYPE_FLOAT32
+
+
+def get_sine(frequency, sample_rate, frames, amplitude=0.5):
+    t = np.arange(frames) / sample_rate
+    return np.stack((amplitude * np.sin(2 * np.pi * frequency * t), amplitude * np.cos(2 * np.pi * frequency * t)),
+                    axis=1)
+
+
+@pytest.mark.parametrize('source_rate, target_rate', [(44100, 96000), (48000, 192000), (96000, 48000),
+                                                      (96000, 96000)])
+def test_output_does_not_depend_on_blocks(source_rate, target_rate):
+    sound = get_sine(1000, source_rate, 20000)
+
+    whole = PolyphaseResampler(source_rate, target_rate)
+    expected = np.concatenate((whole.process(sound), whole.flush()))
+
+    blocks = PolyphaseResampler(source_rate, target_rate)
+    output = [blocks.process(sound[start: start + size]) for start, size in
+              zip(range(0, 20000, 4096), [4096] * 4 + [3616])] + [blocks.flush()]
+    output = np.concatenate(output)
+
+    assert len(output) >= whole.get_output_frames(len(sound))
+    assert np.allclose(output, expected)
+
+
+@pytest.mark.parametrize('source_rate, target_rate', [(44100, 96000), (48000, 192000), (192000, 96000)])
+def test_sine_is_resampled(source_rate, target_rate):
+    frames = 9000
+    resampler = PolyphaseResampler(source_rate, target_rate)
+    output = np.concatenate((resampler.process(get_sine(1000, source_rate, frames)), resampler.flush()))
+    output = output[:resampler.get_output_frames(frames)]
+
+    expected = get_sine(1000, target_rate, len(output))
+    # the edges are affected by the silence before and after the sound
+    edge = len(output) // 10
+    assert np.max(np.abs(output[edge:-edge] - expected[edge:-edge])) < 1e-3
+
+
+def test_invalid_rates():
+    with pytest.raises(ValueError):
+        PolyphaseResampler(0, 96000)
+    with pytest.raises(ValueError):
+        PolyphaseResampler(44101, 96000)
+
+
+@pytest.mark.parametrize('data_type', [DATA_TYPE_INT32, DATA_TYPE_FLOAT32])
+def test_upload_blocks(data_type):
+    source_frames = 30000
+    sound = get_sine(440, 48000, source_frames) * (2**30 if data_type == DATA_TYPE_INT32 else 1)
+    data = sound.astype(np.int32 if data_type == DATA_TYPE_INT32 else np.float32).tobytes()
+    # the client pads the last data command with zeros
+    data += bytes(-len(data) % DATA_BLOCK_SIZE)
+
+    upload = ResampledUpload(48000, 96000, source_frames * 2, data_type)
+    blocks = []
+    for start in range(0, len(data), DATA_BLOCK_SIZE):
+        blocks += upload.add_block(data[start: start + DATA_BLOCK_SIZE])
+    blocks += upload.finish()
+
+    assert upload.total_samples == source_frames * 2 * 2
+    assert len(blocks) == upload.commands_to_send
+    assert all(len(block) == DATA_BLOCK_SIZE for block in blocks)
+
+    output = np.frombuffer(b''.join(blocks), dtype=np.int32 if data_type == DATA_TYPE_INT32 else np.float32)
+    # the padding of the client isn't converted and the padding of the last block is silence
+    assert not output[upload.total_samples:].any()
+    output = output[:upload.total_samples].reshape(-1, 2).astype(np.float64)
+    expected = get_sine(440, 96000, len(output)) * (2**30 if data_type == DATA_TYPE_INT32 else 1)
+    assert np.max(np.abs(output[1000:-1000] - expected[1000:-1000])) < 1e-3 * np.max(np.abs(expected))
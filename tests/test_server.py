@@ -0,0 +1,368 @@
+import asyncio
+import contextlib
+import json
+import logging
+import numpy as np
+import pytest
+import time
+from unittest.mock import ANY
+
+from events import EventLog, NullProgress
+from ingest import DATA_CMD_INDEX, SessionDeadlines, calc_checksum
+from server import SoundCardTCPServer, parse_arguments
+from sounds import SoundCache
+from examples.client import tcp_send_sound_client
+from examples.communication import Communication
+from examples.protocol import REPLY_RETRANSMIT, Protocol
+
+
+class RecordingDevice(object):
+    """
+    Device that keeps the commands written to it, failing the first 'failures' ones.
+    """
+    def __init__(self, failures=0):
+        self.conn_open = False
+        self.failures = failures
+        self.commands = []
+
+    def open(self):
+        self.conn_open = True
+        return True
+
+    def wait_for_connection(self):
+        self.open()
+
+    def send_command(self, data_to_send, rand_val, is_metadata=False, data_size=0):
+        if self.failures > 0:
+            self.failures -= 1
+            raise AssertionError('Command failed after 3 retries')
+        self.commands.append(bytes(data_to_send))
+
+    def flush(self):
+        pass
+
+    def start_session(self):
+        pass
+
+    def wait_for_slot(self, blocking=True):
+        return True
+
+    def restart(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def close(self):
+        self.conn_open = False
+
+    def as_dict(self):
+        return {'connected': self.conn_open}
+
+
+@contextlib.asynccontextmanager
+async def run_server(port, device, **kwargs):
+    server = SoundCardTCPServer('localhost', port, device_factory=lambda: device, **kwargs)
+    task = asyncio.ensure_future(server.start_server())
+    try:
+        while getattr(server, '_device_ready', None) is None or not server._device_ready.is_set():
+            await asyncio.sleep(0.01)
+        yield server
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+class ProgressSpy(object):
+    def __init__(self):
+        self.updates = 0
+        self.closed = False
+
+    def update(self, n=1):
+        self.updates += n
+
+    def close(self):
+        self.closed = True
+
+
+def prepare_protocol(blocks=3, sound_index=2, source_sample_rate=None):
+    protocol = Protocol(np.arange(blocks * 32768 // 4, dtype=np.int32))
+    protocol.prepare_header(source_sample_rate=source_sample_rate)
+    protocol.add_metadata([sound_index, protocol.sound_file_size_in_samples, 96000, 0])
+    protocol.add_filemetadata()
+    protocol.add_first_data_block()
+    protocol.update_header_checksum()
+    return protocol
+
+
+async def wait_for(condition, timeout=10.0):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError('Condition not met in time')
+
+
+@pytest.mark.asyncio
+async def test_failed_job_is_written_again(tmp_path, unused_tcp_port):
+    device = RecordingDevice(failures=1)
+    async with run_server(unused_tcp_port, device, spool_dir=str(tmp_path)) as server:
+        reply = server._reply
+        result = await tcp_send_sound_client(None, sound_index=2, duration=0.1, port=unused_tcp_port, verbose=False)
+        assert result.ok
+        await wait_for(lambda: not server.get_status()['spool']['jobs'])
+        # the reply used by the sessions on the event loop isn't reset by the thread writing the jobs
+        assert server._reply is reply
+
+        status = server.get_status()
+        assert status['spool']['failed_jobs'] == []
+        assert 'failed_jobs' not in status['metrics']
+    # metadata command plus the data commands
+    assert len(device.commands) == 3
+
+
+@pytest.mark.asyncio
+async def test_job_failing_every_attempt_is_reported(tmp_path, unused_tcp_port):
+    device = RecordingDevice(failures=100)
+    async with run_server(unused_tcp_port, device, spool_dir=str(tmp_path), drain_attempts=2) as server:
+        result = await tcp_send_sound_client(None, sound_index=2, duration=0.1, port=unused_tcp_port, verbose=False)
+        assert result.ok
+        await wait_for(lambda: not server.get_status()['spool']['jobs'])
+
+        status = server.get_status()
+        assert status['metrics']['failed_jobs'] == 1
+        [failed] = status['spool']['failed_jobs']
+        assert failed['attempts'] == 2
+        assert 'Command failed' in failed['error']
+    assert device.commands == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('source_sample_rate', [None, 48000])
+async def test_progress_is_closed_when_the_client_is_evicted(unused_tcp_port, source_sample_rate):
+    progress = []
+    deadlines = SessionDeadlines(first_block=0.2, chunk_gap=0.2)
+    async with run_server(unused_tcp_port, RecordingDevice(), deadlines=deadlines) as server:
+        server._create_progress = lambda total: progress.append(ProgressSpy()) or progress[-1]
+        protocol = prepare_protocol(source_sample_rate=source_sample_rate)
+        comm = Communication(protocol, None, 'localhost', unused_tcp_port)
+        await comm.open()
+        comm.send_header(protocol.header)
+        assert (await comm.get_reply())[0] == 2
+        # the client stalls: it is evicted with an error reply
+        assert (await comm.get_reply())[0] == 10
+        comm.close()
+        await wait_for(lambda: server.get_status()['metrics'].get('evictions') == 1)
+
+    assert len(progress) == 1 and progress[0].closed
+
+
+class SlowDevice(RecordingDevice):
+    """
+    Device that takes a while to connect and whose queue of commands is always full, like the driver process while
+    the sound card is missing or busy.
+    """
+    def wait_for_connection(self):
+        time.sleep(0.5)
+        super().wait_for_connection()
+
+    def wait_for_slot(self, blocking=True):
+        if blocking:
+            time.sleep(0.1)
+        return blocking
+
+
+@pytest.mark.asyncio
+async def test_waiting_for_the_device_does_not_block_the_event_loop(unused_tcp_port):
+    device = SlowDevice()
+    async with run_server(unused_tcp_port, device):
+        gaps = []
+
+        async def tick():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.01)
+                gaps.append(time.perf_counter() - start)
+
+        ticker = asyncio.ensure_future(tick())
+        result = await tcp_send_sound_client(None, sound_index=2, duration=0.1, port=unused_tcp_port, verbose=False)
+        ticker.cancel()
+
+        assert result.ok
+        assert len(device.commands) == 3
+        assert max(gaps) < 0.3
+
+
+async def send_truncated_upload(port, protocol, content_hash=None):
+    """
+    Sends the header and the first data command of an upload, and finishes it without sending the rest.
+    :return: The final reply of the server, and the ensure reply if a content hash is given
+    """
+    comm = Communication(protocol, None, 'localhost', port)
+    await comm.open()
+    ensured = await comm.ensure_sound(content_hash) if content_hash is not None else None
+    comm.send_header(protocol.header)
+    assert (await comm.get_reply())[0] == 2
+    comm._prepare_data_cmd(protocol.first_data_cmd_index)
+    comm.send_data(protocol.data_cmd)
+    assert (await comm.get_reply())[0] == 2
+    comm._writer.write_eof()
+    reply = await comm.get_reply()
+    comm.close()
+    return reply, ensured
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('spool', [False, True])
+@pytest.mark.parametrize('source_sample_rate', [None, 48000])
+async def test_truncated_upload_is_refused(tmp_path, unused_tcp_port, spool, source_sample_rate):
+    device = RecordingDevice()
+    sounds = SoundCache(2, 3)
+    kwargs = {'spool_dir': str(tmp_path)} if spool else {}
+    async with run_server(unused_tcp_port, device, sound_cache=sounds, **kwargs) as server:
+        content_hash = bytes(range(32))
+        protocol = prepare_protocol(blocks=4, source_sample_rate=source_sample_rate)
+        reply, ensured = await send_truncated_upload(unused_tcp_port, protocol, content_hash)
+        assert ensured == (2, False)
+        assert reply[0] != 2
+        await wait_for(lambda: server.get_status()['metrics'].get('truncated_uploads') == 1)
+
+        # the sound isn't cached, nor written to the device from the spool
+        assert sounds.as_dict()['slots'] == []
+        if spool:
+            assert server.get_status()['spool']['jobs'] == []
+            assert device.commands == []
+
+
+async def send_data_cmd(comm, data_cmd):
+    """
+    :return: The reply, and the dataIndex requested again if the server asks for a retransmission
+    """
+    comm.send_data(data_cmd)
+    reply = await comm.get_reply()
+    if reply[2] != REPLY_RETRANSMIT:
+        return reply, None
+    return reply, int.from_bytes(await comm._reader.readexactly(4), byteorder='little')
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('resent', ['corrupted', 'wrong_index'])
+async def test_data_command_is_sent_again(unused_tcp_port, resent):
+    device = RecordingDevice()
+    async with run_server(unused_tcp_port, device) as server:
+        protocol = prepare_protocol(blocks=2)
+        comm = Communication(protocol, None, 'localhost', unused_tcp_port)
+        await comm.open()
+        comm.send_header(protocol.header)
+        assert (await comm.get_reply())[0] == 2
+
+        comm._prepare_data_cmd(1)
+        data_cmd = bytes(protocol.data_cmd)
+        bad_cmd = bytearray(data_cmd)
+        if resent == 'corrupted':
+            bad_cmd[-1] ^= 0xFF
+        else:
+            bad_cmd[DATA_CMD_INDEX: DATA_CMD_INDEX + 4] = (5).to_bytes(4, byteorder='little')
+            bad_cmd[-1] = calc_checksum(bad_cmd[:-1])
+
+        assert await send_data_cmd(comm, bad_cmd) == (ANY, 1)
+        reply, data_index = await send_data_cmd(comm, data_cmd)
+        assert reply[0] == 2 and data_index is None
+        comm._writer.write_eof()
+        assert await comm.get_final_reply() == b'OK'
+        comm.close()
+
+        assert server.get_status()['metrics']['retransmissions'] == 1
+    # metadata command plus the data command, which is only written once
+    assert len(device.commands) == 2
+    assert device.commands[1][8:12] == (1).to_bytes(4, byteorder='little')
+
+
+@pytest.mark.asyncio
+async def test_upload_is_aborted_after_the_retransmissions(unused_tcp_port):
+    device = RecordingDevice()
+    async with run_server(unused_tcp_port, device, max_retransmissions=2) as server:
+        protocol = prepare_protocol(blocks=2)
+        comm = Communication(protocol, None, 'localhost', unused_tcp_port)
+        await comm.open()
+        comm.send_header(protocol.header)
+        assert (await comm.get_reply())[0] == 2
+
+        comm._prepare_data_cmd(1)
+        corrupted = bytearray(protocol.data_cmd)
+        corrupted[-1] ^= 0xFF
+        assert await send_data_cmd(comm, corrupted) == (ANY, 1)
+        assert await send_data_cmd(comm, corrupted) == (ANY, 1)
+        reply, data_index = await send_data_cmd(comm, corrupted)
+        assert reply[0] != 2 and data_index is None
+
+        # the upload is over: no 'OK' follows
+        comm._writer.write_eof()
+        assert await comm._reader.read() == b''
+        comm.close()
+
+        metrics = server.get_status()['metrics']
+        assert metrics['retransmissions'] == 2
+        assert metrics['aborted_uploads'] == 1
+    # only the metadata command
+    assert len(device.commands) == 1
+
+
+@pytest.mark.asyncio
+async def test_upload_failing_on_the_device_gets_an_error_reply(unused_tcp_port):
+    device = RecordingDevice(failures=1)
+    async with run_server(unused_tcp_port, device) as server:
+        result = await tcp_send_sound_client(None, sound_index=2, duration=0.1, port=unused_tcp_port, verbose=False)
+        assert not result.ok
+        assert server.get_status()['metrics']['failed_uploads'] == 1
+
+        # the next upload isn't affected
+        result = await tcp_send_sound_client(None, sound_index=2, duration=0.1, port=unused_tcp_port, verbose=False)
+        assert result.ok
+
+
+def test_config_file_gives_the_defaults_of_the_options(tmp_path):
+    path = tmp_path / 'server.json'
+    path.write_text(json.dumps({'port': 1234, 'spool-max-mb': 512, 'service': True}))
+
+    args = parse_arguments(['--config', str(path), '--port', '5678'])
+
+    # the command line takes precedence over the config file
+    assert args.port == 5678
+    assert args.spool_max_mb == 512
+    assert args.service is True
+    assert args.address == 'localhost'
+
+
+@pytest.mark.parametrize('config', [{'prot': 1234}, {'config': 'other.json'}, [1234]])
+def test_config_file_with_unknown_options_is_refused(tmp_path, config):
+    path = tmp_path / 'server.json'
+    path.write_text(json.dumps(config))
+
+    with pytest.raises(SystemExit):
+        parse_arguments(['--config', str(path)])
+
+
+def test_service_mode_logs_events_without_progress_bars(tmp_path, capsys):
+    event_log = EventLog(str(tmp_path / 'events.log'), name='test_service')
+    event_log.start()
+    server = SoundCardTCPServer('localhost', 0, device_factory=RecordingDevice, event_log=event_log)
+    assert isinstance(server._create_progress(10), NullProgress)
+    server._log('upload_refused', 'Refusing upload', logging.WARNING, frame_type=128)
+    event_log.stop()
+
+    assert capsys.readouterr().out == ''
+    with open(tmp_path / 'events.log') as f:
+        [record] = [json.loads(line) for line in f]
+    assert record['event'] == 'upload_refused' and record['frame_type'] == 128
+
+
+def test_console_mode_prints_events_with_progress_bars(capsys):
+    server = SoundCardTCPServer('localhost', 0, device_factory=RecordingDevice)
+    progress = server._create_progress(10)
+    assert not isinstance(progress, NullProgress)
+    progress.close()
+    server._log('upload_refused', 'Refusing upload', logging.WARNING, frame_type=128)
+
+    assert capsys.readouterr().out == 'Refusing upload\n'
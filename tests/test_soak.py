@@ -0,0 +1,42 @@
+import pytest
+
+from examples.soak import FAULT_DISCONNECT, FAULT_READ_TIMEOUT, FAULT_WRITE_TIMEOUT, FAULTS, FaultRates, \
+    SoakConfiguration, parse_duration, run_soak
+
+
+def test_parse_duration():
+    assert parse_duration('90') == 90.0
+    assert parse_duration('30m') == 1800.0
+    assert parse_duration('12h') == 12 * 3600.0
+
+
+@pytest.mark.asyncio
+async def test_soak_recovers_from_faults(unused_tcp_port):
+    pytest.importorskip('usb.core')
+    config = SoakConfiguration(clients=2, run_duration=3.0, sound_durations=(0.1, 0.3), usb_mbps=400.0,
+                               report_interval=1.0, seed=3)
+    rates = FaultRates(value_mismatch=0.05, corrupted_chunk=0.1, client_drop=0.2)
+    results = await run_soak(config, rates, port=unused_tcp_port, output=None)
+
+    assert results['uploads'] > 0
+    assert results['chunks_verified'] > 0
+    assert results['chunks_lost'] == 0
+    assert set(results['faults']) == set(FAULTS)
+    assert results['faults']['corrupted_chunk']['injected'] > 0
+    assert results['server']['retransmissions'] == results['faults']['corrupted_chunk']['injected']
+
+
+@pytest.mark.asyncio
+async def test_soak_recovers_from_device_faults(unused_tcp_port):
+    pytest.importorskip('usb.core')
+    # short timeouts and disconnections, as the faults wait for them
+    config = SoakConfiguration(clients=2, run_duration=3.0, sound_durations=(0.1, 0.3), usb_mbps=400.0,
+                               write_timeout=20, ack_timeout=20, report_interval=1.0, seed=5)
+    rates = FaultRates(write_timeout=0.05, read_timeout=0.05, disconnect=0.03, disconnect_duration=0.2)
+    results = await run_soak(config, rates, port=unused_tcp_port, output=None)
+
+    assert results['uploads'] > 0
+    assert results['chunks_lost'] == 0
+    for fault in (FAULT_WRITE_TIMEOUT, FAULT_READ_TIMEOUT, FAULT_DISCONNECT):
+        assert results['faults'][fault]['injected'] > 0
+        assert results['faults'][fault]['recovered'] == results['faults'][fault]['injected']
@@ -0,0 +1,81 @@
+import pytest
+from sounds import SoundCache, SoundCacheFull
+
+
+def get_hash(n):
+    return bytes([n]) * 32
+
+
+def load(cache, n, **kwargs):
+    slot, loaded = cache.ensure(get_hash(n), **kwargs)
+    if not loaded:
+        cache.commit(slot)
+    return slot.index, loaded
+
+
+def test_loaded_sounds_are_hits():
+    cache = SoundCache(2, 4)
+
+    assert load(cache, 1) == (2, False)
+    assert load(cache, 2) == (3, False)
+    assert load(cache, 1) == (2, True)
+    assert cache.as_dict()['hits'] == 1
+    assert cache.as_dict()['free'] == 1
+
+
+def test_least_recently_used_unpinned_slot_is_evicted():
+    cache = SoundCache(2, 4)
+    load(cache, 1, pin=True)
+    load(cache, 2)
+    load(cache, 3)
+    # sound 2 is now the least recently used
+    load(cache, 2)
+
+    assert load(cache, 4) == (4, False)
+    assert load(cache, 2) == (3, True)
+    assert cache.as_dict()['evictions'] == 1
+
+    # with every slot pinned there's nowhere to load new sounds
+    load(cache, 2, pin=True)
+    load(cache, 4, pin=True)
+    with pytest.raises(SoundCacheFull):
+        cache.ensure(get_hash(5))
+
+    load(cache, 1, unpin=True)
+    assert load(cache, 5) == (2, False)
+
+
+def test_slots_only_become_resident_when_committed():
+    cache = SoundCache(2, 3)
+    slot, loaded = cache.ensure(get_hash(1))
+    assert not loaded
+
+    # while the sound is loading, its slot isn't given to another sound or evicted
+    other, _ = cache.ensure(get_hash(1))
+    assert other.index != slot.index
+    with pytest.raises(SoundCacheFull):
+        cache.ensure(get_hash(2))
+
+    cache.release(other)
+    cache.commit(slot)
+    assert load(cache, 1) == (slot.index, True)
+
+    # an upload that doesn't go through the cache overwrites the sound
+    cache.invalidate(slot.index)
+    assert load(cache, 1)[1] is False
+
+
+def test_resident_slots_are_kept_between_runs(tmp_path):
+    path = str(tmp_path / 'sounds.json')
+    cache = SoundCache(2, 4, path)
+    load(cache, 1)
+    load(cache, 2, pin=True)
+    # a sound that never finished loading isn't saved
+    cache.ensure(get_hash(3))
+
+    restarted = SoundCache(2, 4, path)
+    assert restarted.load() == 2
+    assert load(restarted, 1) == (2, True)
+    assert load(restarted, 2) == (3, True)
+    assert [slot['pinned'] for slot in restarted.as_dict()['slots']] == [False, True]
+    assert load(restarted, 3) == (4, False)
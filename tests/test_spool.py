@@ -0,0 +1,80 @@
+import os
+import pytest
+from spool import Spool, JOB_READY, DATA_BLOCK_SIZE
+
+
+@pytest.mark.asyncio
+async def test_staged_job_is_recovered_after_restart(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.recover()
+
+    job = await spool.allocate(128, 3)
+    job.write_metadata(bytes(range(16)))
+    job.write_first_block(b'\x01' * DATA_BLOCK_SIZE)
+    assert job.append_chunk((1).to_bytes(4, 'little'), b'\x02' * DATA_BLOCK_SIZE)
+    assert job.append_chunk((2).to_bytes(4, 'little'), b'\x03' * 100)
+    spool.commit(job)
+
+    # a partial upload isn't recovered
+    partial = await spool.allocate(129, 2)
+    partial.unmap()
+
+    restarted = Spool(str(tmp_path))
+    recovered = restarted.recover()
+
+    assert [j.job_id for j in recovered] == [job.job_id]
+    recovered_job = await restarted.get_ready()
+    assert recovered_job.state == JOB_READY
+    assert recovered_job.received == 2
+    assert bytes(recovered_job.get_metadata()) == bytes(range(16))
+    index, block = recovered_job.get_chunk(1)
+    assert int.from_bytes(index, 'little') == 2
+    assert bytes(block[:100]) == b'\x03' * 100
+    del index, block
+
+    await restarted.release(recovered_job)
+    # the new job ids continue after the ones already used
+    new_job = await restarted.allocate(128, 1)
+    assert new_job.job_id > job.job_id
+    new_job.unmap()
+
+
+@pytest.mark.asyncio
+async def test_job_rejects_chunks_beyond_declared_size(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.recover()
+
+    job = await spool.allocate(128, 1)
+    assert job.append_chunk(b'\x00' * 4, b'\x00' * DATA_BLOCK_SIZE)
+    assert not job.append_chunk(b'\x00' * 4, b'\x00' * DATA_BLOCK_SIZE)
+    await spool.release(job)
+
+
+@pytest.mark.asyncio
+async def test_released_files_are_reused(tmp_path):
+    spool = Spool(str(tmp_path), max_jobs=1)
+    spool.recover()
+
+    job = await spool.allocate(128, 4)
+    await spool.release(job)
+    job = await spool.allocate(128, 2)
+
+    assert len(os.listdir(str(tmp_path))) == 1
+    assert spool.as_dict()['jobs'][0]['job_id'] == 2
+    await spool.release(job)
+
+
+@pytest.mark.asyncio
+async def test_job_ids_keep_growing_after_restart(tmp_path):
+    job_ids = []
+    for jobs in (3, 2, 4):
+        spool = Spool(str(tmp_path), max_jobs=4)
+        spool.recover()
+        allocated = [await spool.allocate(128, 1) for _ in range(jobs)]
+        job_ids += [job.job_id for job in allocated]
+        for job in allocated:
+            await spool.release(job)
+
+    # the ids sent to the clients don't repeat, and the files left by the previous runs are reused
+    assert job_ids == list(range(1, 10))
+    assert len(os.listdir(str(tmp_path))) == 4